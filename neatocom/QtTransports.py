@@ -10,7 +10,8 @@ import sys
 import logging
 from qtpy.QtCore import QProcess
 from qtpy.QtNetwork import QUdpSocket, QTcpSocket, QAbstractSocket, QHostAddress
-from .transports import Transport
+from .transports import Transport, ReceiveBuffer
+from .compression import Compression, CompressionError, FramePacker
 
 L = lambda: logging.getLogger(__name__)
 
@@ -27,7 +28,7 @@ class QProcessTransport(Transport):
     def __init__(self, cmdline, sendername='qprocess'):
         self.cmdline = cmdline
         self.sendername = sendername
-        self.leftover = b''
+        self.buffer = ReceiveBuffer()
         self.process = QProcess()
         self.process.readyRead.connect(self.on_ready_read)
         self.process.finished.connect(self.on_finished)
@@ -50,19 +51,15 @@ class QProcessTransport(Transport):
         self.process.write(data)
 
     def on_ready_read(self):
-        data = self.process.readAllStandardOutput().data()
+        self.buffer.feed(self.process.readAllStandardOutput().data())
         errors = self.process.readAllStandardError().data().decode('utf8')
         if errors:
             L().error('Error from child process:\n%s' % errors)
-        pdata = data.decode('utf8')
-        if len(pdata) > 100:
-            pdata = pdata[:100] + '...'
-        #if pdata.startswith('{'):
-        L().debug('message from child process: %s'%pdata)
-        self.leftover = self.received(
-            sender=self.sendername,
-            data=self.leftover + data
-        )
+        frame = self.buffer.pop_frame()
+        if not frame:
+            return
+        L().debug('message from child process: %d bytes'%len(frame))
+        self.buffer.unget(self.received(sender=self.sendername, data=frame))
 
     def on_finished(self):
         L().info('Child process exited.')
@@ -73,12 +70,20 @@ class QTcpTransport(Transport):
     
     Connect using .start().
     
-    Received data is processed on the Qt mainloop thread.
+    Received data is processed on the Qt mainloop thread, once a
+    message is complete. recv_buffer_size sets the OS receive buffer.
+    
+    With compression=True, compression is offered to the server on connect
+    (see neatocom.compression). .compression holds the state of the
+    current connection.
     '''
-    def __init__(self, host, port, sendername='qtcp'):
+    def __init__(self, host, port, sendername='qtcp', recv_buffer_size=256*1024, compression=True):
         self.address = (host, port)
         self.sendername = sendername
-        self.leftover = b''
+        self.recv_buffer_size = recv_buffer_size
+        self.buffer = ReceiveBuffer()
+        self.packer = FramePacker() if compression else None
+        self.compression = None
         self.socket = QTcpSocket()
         self.socket.readyRead.connect(self.on_ready_read)
         self.socket.error.connect(self.on_error)
@@ -94,27 +99,41 @@ class QTcpTransport(Transport):
     def stop(self):
         self.socket.flush()
         self.socket.disconnectFromHost()
+        if self.packer:
+            L().info(self.packer.stats.summary())
 
     def send(self, data, receivers=None):
         if receivers is not None and self.sendername not in receivers:
             return
         L().debug('message to tcp server: %s'%data)
+        if self.compression is not None:
+            data = self.compression.pack(data)
         self.socket.write(data)
 
     def on_ready_read(self):
         data = self.socket.readAll().data()
-        pdata = data
-        if len(pdata) > 100:
-            pdata = pdata[:100] + b'...'
-        #if pdata.startswith('{'):
-        L().debug('message from tcp server: %s'%pdata)
-        self.leftover = self.received(
-            sender=self.sendername,
-            data=self.leftover + data
-        )
+        if self.compression is not None:
+            try:
+                data, answer = self.compression.received(data)
+            except CompressionError as e:
+                L().error('data from tcp server: %s'%e)
+                self.socket.abort()
+                return
+        self.buffer.feed(data)
+        frame = self.buffer.pop_frame()
+        if not frame:
+            return
+        L().debug('message from tcp server: %d bytes'%len(frame))
+        self.buffer.unget(self.received(sender=self.sendername, data=frame))
         
     def on_connect(self):
-         L().info('QTcpSocket: Established connection to %s'%(self.address,))
+        L().info('QTcpSocket: Established connection to %s'%(self.address,))
+        self.socket.setSocketOption(QAbstractSocket.ReceiveBufferSizeSocketOption, self.recv_buffer_size)
+        # moves are small messages, don't let Nagle delay them
+        self.socket.setSocketOption(QAbstractSocket.LowDelayOption, 1)
+        if self.packer:
+            self.compression = Compression(self.packer, offer=True)
+            self.socket.write(self.compression.hello())
 
     def on_error(self, error):
         L().info('QTcpSocket raised error: %s'%error)
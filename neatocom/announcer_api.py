@@ -63,11 +63,17 @@ def make_announcer(transport, description='', filter_func=None, codec=TerseCodec
     return api
 
 
-def make_udp_announcer(port, description='', filter_func=None, codec=TerseCodec()):
+def make_udp_announcer(port, description='', filter_func=None, codec=TerseCodec(), use_asyncio=False):
     '''makes an annoncer using UdpTransport(port) and returns it.
     
     Start/stop with announcer.transport.start() / .stop().
+
+    With use_asyncio=True, AsyncioUdpTransport is used instead, e.g. for
+    passing the announcer to an AsyncioTcpServerTransport.
     '''
-    from .network_transports import UdpTransport
+    if use_asyncio:
+        from .asyncio_transports import AsyncioUdpTransport as UdpTransport
+    else:
+        from .network_transports import UdpTransport
     transport = UdpTransport(port)
     return make_announcer(transport, description, filter_func, codec)
@@ -0,0 +1,91 @@
+'''ApiStats: per-method message statistics of a RemoteAPI.
+
+Enable with RemoteAPI.enable_stats(). Recorded per method name:
+
+ * calls_in, bytes_in, decode_s, handler_s for incoming messages
+ * calls_out, bytes_out, encode_s, send_s for outgoing messages
+
+Times are in seconds (sums over all calls). handler_s covers the
+@incoming method body and all connected handlers.
+
+Calls made within RemoteAPI.batch() are recorded with send_s = 0. The
+frames sent when the batch ends are recorded as method '(batch)', with
+calls_out counting frames and bytes_out = 0 (the bytes are already
+counted per method).
+
+If log_interval is set, a summary of the last interval is logged every
+log_interval seconds (checked whenever a message passes; no timer thread).
+'''
+import time
+import threading
+import logging
+L = lambda: logging.getLogger(__name__)
+
+__all__ = [
+    'ApiStats',
+]
+
+FIELDS = [
+    'calls_in', 'bytes_in', 'decode_s', 'handler_s',
+    'calls_out', 'bytes_out', 'encode_s', 'send_s',
+]
+
+
+class ApiStats(object):
+    def __init__(self, log_interval=None, log_top=10):
+        self.log_interval = log_interval
+        self.log_top = log_top
+        # method -> {field: value}, since start / since last log line
+        self._totals = {}
+        self._window = {}
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+
+    def _add(self, method, values):
+        with self._lock:
+            for table in (self._totals, self._window):
+                entry = table.get(method)
+                if entry is None:
+                    entry = table[method] = dict.fromkeys(FIELDS, 0)
+                for key, value in values.items():
+                    entry[key] += value
+        if self.log_interval and time.monotonic() - self._window_start >= self.log_interval:
+            self.log()
+
+    def incoming(self, method, nbytes, decode_s, handler_s):
+        self._add(method, {'calls_in': 1, 'bytes_in': nbytes, 'decode_s': decode_s, 'handler_s': handler_s})
+
+    def outgoing(self, method, nbytes, encode_s, send_s):
+        self._add(method, {'calls_out': 1, 'bytes_out': nbytes, 'encode_s': encode_s, 'send_s': send_s})
+
+    def snapshot(self):
+        '''returns {method: {field: value}} since start.'''
+        with self._lock:
+            return {method: dict(entry) for method, entry in self._totals.items()}
+
+    def reset(self):
+        with self._lock:
+            self._totals = {}
+            self._window = {}
+            self._window_start = time.monotonic()
+
+    def log(self):
+        '''logs the figures since the last log line, most expensive methods first.'''
+        with self._lock:
+            window, self._window = self._window, {}
+            elapsed = time.monotonic() - self._window_start
+            self._window_start += elapsed
+        if not window:
+            return
+        def cost(item):
+            e = item[1]
+            return e['decode_s'] + e['handler_s'] + e['encode_s'] + e['send_s']
+        lines = []
+        for method, e in sorted(window.items(), key=cost, reverse=True)[:self.log_top]:
+            lines.append(
+                '  %-16s in %6d (%8d B, dec %7.1f ms, handler %7.1f ms)  out %6d (%8d B, enc %7.1f ms, send %7.1f ms)'%(
+                    method,
+                    e['calls_in'], e['bytes_in'], 1e3*e['decode_s'], 1e3*e['handler_s'],
+                    e['calls_out'], e['bytes_out'], 1e3*e['encode_s'], 1e3*e['send_s'],
+                ))
+        L().info('message stats for the last %.0f s:\n%s'%(elapsed, '\n'.join(lines)))
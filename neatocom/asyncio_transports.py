@@ -0,0 +1,488 @@
+'''transports running on a single asyncio event loop.
+
+Same interface as the threaded transports, but all sockets are served by one
+event loop in one thread. No thread per connection, no polling timeouts.
+
+Classes defined here:
+ * AsyncioTransport: base class
+ * AsyncioMuxTransport: owns the event loop and muxes several AsyncioTransports.
+ * AsyncioStdioTransport: reads from stdin, writes to stdout.
+ * AsyncioTcpServerTransport: accepts tcp connections.
+ * AsyncioUdpTransport: sends and receives UDP datagrams (e.g. for the announcer).
+
+Typical server setup:
+
+>>> transport = AsyncioMuxTransport()
+>>> transport += AsyncioStdioTransport()
+>>> transport += AsyncioTcpServerTransport(port=8888)
+>>> api = SomeAPI(codec=TerseCodec(), transport=transport)
+>>> transport.run()
+'''
+
+__all__ = [
+    'AsyncioTransport',
+    'AsyncioMuxTransport',
+    'AsyncioStdioTransport',
+    'AsyncioTcpServerTransport',
+    'AsyncioUdpTransport',
+]
+
+import asyncio
+import logging
+import socket as sk
+import sys
+import threading
+
+from .transports import Transport, MuxTransport, ReceiveBuffer
+from .compression import Compression, CompressionError, FramePacker, PackedData
+
+L = lambda: logging.getLogger(__name__)
+
+
+def _as_list(receivers):
+    # a single receiver may be given as plain string
+    if isinstance(receivers, str):
+        return [receivers]
+    return receivers
+
+
+def _on_loop_thread(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class AsyncioTransport(Transport):
+    '''Base for transports running on an asyncio event loop.
+
+    If the transport was added to an AsyncioMuxTransport, it runs on the
+    mux's loop; .start() and .stop() only open and close the underlying
+    channel. Otherwise .run() runs an own event loop (blocking), and .start()
+    does so in a new thread.
+
+    Subclasses implement the coroutines _open() and _close(), which are
+    executed on the loop thread. .send() may be called from any thread.
+    '''
+    def __init__(self):
+        Transport.__init__(self)
+        self.loop = None
+        self._owns_loop = False
+
+    def run(self):
+        '''Run on an own event loop, blocking.'''
+        self.loop = asyncio.new_event_loop()
+        self._owns_loop = True
+        self.running = True
+        try:
+            self.loop.run_until_complete(self._open())
+            self.loop.run_forever()
+            self.loop.run_until_complete(self._close())
+        finally:
+            self.loop.close()
+            self.loop = None
+            self._owns_loop = False
+
+    def start(self):
+        if self.loop is None:
+            # no loop given, run standalone.
+            Transport.start(self)
+            return
+        self.running = True
+        future = asyncio.run_coroutine_threadsafe(self._open(), self.loop)
+        future.add_done_callback(self._opened)
+
+    def _opened(self, future):
+        '''logs a failed _open(); the transport does not run then.'''
+        if future.cancelled() or future.exception() is None:
+            return
+        L().error('%s could not be opened: %s'%(type(self).__name__, future.exception()))
+        self.running = False
+
+    def stop(self):
+        self.running = False
+        if self.loop is None:
+            return
+        if self._owns_loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            thread = getattr(self, '_thread', None)
+            if thread and thread is not threading.current_thread():
+                thread.join()
+        else:
+            asyncio.run_coroutine_threadsafe(self._close(), self.loop)
+
+    def call_soon(self, func, *args):
+        '''call func on the loop thread; immediately if we are on it.'''
+        if _on_loop_thread(self.loop):
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    async def _open(self):
+        '''Open the channel. Override me.'''
+        pass
+
+    async def _close(self):
+        '''Close the channel. Override me.'''
+        pass
+
+
+class AsyncioMuxTransport(MuxTransport):
+    '''MuxTransport running all muxed transports on one asyncio event loop.
+
+    Muxed transports must be AsyncioTransports. Incoming data is handled
+    directly on the loop thread, i.e. the thread of AsyncioMuxTransport.run().
+    '''
+    def __init__(self):
+        MuxTransport.__init__(self)
+        self.loop = asyncio.new_event_loop()
+
+    def add_transport(self, transport, start=True):
+        transport.loop = self.loop
+        return MuxTransport.add_transport(self, transport, start)
+
+    __iadd__ = add_transport
+
+    def handle_received(self, sender, data):
+        '''handles INCOMING data from any of the muxed transports.
+        b'' is returned as leftover ALWAYS; remainders are kept per sender.
+        '''
+        leftover = self.leftovers.pop(sender, b'')
+        leftover = self.received(sender, leftover + data)
+        if leftover:
+            self.leftovers[sender] = leftover
+        return b''
+
+    def stop(self):
+        L().debug('AsyncioMuxTransport.stop() called')
+        self.running = False
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        thread = getattr(self, '_thread', None)
+        if thread and thread is not threading.current_thread():
+            thread.join()
+
+    def run(self):
+        L().debug('AsyncioMuxTransport.run() called')
+        asyncio.set_event_loop(self.loop)
+        self.running = True
+        # open all channels before serving; e.g. a server that cannot
+        # listen on its port must not run silently.
+        for transport in self.transports:
+            transport.running = True
+        results = self.loop.run_until_complete(asyncio.gather(
+            *[transport._open() for transport in self.transports], return_exceptions=True
+        ))
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            for transport, result in zip(self.transports, results):
+                if isinstance(result, Exception):
+                    L().error('%s could not be opened: %s'%(type(transport).__name__, result))
+            self.running = False
+            for transport in self.transports:
+                transport.running = False
+            self.loop.run_until_complete(asyncio.gather(
+                *[transport._close() for transport in self.transports], return_exceptions=True
+            ))
+            self.loop.close()
+            raise errors[0]
+        self.loop.run_forever()
+        self.loop.run_until_complete(asyncio.gather(
+            *[transport._close() for transport in self.transports]
+        ))
+        self.loop.close()
+        L().debug('AsyncioMuxTransport has finished')
+
+
+class _StdinProtocol(asyncio.Protocol):
+    def __init__(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.received(sender='stdio', data=data)
+
+    def eof_received(self):
+        L().info('stdin was closed')
+
+
+class AsyncioStdioTransport(AsyncioTransport):
+    '''reads from stdin, writes to stdout. Sender name is "stdio".'''
+    def __init__(self):
+        AsyncioTransport.__init__(self)
+        self.leftover = b''
+        self._pipe = None
+
+    async def _open(self):
+        try:
+            self._pipe, _ = await self.loop.connect_read_pipe(
+                lambda: _StdinProtocol(self), sys.stdin.buffer
+            )
+        except ValueError:
+            # stdin is a regular file, which cannot be polled.
+            L().debug('stdin is not a pipe, reading on a separate thread')
+            threading.Thread(target=self._read_blocking, name='AsyncioStdioTransport', daemon=True).start()
+
+    def _read_blocking(self):
+        while self.running:
+            data = sys.stdin.buffer.read1(65536)
+            if not data:
+                L().info('stdin was closed')
+                break
+            self.loop.call_soon_threadsafe(self.received, 'stdio', data)
+
+    async def _close(self):
+        if self._pipe:
+            self._pipe.close()
+            self._pipe = None
+
+    def received(self, sender, data):
+        self.leftover = Transport.received(self, sender, self.leftover + data)
+        return b''
+
+    def send(self, data, receivers=None):
+        if receivers is not None and 'stdio' not in receivers:
+            return
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+
+class _TcpConnectionProtocol(asyncio.BufferedProtocol):
+    '''one TCP connection of AsyncioTcpServerTransport.
+
+    The event loop reads directly into a reusable buffer of
+    server.recv_buffer_size bytes.
+    '''
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.name = None
+        self._chunk = memoryview(bytearray(server.recv_buffer_size))
+        self._buffer = ReceiveBuffer()
+        self.compression = Compression(server.packer) if server.packer else None
+        self.max_queued_bytes = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.name = '%s:%s'%transport.get_extra_info('peername')[:2]
+        L().debug('TCP connect from %s'%self.name)
+        transport.set_write_buffer_limits(high=self.server.write_buffer_high)
+        self.server.connections[self.name] = self
+
+    def get_buffer(self, sizehint):
+        return self._chunk
+
+    def buffer_updated(self, nbytes):
+        data = self._chunk[:nbytes]
+        if self.compression is not None:
+            try:
+                data, answer = self.compression.received(data)
+            except CompressionError as e:
+                L().warning('%s: %s, closing the connection'%(self.name, e))
+                self.transport.close()
+                return
+            if answer:
+                self.transport.write(answer)
+                self.compression.start_sending()
+            if self.compression.passthrough:
+                self.compression = None
+        self._buffer.feed(data)
+        frame = self._buffer.pop_frame()
+        if frame:
+            self._buffer.unget(self.server.received(sender=self.name, data=frame))
+
+    def connection_lost(self, exc):
+        L().debug('Closed TCP connection to %s'%self.name)
+        self.server.connections.pop(self.name, None)
+        self.server.forget(self.name)
+
+    def pause_writing(self):
+        L().debug('%s: write buffer above high water mark'%self.name)
+
+    def resume_writing(self):
+        L().debug('%s: write buffer drained'%self.name)
+
+    def send(self, data, packed=None):
+        '''packed: PackedData of data, used if compression is enabled.'''
+        if self.transport.is_closing():
+            return
+        if packed is not None and self.compression is not None and self.compression.enabled:
+            data = packed.packed()
+        server = self.server
+        if self.transport.get_write_buffer_size() + len(data) > server.max_queue_bytes:
+            self.dropped += 1
+            if server.overflow_policy == 'drop':
+                L().warning('%s does not keep up with sending, message dropped'%self.name)
+                return
+            L().warning('%s does not keep up with sending, disconnecting'%self.name)
+            self.transport.abort()
+            return
+        self.transport.write(data)
+        self.max_queued_bytes = max(self.max_queued_bytes, self.transport.get_write_buffer_size())
+
+    def queue_stats(self):
+        '''same metrics as _TcpConnection.queue_stats() of the threaded server.'''
+        return {
+            'queued_bytes': self.transport.get_write_buffer_size(),
+            'max_queued_bytes': self.max_queued_bytes,
+            'dropped_messages': self.dropped,
+        }
+
+
+class AsyncioTcpServerTransport(AsyncioTransport):
+    '''transport that accepts TCP connections, like TcpServerTransport.
+
+    Senders / receivers are named "host:port" of the remote side.
+    Use .close(name) for server-side disconnect.
+
+    Writes never block: outgoing data is buffered per connection. Above
+    write_buffer_high bytes the connection counts as congested. If more than
+    max_queue_bytes are pending, overflow_policy decides what happens:
+     - 'disconnect': the connection is closed (default).
+     - 'drop': the message is discarded for this connection.
+    .stats() returns the queue metrics of all connections.
+
+    Each connection reads up to recv_buffer_size bytes at once into a
+    reusable buffer.
+
+    With compression=True, clients offering compression get big frames
+    compressed (see neatocom.compression). A FramePacker can be given
+    instead of True. .compression_stats() returns the byte and time counters.
+
+    You can optionally pass an announcer (as returned by
+    announcer_api.make_udp_announcer(use_asyncio=True)). It will run on the
+    same loop and be started/stopped together with the server.
+    '''
+    def __init__(self, port, interface='', announcer=None, write_buffer_high=256*1024, max_queue_bytes=16*1024*1024, overflow_policy='disconnect', recv_buffer_size=64*1024, compression=True):
+        if overflow_policy not in ('disconnect', 'drop'):
+            raise ValueError('Unknown overflow_policy %r'%overflow_policy)
+        AsyncioTransport.__init__(self)
+        if compression is True:
+            compression = FramePacker()
+        self.packer = compression or None
+        self.addr = (interface, port)
+        self.announcer = announcer
+        self.write_buffer_high = write_buffer_high
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow_policy = overflow_policy
+        self.recv_buffer_size = recv_buffer_size
+        # name -> _TcpConnectionProtocol
+        self.connections = {}
+        self._server = None
+
+    async def _open(self):
+        interface, port = self.addr
+        self._server = await self.loop.create_server(
+            lambda: _TcpConnectionProtocol(self),
+            host=interface or None,
+            port=port,
+            reuse_address=True,
+        )
+        L().info('listening on port %d'%port)
+        if self.announcer:
+            self.announcer.transport.loop = self.loop
+            self.announcer.transport.start()
+
+    async def _close(self):
+        if self.announcer:
+            await self.announcer.transport._close()
+        if self._server:
+            self._server.close()
+            for connection in list(self.connections.values()):
+                connection.transport.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self.packer:
+            L().info(self.packer.stats.summary())
+
+    def send(self, data, receivers=None):
+        self.call_soon(self._send, data, receivers)
+
+    def _send(self, data, receivers):
+        receivers = _as_list(receivers)
+        if receivers is None:
+            connections = list(self.connections.values())
+        else:
+            connections = [self.connections[name] for name in receivers if name in self.connections]
+        packed = PackedData(data, self.packer) if self.packer else None
+        for connection in connections:
+            connection.send(data, packed)
+
+    def close(self, name):
+        '''close the connection with the given sender/receiver name.'''
+        self.call_soon(self._close_connection, name)
+
+    def stats(self):
+        '''returns {connection name: queue metrics}.'''
+        return {
+            name: connection.queue_stats()
+            for name, connection in list(self.connections.items())
+        }
+
+    def compression_stats(self):
+        '''returns the compression counters (see CompressionStats.snapshot), or None.'''
+        return self.packer.stats.snapshot() if self.packer else None
+
+    def _close_connection(self, name):
+        connection = self.connections.get(name)
+        if connection:
+            connection.transport.close()
+
+
+class _UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        host, port = addr[:2]
+        L().debug('message from udp %s: %s'%(host, data))
+        # not using leftover data here, since udp packets are
+        # not guaranteed to arrive in order.
+        self.transport.received(sender=host, data=data)
+
+    def error_received(self, exc):
+        L().info('UDP error: %s'%exc)
+
+
+class AsyncioUdpTransport(AsyncioTransport):
+    '''transport that communicates over UDP datagrams, like UdpTransport.
+
+    Connectionless - sender/receiver are IP addresses. Sending and receiving is
+    done on the same port. Sending with receiver=None makes a broadcast.
+    '''
+    def __init__(self, port):
+        AsyncioTransport.__init__(self)
+        self.port = port
+        self._endpoint = None
+
+    async def _open(self):
+        sock = sk.socket(sk.AF_INET, sk.SOCK_DGRAM)
+        sock.setsockopt(sk.SOL_SOCKET, sk.SO_BROADCAST, 1)
+        sock.setsockopt(sk.SOL_SOCKET, sk.SO_REUSEADDR, 1)
+        try:
+            sock.setsockopt(sk.SOL_SOCKET, sk.SO_REUSEPORT, 1)
+        except AttributeError:
+            # SO_REUSEPORT not available.
+            pass
+        sock.bind(('', self.port))
+        self._endpoint, _ = await self.loop.create_datagram_endpoint(
+            lambda: _UdpProtocol(self), sock=sock
+        )
+
+    async def _close(self):
+        if self._endpoint:
+            self._endpoint.close()
+            self._endpoint = None
+
+    def send(self, data, receivers=None):
+        self.call_soon(self._send, data, receivers)
+
+    def _send(self, data, receivers):
+        L().debug('message to udp %r: %s'%(receivers, data))
+        if not self._endpoint:
+            return
+        receivers = _as_list(receivers)
+        if receivers:
+            for receiver in receivers:
+                self._endpoint.sendto(data, (receiver, self.port))
+        else:
+            self._endpoint.sendto(data, ('<broadcast>', self.port))
@@ -5,9 +5,11 @@ Codecs convert message structures into bytes and vice versa.
 Classes defined here:
  * Codec: base class
  * Message, DecodeError
+ * Cached: value whose encoded form is reused
 '''
 
 __all__ = [
+    'Cached',
     'Codec',
     'DecodeError',
     'Message',
@@ -34,10 +36,34 @@ class AttrDict(dict):
     __getattr__ = dict.__getitem__
 
 
+class Cached(object):
+    '''Wraps a value that is sent repeatedly without changes.
+    
+    Codecs that support it encode the value only once and reuse the result.
+    The wrapped value must not be modified afterwards.
+    '''
+    def __init__(self, value):
+        self.value = value
+        self._encoded = {}
+        
+    def encoded(self, key, encode):
+        '''returns encode(value), cached under key.'''
+        try:
+            return self._encoded[key]
+        except KeyError:
+            data = self._encoded[key] = encode(self.value)
+            return data
+
+
 class Codec(object):
     '''Responsible for serializing and deserializing method calls.
     
     Subclass and override `encode` and `decode`.
+    
+    Encoded messages must be self-delimiting (all codecs here end them with
+    a newline): the concatenation of several encoded messages is a valid
+    frame, which `decode` returns as the list of messages in order.
+    RemoteAPI.batch() and ReceiveBuffer rely on this.
     '''
     def decode(self, data):
         '''decode data to method call with kwargs.
@@ -65,6 +91,9 @@ class MyJsonEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, bytes):
             return {'__bytes': base64.b64encode(obj).decode('utf8')}
+        if isinstance(obj, Cached):
+            # not cached, json does not allow to insert preencoded data
+            return obj.value
         return json.JSONEncoder.default(self, obj)
     
 class MyJsonDecoder(json.JSONDecoder):
@@ -143,6 +172,7 @@ class TerseCodec(Codec):
     * Commands must be terminated by newline. 
     * Newlines, double quote and backslash in strings are escaped as usual
     * Allowed dtypes: int, float, str, bytes (content base64-encoded), list, dict
+    * Cached values are encoded only once.
     '''
     def encode(self, method, kwargs):
         '''encodes the call, including trailing newline'''
@@ -187,6 +217,8 @@ def _encode_value(value):
         return _encode_iterable(value)
     elif isinstance(value, dict):
         return _encode_dict(value)
+    elif isinstance(value, Cached):
+        return value.encoded('terse', _encode_value)
     
 def _encode_iterable(l):
     return b'[' + b' '.join(_encode_value(value) for value in l) + b']'
@@ -0,0 +1,324 @@
+'''Optional per-frame compression for TCP transports.
+
+Negotiation: the client starts the connection with the line
+
+    ~compress zlib
+
+(an offer, listing the methods it understands). A server supporting
+compression answers with the same kind of line, naming the chosen method.
+The offer has to be the first line of the client; a server receiving
+anything else treats the connection as plain. Older servers log the offer
+as undecodable message and ignore it; older clients never send one.
+
+Wire format: after the answer, both sides may send compressed frames
+
+    0x01 <4 byte big endian length> <zlib data>
+
+in between the plain (newline-terminated) messages. A frame starts only
+where a message could start. Its content is a sequence of complete
+messages. Plain text never starts with 0x01, so received data can be
+parsed without knowing whether the peer compressed it.
+
+What gets compressed (FramePacker):
+ * nothing below `threshold` bytes (moves and the like);
+ * big frames are sampled first; if the sample does not shrink by
+   `min_saving`, the frame is sent plain (e.g. image data);
+ * a frame is sent plain if compression saves less than `min_saving`;
+ * frames above `fast_above` bytes use the faster zlib level 1. (The
+   standard library has no LZ4.)
+
+Frames are compressed independently of each other, so that a broadcast is
+compressed once for all connections (see PackedData).
+
+Limits: a server accepts frames of at most MAX_CLIENT_FRAME bytes from
+clients, compressed and decompressed (a small frame can inflate to
+gigabytes). Bigger or corrupt frames raise CompressionError; the
+transports close the connection then.
+
+CompressionStats counts bytes before and after compression and the CPU time
+spent in both directions.
+'''
+
+__all__ = [
+    'CompressionError',
+    'CompressionStats',
+    'FramePacker',
+    'PackedData',
+    'StreamUnpacker',
+    'Compression',
+    'hello_line',
+]
+
+import time
+import zlib
+import struct
+import threading
+import logging
+L = lambda: logging.getLogger(__name__)
+
+HELLO = b'~compress'
+METHODS = ['zlib']
+FRAME_ZLIB = 0x01
+_HEADER = struct.Struct('>BI')
+# limit for frames received from clients, see Compression
+MAX_CLIENT_FRAME = 16 << 20
+
+
+class CompressionError(Exception): pass
+
+
+def hello_line(methods=METHODS):
+    return HELLO + b' ' + ' '.join(methods).encode('ascii') + b'\n'
+
+
+class CompressionStats(object):
+    '''byte and time counters, shared by the connections of a transport.'''
+    FIELDS = [
+        'frames_out', 'compressed_out', 'skipped_out', 'raw_bytes_out', 'wire_bytes_out', 'compress_s',
+        'frames_in', 'raw_bytes_in', 'wire_bytes_in', 'decompress_s',
+    ]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(self.FIELDS, 0)
+
+    def add(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self._counters[key] += value
+
+    def snapshot(self):
+        '''returns the counters plus derived figures:
+        ratio_out (wire / raw bytes of compressed frames) and
+        compress_us_per_frame.
+        '''
+        with self._lock:
+            result = dict(self._counters)
+        if result['raw_bytes_out']:
+            result['ratio_out'] = result['wire_bytes_out'] / float(result['raw_bytes_out'])
+        if result['frames_out']:
+            result['compress_us_per_frame'] = 1e6 * result['compress_s'] / result['frames_out']
+        return result
+
+    def summary(self):
+        s = self.snapshot()
+        return (
+            'compression: out %d frames (%d compressed, %d incompressible), %d -> %d bytes, %.1f ms; '
+            'in %d frames, %d -> %d bytes, %.1f ms'%(
+                s['frames_out'], s['compressed_out'], s['skipped_out'],
+                s['raw_bytes_out'], s['wire_bytes_out'], 1e3*s['compress_s'],
+                s['frames_in'], s['wire_bytes_in'], s['raw_bytes_in'], 1e3*s['decompress_s'],
+            )
+        )
+
+
+class FramePacker(object):
+    '''decides about and does the compression of outgoing frames.'''
+    def __init__(self, threshold=2048, min_saving=0.1, sample_size=16*1024, level=6, fast_above=1024*1024, stats=None):
+        self.threshold = threshold
+        self.min_saving = min_saving
+        self.sample_size = sample_size
+        self.level = level
+        self.fast_above = fast_above
+        self.stats = stats or CompressionStats()
+
+    def pack(self, data):
+        '''returns data (plain) or a compressed frame.'''
+        if len(data) < self.threshold:
+            return data
+        t0 = time.perf_counter()
+        packed = None
+        if len(data) > 4 * self.sample_size:
+            sample = zlib.compress(data[:self.sample_size], 1)
+            if len(sample) > (1 - self.min_saving) * self.sample_size:
+                packed = data
+        if packed is None:
+            packed = zlib.compress(data, 1 if len(data) > self.fast_above else self.level)
+            if len(packed) + _HEADER.size > (1 - self.min_saving) * len(data):
+                packed = data
+            else:
+                packed = _HEADER.pack(FRAME_ZLIB, len(packed)) + packed
+        compressed = packed is not data
+        self.stats.add(
+            frames_out=1,
+            compressed_out=int(compressed),
+            skipped_out=int(not compressed),
+            raw_bytes_out=len(data),
+            wire_bytes_out=len(packed),
+            compress_s=time.perf_counter() - t0,
+        )
+        return packed
+
+
+class PackedData(object):
+    '''data sent to several connections, compressed at most once.'''
+    def __init__(self, data, packer):
+        self.data = data
+        self.packer = packer
+        self._packed = None
+
+    def packed(self):
+        if self._packed is None:
+            self._packed = self.packer.pack(self.data)
+        return self._packed
+
+
+class StreamUnpacker(object):
+    '''turns a received byte stream back into plain messages.
+
+    Decompresses frames and takes out the hello line of the peer,
+    which is passed to on_hello(methods).
+
+    Until the hello was seen (or given up with take_buffer()), incomplete
+    lines are held back, so that a hello split over two reads is recognized.
+
+    max_frame: largest accepted frame, compressed and decompressed;
+    None for no limit. CompressionError is raised for bigger or corrupt
+    frames.
+    '''
+    def __init__(self, stats, on_hello=None, max_frame=None):
+        self.stats = stats
+        self.on_hello = on_hello
+        self.max_frame = max_frame
+        self.looking = True
+        self._buffer = bytearray()
+        self._line_start = True
+
+    def take_buffer(self):
+        '''stops looking for the hello and returns the data held back.
+        Only for streams without compressed frames.'''
+        self.looking = False
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    def feed(self, data):
+        '''returns the plain data contained in the received data so far.'''
+        buf = self._buffer
+        buf += data
+        out = []
+        while buf:
+            if self._line_start and buf[0] == FRAME_ZLIB:
+                if len(buf) < _HEADER.size:
+                    break
+                size = _HEADER.unpack_from(buf)[1]
+                if self.max_frame is not None and size > self.max_frame:
+                    raise CompressionError('frame of %d bytes, limit is %d'%(size, self.max_frame))
+                end = _HEADER.size + size
+                if len(buf) < end:
+                    break
+                t0 = time.perf_counter()
+                with memoryview(buf) as view:
+                    plain = self._decompress(view[_HEADER.size:end])
+                del buf[:end]
+                self.stats.add(
+                    frames_in=1,
+                    wire_bytes_in=end,
+                    raw_bytes_in=len(plain),
+                    decompress_s=time.perf_counter() - t0,
+                )
+                out.append(plain)
+                continue
+            # plain data, up to the next frame
+            end = buf.find(b'\n\x01') + 1
+            if not end:
+                end = buf.rfind(b'\n') + 1 if self.looking else len(buf)
+                if not end:
+                    break
+            chunk = bytes(buf[:end])
+            del buf[:end]
+            self._line_start = chunk.endswith(b'\n')
+            if self.looking:
+                chunk = self._take_hello(chunk)
+            out.append(chunk)
+        return b''.join(out)
+
+    def _decompress(self, data):
+        decompressor = zlib.decompressobj()
+        try:
+            if self.max_frame is None:
+                plain = decompressor.decompress(data)
+            else:
+                # one byte more than allowed tells that the limit is exceeded
+                plain = decompressor.decompress(data, self.max_frame + 1)
+                if len(plain) > self.max_frame:
+                    raise CompressionError('frame decompresses to more than %d bytes'%self.max_frame)
+        except zlib.error as e:
+            raise CompressionError('corrupt frame: %s'%e)
+        if not decompressor.eof:
+            raise CompressionError('incomplete frame')
+        return plain
+
+    def _take_hello(self, chunk):
+        '''removes the hello line from chunk (complete lines).'''
+        if chunk.startswith(HELLO):
+            idx = 0
+        else:
+            idx = chunk.find(b'\n' + HELLO) + 1
+            if not idx:
+                return chunk
+        end = chunk.index(b'\n', idx) + 1
+        methods = chunk[idx + len(HELLO):end].decode('ascii', 'replace').split()
+        self.looking = False
+        if self.on_hello:
+            self.on_hello(methods)
+        return chunk[:idx] + chunk[end:]
+
+
+class Compression(object):
+    '''compression state of one connection.
+
+    Client side: create with offer=True and send .hello() first thing.
+    Server side: create with offer=False; .received() returns the answer
+    to send back, if the client offered compression.
+
+    After negotiation, .enabled is True and outgoing data should go through
+    .pack() (or PackedData). If the client does not offer compression,
+    .passthrough becomes True; received data needs no unpacking then.
+
+    max_frame: see StreamUnpacker. Default: MAX_CLIENT_FRAME on the server
+    side; no limit on the client side, which trusts its server.
+    .received() raises CompressionError; close the connection then.
+    '''
+    def __init__(self, packer, offer=False, max_frame=None):
+        self.packer = packer
+        self.offer = offer
+        self.enabled = False
+        self.passthrough = False
+        self.method = None
+        self._answer = None
+        if max_frame is None and not offer:
+            max_frame = MAX_CLIENT_FRAME
+        self.unpacker = StreamUnpacker(packer.stats, on_hello=self._on_hello, max_frame=max_frame)
+
+    def hello(self):
+        return hello_line()
+
+    def _on_hello(self, methods):
+        usable = [m for m in methods if m in METHODS]
+        self.method = usable[0] if usable else None
+        if not self.offer:
+            self._answer = hello_line(usable[:1])
+        L().debug('compression negotiated: %s'%self.method)
+
+    def received(self, data):
+        '''returns (plain data, answer to send or None).
+        The sender must set .enabled (see start_sending) after sending the answer.'''
+        plain = self.unpacker.feed(data)
+        if not self.offer and self.unpacker.looking and plain:
+            # the offer must come first. Plain client.
+            self.passthrough = True
+            plain += self.unpacker.take_buffer()
+        answer, self._answer = self._answer, None
+        if self.offer and self.method and not self.enabled:
+            self.enabled = True
+        return plain, answer
+
+    def start_sending(self):
+        '''server side: call after the answer was sent.'''
+        self.enabled = self.method is not None
+
+    def pack(self, data):
+        if not self.enabled:
+            return data
+        return self.packer.pack(data)
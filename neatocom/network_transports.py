@@ -1,11 +1,13 @@
 __all__ = ['UdpTransport', 'TcpServerTransport']
 
 import logging
+from collections import deque
 
 import socket as sk
 from socketserver import ThreadingTCPServer, BaseRequestHandler
-from threading import Thread, Event
-from .transports import Transport, MuxTransport
+from threading import Thread, Event, Condition
+from .transports import Transport, MuxTransport, ReceiveBuffer, Waker
+from .compression import Compression, CompressionError, FramePacker, PackedData
 
 L = lambda: logging.getLogger(__name__)
 
@@ -21,10 +23,14 @@ class UdpTransport(Transport):
         Transport.__init__(self)
         self.port = port
         self.socket = sk.socket(sk.AF_INET, sk.SOCK_DGRAM)
-        self.socket.settimeout(0.5)
         self.socket.setsockopt(sk.SOL_SOCKET, sk.SO_BROADCAST, 1)
         self.socket.setsockopt(sk.SOL_SOCKET, sk.SO_REUSEADDR, 1)
-        self.socket.setsockopt(sk.SOL_SOCKET, sk.IP_MULTICAST_LOOP, 1)
+        try:
+            self.socket.setsockopt(sk.SOL_SOCKET, sk.IP_MULTICAST_LOOP, 1)
+        except OSError:
+            # not supported on this platform.
+            pass
+        self._waker = Waker()
         try:
             self.socket.setsockopt(sk.SOL_SOCKET, sk.SO_REUSEPORT, 1)
         except AttributeError:
@@ -36,21 +42,24 @@ class UdpTransport(Transport):
         Transport.start(self)
         
     def stop(self):
+        self.running = False
+        self._waker.wake()
         Transport.stop(self)
         
     def run(self):
         self.running = True
         while self.running:
-            try:
-                data, addr = self.socket.recvfrom(2048)
-            except sk.timeout:
+            if not self._waker.wait(self.socket):
+                # woken up by stop()
                 continue
+            data, addr = self.socket.recvfrom(2048)
             host, port = addr
             # not using leftover data  here, since udp packets are
             # not guaranteed to arrive in order.
             L().debug('message from udp %s: %s'%(host, data))
             self.received(data=data, sender=host)
         self.socket.close()
+        self._waker.close()
     
     def send(self, data, receivers=None):
         L().debug('message to udp %r: %s'%(receivers, data))
@@ -75,21 +84,45 @@ class TcpServerTransport(MuxTransport):
     
     You can optionally pass an announcer (as returned by announcer_api.make_udp_announcer).
     It will be started/stopped together with the TcpServerTransport.
+
+    Sending never blocks: outgoing data is queued per connection and written
+    by the connection's writer thread. If more than max_queue_bytes are
+    pending for a connection, overflow_policy decides what happens:
+     - 'disconnect': the connection is closed (default).
+     - 'drop': the message is discarded for this connection.
+    .stats() returns the queue metrics of all connections.
+
+    Each connection reads up to recv_buffer_size bytes at once into a
+    reusable buffer.
+
+    With compression=True, clients offering compression get big frames
+    compressed (see neatocom.compression). A FramePacker can be given
+    instead of True. .compression_stats() returns the byte and time counters.
     
     Threads:
      - TcpServerTransport.run() blocks (use .start() for automatic extra Thread)
      - .run() starts a new thread for listening to connections
-     - each incoming connection will start another Thread.
+     - each incoming connection will start two more Threads (reader and writer).
     '''
-    def __init__(self, port, interface='', announcer=None):
+    def __init__(self, port, interface='', announcer=None, max_queue_bytes=16*1024*1024, overflow_policy='disconnect', recv_buffer_size=64*1024, compression=True):
+        if overflow_policy not in ('disconnect', 'drop'):
+            raise ValueError('Unknown overflow_policy %r'%overflow_policy)
+        if compression is True:
+            compression = FramePacker()
+        self.packer = compression or None
         self.addr = (interface, port)
         self.announcer = announcer
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow_policy = overflow_policy
+        self.recv_buffer_size = recv_buffer_size
         MuxTransport.__init__(self)
         
     def run(self):
         server = ThreadingTCPServer(self.addr, _TcpConnection, bind_and_activate=True)
         server.mux = self
-        Thread(target=server.serve_forever, name="TcpServerTransport_Listen").start()
+        listen_waker = Waker()
+        listen_thread = Thread(target=self._listen, args=(server, listen_waker), name="TcpServerTransport_Listen")
+        listen_thread.start()
         if self.announcer:
             self.announcer.transport.start()
         
@@ -98,16 +131,44 @@ class TcpServerTransport(MuxTransport):
         if self.announcer:
             self.announcer.transport.stop()
         
-        server.shutdown()
+        listen_waker.wake()
+        listen_thread.join()
+        listen_waker.close()
+        # also waits for the connection threads to finish.
+        server.server_close()
+        if self.packer:
+            L().info(self.packer.stats.summary())
+
+    def _listen(self, server, waker):
+        '''accept connections until woken up.'''
+        while waker.wait(server):
+            server.handle_request()
         
     def close(self, name):
         '''close the connection with the given sender/receiver name.
         '''
-        for transport in self.transports:
+        for transport in list(self.transports):
             if transport.name == name:
-                transport.transport_running.clear()
-                                    
-                                    
+                transport.stop()
+
+    def send(self, data, receivers=None):
+        packed = PackedData(data, self.packer) if self.packer else None
+        for transport, names in self._route(receivers):
+            transport.send(data, receivers=names, packed=packed)
+
+    def compression_stats(self):
+        '''returns the compression counters (see CompressionStats.snapshot), or None.'''
+        return self.packer.stats.snapshot() if self.packer else None
+
+    def stats(self):
+        '''returns {connection name: queue metrics}, see _TcpConnection.queue_stats().'''
+        return {
+            transport.name: transport.queue_stats()
+            for transport in list(self.transports)
+        }
+
+
+
 class _TcpConnection(BaseRequestHandler, Transport):
     '''Bridge between TcpServer (BaseRequestHandler) and Transport.
     
@@ -118,7 +179,17 @@ class _TcpConnection(BaseRequestHandler, Transport):
     The Transport also stops upon client-side close of connection.
     
     The _TcpConnection registers and unregisters itself with the TcpServerTransport.
+
+    .send() only queues the data; a separate writer thread sends it, so
+    that a slow client cannot block the sending thread. A broadcast thus
+    costs the sending thread one queue append per connection; the writers
+    send concurrently. A writer takes everything queued (up to max_iov
+    messages) and writes it with one vectored sendmsg() call. On close,
+    the writer gets flush_timeout seconds to send the remaining data.
     '''
+    flush_timeout = 5.0
+    # max. number of queued messages written at once
+    max_iov = 512
     
     # BaseRequestHandler overrides
     def __init__(self, request, client_address, server):
@@ -128,36 +199,141 @@ class _TcpConnection(BaseRequestHandler, Transport):
     def setup(self):
         self.name = '%s:%s'%self.client_address
         L().debug('TCP connect from %s'%self.name)
+        # messages are small and latency matters
+        self.request.setsockopt(sk.IPPROTO_TCP, sk.TCP_NODELAY, 1)
         
-        self.request.settimeout(0.5)
         self.transport_running = Event()
+        self._waker = Waker()
+        # outgoing queue
+        self._out_queue = deque()
+        self._out_bytes = 0
+        self._out_cond = Condition()
+        # queue metrics
+        self._max_out_bytes = 0
+        self._dropped = 0
+        packer = self.server.mux.packer
+        self.compression = Compression(packer) if packer else None
+        self._writer = Thread(target=self._write_loop, name='TcpWriter %s'%self.name)
         # add myself to the muxer, which will .start() me.
         self.server.mux.add_transport(self)
         
     def handle(self):
         self.transport_running.wait()
-        leftover = b''
+        chunk = bytearray(self.server.mux.recv_buffer_size)
+        chunk_view = memoryview(chunk)
+        buffer = ReceiveBuffer()
         while self.transport_running.is_set():
-            try:
-                data = self.request.recv(1024)
-            except sk.timeout:
+            if not self._waker.wait(self.request):
+                # woken up by stop()
                 continue
-            data = data.replace(b'\r\n', b'\n')
-            if data == b'':
+            try:
+                size = self.request.recv_into(chunk)
+            except OSError as e:
+                L().info('Receiving from %s failed: %s'%(self.name, e))
+                size = 0
+            if size == 0:
                 # Connection was closed.
                 self.stop()
                 break
-            L().debug('data from %s: %r'%(self.name, data))
-            leftover = self.received(sender=self.name, data=leftover+data)
+            data = chunk_view[:size]
+            if self.compression is not None:
+                try:
+                    data, answer = self.compression.received(data)
+                except CompressionError as e:
+                    L().warning('%s: %s, closing the connection'%(self.name, e))
+                    self.stop()
+                    break
+                if answer:
+                    self._enqueue(answer)
+                    self.compression.start_sending()
+                if self.compression.passthrough:
+                    self.compression = None
+            buffer.feed(data)
+            frame = buffer.pop_frame()
+            if not frame:
+                continue
+            L().debug('data from %s: %d bytes'%(self.name, len(frame)))
+            buffer.unget(self.received(sender=self.name, data=frame))
         
     def finish(self):
         L().debug('Closed TCP connection to %s'%self.name)
         # Getting here implies that this transport already stopped.
         self.server.mux.remove_transport(self, stop=False)
+        # let the writer flush the queue before the socket is closed.
+        self._wake_writer()
+        if self._writer.ident is not None:
+            self._writer.join(self.flush_timeout)
+            if self._writer.is_alive():
+                L().info('%s: could not send remaining data in time'%self.name)
+                # makes the blocked send fail.
+                self.request.shutdown(sk.SHUT_RDWR)
+                self._writer.join()
+        self._waker.close()
+
+    def _write_loop(self):
+        while True:
+            with self._out_cond:
+                while not self._out_queue and self.transport_running.is_set():
+                    self._out_cond.wait()
+                if not self._out_queue:
+                    # stopped and everything is sent.
+                    break
+                # everything queued meanwhile, e.g. several broadcasts.
+                buffers = []
+                while self._out_queue and len(buffers) < self.max_iov:
+                    buffers.append(self._out_queue.popleft())
+            size = sum(map(len, buffers))
+            try:
+                self._send_buffers(buffers)
+            except OSError as e:
+                L().info('Sending to %s failed: %s'%(self.name, e))
+                self._discard_queue()
+                self.stop()
+                break
+            with self._out_cond:
+                self._out_bytes -= size
+
+    def _send_buffers(self, buffers):
+        '''writes the buffers with as few syscalls as possible.'''
+        if len(buffers) == 1 or not hasattr(self.request, 'sendmsg'):
+            self.request.sendall(b''.join(buffers))
+            return
+        while buffers:
+            # vectored write, may send only a part
+            sent = self.request.sendmsg(buffers)
+            i = 0
+            while i < len(buffers) and sent >= len(buffers[i]):
+                sent -= len(buffers[i])
+                i += 1
+            buffers = buffers[i:]
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+
+    def _wake_writer(self):
+        with self._out_cond:
+            self._out_cond.notify()
+
+    def _discard_queue(self):
+        with self._out_cond:
+            self._out_queue.clear()
+            self._out_bytes = 0
+
+    def queue_stats(self):
+        '''queue metrics: pending messages and bytes, maximum of pending bytes
+        so far, number of messages dropped by overflow_policy.
+        '''
+        with self._out_cond:
+            return {
+                'queued_messages': len(self._out_queue),
+                'queued_bytes': self._out_bytes,
+                'max_queued_bytes': self._max_out_bytes,
+                'dropped_messages': self._dropped,
+            }
     
     # Transport overrides
     def start(self):
         self.transport_running.set()
+        self._writer.start()
         
     def run(self):
         # _TcpConnection starts "running" by itself (since the connection is already opened by definition).
@@ -165,11 +341,38 @@ class _TcpConnection(BaseRequestHandler, Transport):
         
     def stop(self):
         self.transport_running.clear()
+        self._waker.wake()
+        self._wake_writer()
         
-    def send(self, data, receivers=None):
+    def send(self, data, receivers=None, packed=None):
+        '''packed: PackedData of data, used if compression is enabled.'''
         if not self.transport_running.is_set():
-            raise Exception('Tried to send over non-running transport!')
+            # e.g. disconnected due to overflow, but not yet removed from the mux.
+            L().debug('%s is not running, not sending'%self.name)
+            return
         if receivers is not None and not self.name in receivers:
             return
-        # FIXME: do something on failure
-        self.request.sendall(data)
\ No newline at end of file
+        compression = self.compression
+        if compression is not None and compression.enabled:
+            data = packed.packed() if packed is not None else compression.pack(data)
+        self._enqueue(data)
+
+    def _enqueue(self, data):
+        mux = self.server.mux
+        with self._out_cond:
+            if self._out_bytes + len(data) > mux.max_queue_bytes:
+                self._dropped += 1
+                if mux.overflow_policy == 'drop':
+                    L().warning('%s does not keep up with sending, message dropped'%self.name)
+                    return
+                L().warning('%s does not keep up with sending, disconnecting'%self.name)
+                self._out_queue.clear()
+                self._out_bytes = 0
+                self.transport_running.clear()
+                self._waker.wake()
+                self._out_cond.notify()
+                return
+            self._out_queue.append(data)
+            self._out_bytes += len(data)
+            self._max_out_bytes = max(self._max_out_bytes, self._out_bytes)
+            self._out_cond.notify()
\ No newline at end of file
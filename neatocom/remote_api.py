@@ -3,9 +3,15 @@
 @outgoing, @incoming: decorators for RemoteAPI subclass methods.
 
 '''
+import time
+import inspect
 import logging
+import threading
+import contextlib
 L = lambda: logging.getLogger(__name__)
 
+from .api_stats import ApiStats
+
 __all__ = [
     'RemoteAPI',
     'incoming',
@@ -45,6 +51,10 @@ class RemoteAPI(object):
     Execution order: the method of remote_api is executed first,
     then the connected handlers in the order of registering.
     
+    Handlers are connected per instance: each instance gets its own copy
+    of the @incoming methods, so that several instances of one API class
+    (e.g. one per room of a server) do not call each other's handlers.
+    
     Threading:
         * outgoing messages are sent on the calling thread.
         * incoming messages are handled on the thread which
@@ -54,12 +64,53 @@ class RemoteAPI(object):
     For added neatness, you can .invert() the whole api,
     swapping incoming and outgoing methods.
     
+    Dispatch: each subclass gets a table of its remote methods at class
+    creation. Incoming calls are looked up there, and their arguments are
+    checked against the signature of the @incoming method when the call
+    fails. Calls with wrong arguments fail before any handler runs; they
+    are reported via message_error.
+    Exceptions raised by the handlers are logged with traceback; the
+    following messages are still processed.
+    
+    Batching: outgoing calls made within ``with api.batch():`` are sent when
+    the (outermost) batch ends. Consecutive calls to the same receivers
+    become one frame, i.e. one Transport.send(). Batches are per thread.
+    
+    Instrumentation: after .enable_stats(), call counts, bytes and
+    decode / handler / encode / send times are recorded per method.
+    Retrieve them with .stats(). See ApiStats.
+    
     '''
+    # ApiStats instance if stats are enabled
+    _stats = None
+    # threading.local, created by the first batch()
+    _batch_local = None
+    # name -> function, for all @incoming and @outgoing methods of the class
+    _remote_methods = {}
+    # name -> (function, required argument names, allowed argument names or None),
+    # for the @incoming methods (per instance after invert())
+    _incoming = {}
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        methods = {}
+        for klass in reversed(cls.__mro__):
+            for name, field in vars(klass).items():
+                if hasattr(field, '_remote_api_incoming') or hasattr(field, '_remote_api_outgoing'):
+                    methods[name] = field
+                else:
+                    # overridden by something else
+                    methods.pop(name, None)
+        cls._remote_methods = methods
+        cls._incoming = _incoming_table(methods)
+    
     def __init__(self, codec=None, transport=None, invert=False):
         self.codec = codec
         self.transport = transport
         if invert:
             self.invert()
+        else:
+            self._own_incoming()
         
     @property
     def transport(self):
@@ -70,6 +121,16 @@ class RemoteAPI(object):
         if self._transport:
             self._transport.set_api(self)
             
+    def _own_incoming(self):
+        '''replaces the @incoming methods of the class by fresh copies
+        for this instance, with their own list of handlers.'''
+        table = {}
+        for name, (fn, required, names) in self._incoming.items():
+            fn = incoming(fn._unbound_method)
+            setattr(self, name, fn.__get__(self))
+            table[name] = (fn, required, names)
+        self._incoming = table
+        
     def invert(self):
         '''Swaps @incoming and @outgoing property
         on all methods if this INSTANCE.
@@ -78,30 +139,147 @@ class RemoteAPI(object):
         
         Do this before connecting any handlers to incoming calls.
         '''
-        for attr in dir(self):
-            field = getattr(self, attr)
-            if hasattr(field, '_remote_api_incoming') or hasattr(field, '_remote_api_outgoing'):
-                # The decorators add a "method" .inverted() to the field,
-                # which will yield the inverse-decorated field.
-                setattr(self, attr, field.inverted().__get__(self))
+        methods = {}
+        for name in self._remote_methods:
+            # The decorators add a "method" .inverted() to the function,
+            # which will yield the inverse-decorated function.
+            methods[name] = getattr(self, name).__func__.inverted()
+            setattr(self, name, methods[name].__get__(self))
+        self._incoming = _incoming_table(methods)
         
             
+    @contextlib.contextmanager
+    def batch(self):
+        '''context manager collecting outgoing calls, see class docstring.'''
+        if self._batch_local is None:
+            self.__dict__.setdefault('_batch_local', threading.local())
+        local = self._batch_local
+        outermost = getattr(local, 'frames', None) is None
+        if outermost:
+            # list of (receivers, [encoded messages])
+            local.frames = []
+        try:
+            yield
+        finally:
+            if outermost:
+                frames, local.frames = local.frames, None
+                self._flush(frames)
+                
+    def _flush(self, frames):
+        for receivers, messages in frames:
+            t0 = time.perf_counter()
+            self.transport.send(b''.join(messages), receivers=receivers)
+            if self._stats is not None:
+                self._stats.outgoing('(batch)', 0, 0., time.perf_counter() - t0)
+    
+    def _send(self, method, kwargs, receivers):
+        '''encodes and sends (or batches) an outgoing call.'''
+        frames = getattr(self._batch_local, 'frames', None)
+        t0 = time.perf_counter()
+        data = self.codec.encode(method, kwargs=kwargs)
+        t1 = time.perf_counter()
+        if frames is None:
+            self.transport.send(data, receivers=receivers)
+            send_s = time.perf_counter() - t1
+        else:
+            if frames and frames[-1][0] == receivers:
+                frames[-1][1].append(data)
+            else:
+                frames.append((receivers, [data]))
+            send_s = 0.
+        if self._stats is not None:
+            self._stats.outgoing(method, len(data), t1 - t0, send_s)
+    
+    def enable_stats(self, log_interval=None):
+        '''starts recording message statistics.
+        If log_interval is given, a summary is logged every log_interval seconds.
+        '''
+        self._stats = ApiStats(log_interval=log_interval)
+        
+    def disable_stats(self):
+        self._stats = None
+        
+    def stats(self):
+        '''returns {method: {field: value}} (see ApiStats),
+        or None if stats are not enabled.'''
+        if self._stats is None:
+            return None
+        return self._stats.snapshot()
+            
     def handle_received(self, sender, data):
+        if self._stats is not None:
+            return self._handle_received_with_stats(sender, data)
         messages, remainder = self.codec.decode(data)
+        incoming = self._incoming
         for message in messages:
-            if isinstance(message, Exception):
-                self.message_error(message)
+            # fast path of _dispatch
+            try:
+                fn, required, names = incoming[message.method]
+            except (KeyError, AttributeError):
+                self._dispatch(sender, message)
                 continue
             try:
-                method = getattr(self, message.method)
-            except AttributeError:
-                self.message_error(AttributeError("Incoming call of %s not defined on the api"%message.method))
+                fn(self, sender, **message.kwargs)
+            except Exception:
+                # The arguments are checked only now. A call with wrong
+                # arguments fails before the method body runs.
+                self._call_failed(message, required, names)
+        return remainder
+    
+    def _handle_received_with_stats(self, sender, data):
+        # All codecs terminate messages with a newline. Decoding line by
+        # line attributes bytes and decode time to single messages.
+        stats = self._stats
+        end = data.rfind(b'\n') + 1
+        remainder = [data[end:]]
+        for line in data[:end].split(b'\n')[:-1]:
+            if not line:
                 continue
-            if not hasattr(method, "_remote_api_incoming"):
+            t0 = time.perf_counter()
+            messages, rest = self.codec.decode(line + b'\n')
+            decode_s = time.perf_counter() - t0
+            if rest:
+                remainder.insert(-1, rest)
+            for message in messages:
+                t0 = time.perf_counter()
+                self._dispatch(sender, message)
+                handler_s = time.perf_counter() - t0
+                stats.incoming(
+                    getattr(message, 'method', '<error>'),
+                    (len(line) + 1) // len(messages),
+                    decode_s / len(messages),
+                    handler_s
+                )
+        return b''.join(remainder)
+    
+    def _dispatch(self, sender, message):
+        if isinstance(message, Exception):
+            self.message_error(message)
+            return
+        try:
+            fn, required, names = self._incoming[message.method]
+        except KeyError:
+            if message.method in self._remote_methods:
                 self.message_error(AttributeError("Incoming call of %s not marked as @incoming on the api"%message.method))
-                continue
-            method(sender, **message.kwargs)
-        return remainder
+            else:
+                self.message_error(AttributeError("Incoming call of %s not defined on the api"%message.method))
+            return
+        error = _arguments_error(message.kwargs, required, names)
+        if error:
+            self.message_error(TypeError('Incoming call of %s %s'%(message.method, error)))
+            return
+        try:
+            fn(self, sender, **message.kwargs)
+        except Exception:
+            L().error('Error while handling incoming call of %s'%message.method, exc_info=True)
+    
+    def _call_failed(self, message, required, names):
+        '''called from the except clause of a failed incoming call.'''
+        error = _arguments_error(message.kwargs, required, names)
+        if error:
+            self.message_error(TypeError('Incoming call of %s %s'%(message.method, error)))
+        else:
+            L().error('Error while handling incoming call of %s'%message.method, exc_info=True)
     
     def message_error(self, exception):
         L().warning(exception)
@@ -111,26 +289,49 @@ class RemoteAPI(object):
         
         If no results are returned, all incoming messages are connected.
         '''
-        result = []
-        for attr in dir(self):
-            field = getattr(self, attr)
-            if hasattr(field, '_remote_api_incoming') and not field._listeners:
-                yield attr
+        for name, (fn, required, names) in self._incoming.items():
+            if not fn._listeners:
+                yield name
                 
 
 
+def _incoming_table(methods):
+    '''returns the dispatch table for the @incoming functions among methods.
+    Argument names are taken from the signature of the decorated method
+    (self, sender, ...).
+    '''
+    kinds = (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY)
+    table = {}
+    for name, fn in methods.items():
+        if not hasattr(fn, '_remote_api_incoming'):
+            continue
+        params = list(inspect.signature(fn._unbound_method).parameters.values())[2:]
+        required = frozenset(p.name for p in params if p.kind in kinds and p.default is p.empty)
+        names = frozenset(p.name for p in params if p.kind in kinds)
+        if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in params):
+            names = None
+        table[name] = (fn, required, names)
+    return table
+
+
+def _arguments_error(kwargs, required, names):
+    '''returns a description of what is wrong with kwargs, or None.'''
+    keys = kwargs.keys()
+    if not required <= keys:
+        return 'is missing arguments %s'%', '.join(sorted(required - keys))
+    if names is not None and not keys <= names:
+        return 'has unexpected arguments %s'%', '.join(sorted(keys - names))
+    return None
+
+
 def incoming(unbound_method):
     def fn(self, sender, **kwargs):
-        try:
-            unbound_method(self, sender, **kwargs)
-        except TypeError:
-            # signature is wrong
-            L().warning('incoming call with wrong signature, ignored')
-            return
+        unbound_method(self, sender, **kwargs)
         for listener in fn._listeners:
             listener(sender, **kwargs)
     # Presence of this attribute indicates that this method is a valid incoming target
     fn._remote_api_incoming = None
+    fn._unbound_method = unbound_method
     fn._listeners = []
     fn.connect = lambda listener: fn._listeners.append(listener)
     fn.disconnect = lambda listener: fn._listeners.remove(listener)
@@ -144,11 +345,15 @@ def outgoing(unbound_method):
     '''generates a dispatcher call under name of the method.
     method's body will be called before sending.
     '''
+    name = unbound_method.__name__
     def fn(self, receivers=None, **kwargs):
         # this ensures that all kwargs are valid
         unbound_method(self, receivers, **kwargs)
-        data = self.codec.encode(unbound_method.__name__, kwargs=kwargs)
-        self.transport.send(data, receivers=receivers)
+        if self._stats is None and self._batch_local is None:
+            data = self.codec.encode(name, kwargs=kwargs)
+            self.transport.send(data, receivers=receivers)
+            return
+        self._send(name, kwargs, receivers)
     fn._remote_api_outgoing = None
     fn.__name__ = unbound_method.__name__
     fn.__doc__ = unbound_method.__doc__
@@ -5,15 +5,21 @@ For details, see doc of class Transport.
 
 Classes defined here:
  * Transport: abstract base
+ * ReceiveBuffer: accumulates received bytes and cuts off complete frames.
+ * Waker: self-pipe to wake up threads waiting for a socket.
  * StdioTransport: reads from stdin, writes to stdout.
  * MuxTransport: a transport that multiplexes several sub-transports.
  * TcpServerTransport: a transport that accepts tcp connections and muxes 
     them into one transport. Actually a forward to neatocom.network_transports.
 
+For servers with many connections, see neatocom.asyncio_transports, which
+runs all channels on one asyncio event loop instead of a thread each.
 '''
 
 __all__ = [
     'Transport',
+    'ReceiveBuffer',
+    'Waker',
     'StdioTransport',
     'MuxTransport',
     'TcpServerTransport',
@@ -23,7 +29,8 @@ from collections import namedtuple
 import logging
 import queue
 import sys
-import select
+import socket
+import selectors
 import threading
 L = lambda: logging.getLogger(__name__)
 
@@ -93,10 +100,138 @@ class Transport(object):
             raise AttributeError("Transport received a message but has no API set.")
         return self._api.handle_received(sender, data)
 
+    def forget(self, sender):
+        '''to be called when a multichannel transport lost a sender
+        (e.g. closed connection). Lets a MuxTransport drop its route.'''
+        forget = getattr(self._api, 'forget', None)
+        if forget:
+            forget(sender)
+
+
+class ReceiveBuffer(object):
+    '''Accumulates received bytes of one channel and cuts off complete frames.
+
+    All neatocom codecs terminate each message with a newline, so everything
+    up to the last newline can be decoded in one go. Incomplete data (e.g. the
+    beginning of a multi-megabyte message) stays in the buffer; it is neither
+    copied again nor parsed by the codec until the message is complete.
+
+    "\\r\\n" line ends (e.g. from telnet) are converted to "\\n".
+
+    Usage:
+
+    >>> buffer.feed(data)
+    >>> frame = buffer.pop_frame()
+    >>> if frame:
+    ...     buffer.unget(transport.received(sender, frame))
+    '''
+    def __init__(self):
+        self._buffer = bytearray()
+        # the first _scanned bytes are known to contain no newline
+        self._scanned = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        '''append received data (any bytes-like object, e.g. a memoryview
+        into a reusable receive buffer).'''
+        self._buffer += data
+
+    def pop_frame(self):
+        '''removes and returns all complete messages as bytes,
+        b'' if there is no complete message yet.'''
+        end = self._buffer.rfind(b'\n', self._scanned) + 1
+        if not end:
+            self._scanned = len(self._buffer)
+            return b''
+        with memoryview(self._buffer) as view:
+            frame = bytes(view[:end])
+        # deleting from the front of a bytearray does not move the rest.
+        del self._buffer[:end]
+        self._scanned = len(self._buffer)
+        if b'\r' in frame:
+            frame = frame.replace(b'\r\n', b'\n')
+        return frame
+
+    def unget(self, leftover):
+        '''put back data which the codec could not decode yet.'''
+        if leftover:
+            self._buffer[:0] = leftover
+            self._scanned = 0
+
+
+# poll has no limit on the file descriptor numbers, unlike select(),
+# which fails above FD_SETSIZE (1024), i.e. with some hundred connections.
+# (Windows has no poll; its select() limits the count, not the numbers.)
+_Selector = getattr(selectors, 'PollSelector', selectors.SelectSelector)
+
+
+class Waker(object):
+    '''Self-pipe for waking up a thread which waits for a socket.
+
+    .wait(fileobj) blocks until fileobj is readable or .wake() was
+    called. This way threads can block until there is data or a stop
+    request, instead of polling with a timeout. Each Waker serves one thread.
+    '''
+    def __init__(self):
+        # a socket pair can be waited for on all platforms.
+        self._rsock, self._wsock = socket.socketpair()
+        self._rsock.setblocking(False)
+        self._wsock.setblocking(False)
+        self._selector = _Selector()
+        self._selector.register(self._rsock, selectors.EVENT_READ)
+        self._watched = None
+
+    def wait(self, fileobj=None):
+        '''blocks until fileobj is readable (returns True) or until woken
+        up (returns False; the wakeups are consumed then).'''
+        if fileobj is not self._watched:
+            if self._watched is not None:
+                self._selector.unregister(self._watched)
+            if fileobj is not None:
+                self._selector.register(fileobj, selectors.EVENT_READ)
+            self._watched = fileobj
+        events = self._selector.select()
+        if fileobj is not None and any(key.fileobj is fileobj for key, mask in events):
+            return True
+        self.clear()
+        return False
+
+    def fileno(self):
+        return self._rsock.fileno()
+
+    def wake(self):
+        try:
+            self._wsock.send(b'\0')
+        except OSError:
+            # buffer full (i.e. already woken) or closed
+            pass
+
+    def clear(self):
+        '''consume pending wakeups.'''
+        try:
+            while self._rsock.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self._selector.close()
+        self._rsock.close()
+        self._wsock.close()
+
 
 class StdioTransport(Transport):
+    def __init__(self):
+        Transport.__init__(self)
+        self._waker = Waker()
+        self._stdin_open = True
+
     def stop(self):
         L().debug('StdioTransport.stop() called')
+        self.running = False
+        self._waker.wake()
         Transport.stop(self)
 
     def send(self, data, receivers=None):
@@ -121,17 +256,40 @@ class StdioTransport(Transport):
             leftover = self.received(sender='stdio', data=leftover + data)
         L().debug('StdioTransport has finished')
             
-    def _input(self, timeout=0.1):
-        '''Input with 0.1s timeout. Return None on timeout.'''
-        i, o, e = select.select([sys.stdin.buffer], [], [], timeout)
-        if i:
-            return sys.stdin.buffer.read1(65536)
-        else:
+    def _input(self):
+        '''Blocks until there is input or stop() was called. Returns None in the latter case.'''
+        if not self._waker.wait(sys.stdin.buffer if self._stdin_open else None):
+            return None
+        data = sys.stdin.buffer.read1(65536)
+        if not data:
+            L().info('stdin was closed')
+            self._stdin_open = False
             return None
+        return data
 
 
 InData = namedtuple('InData', 'sender data')
 
+
+class _Route(object):
+    '''stands in for the api of a muxed transport; notes the transport
+    each sender is reached by.'''
+    __slots__ = ['mux', 'transport']
+    
+    def __init__(self, mux, transport):
+        self.mux = mux
+        self.transport = transport
+        
+    def handle_received(self, sender, data):
+        if self.mux.routes.get(sender) is not self.transport:
+            self.mux.routes[sender] = self.transport
+        return self.mux.handle_received(sender, data)
+    
+    def forget(self, sender):
+        if self.mux.routes.get(sender) is self.transport:
+            self.mux.forget(sender)
+    
+
 class MuxTransport(Transport):
     '''A transport that muxes several transports.
     
@@ -146,19 +304,50 @@ class MuxTransport(Transport):
     Removing a transport stop()s it by default.
     
     Running/Stopping the MuxTransport also runs/stops all muxed transports.
+    
+    Routing: the mux remembers through which transport each sender was
+    heard (.routes). Messages to known receivers go only to their
+    transports, each called once with the list of its receivers. Receivers
+    not heard from yet are offered to all transports, which decide for
+    themselves. Broadcasts (receivers=None) go to all transports.
     '''
     
     def __init__(self):
+        self._api = None
         self.in_queue = queue.Queue()
         self.transports = []
         self.running = False
         # sender --> leftover bytes
         self.leftovers = {}
+        # sender --> transport
+        self.routes = {}
         
     def send(self, data, receivers=None):
-        # Let everyone decide for himself.
-        for transport in self.transports:
-            transport.send(data, receivers=receivers)
+        for transport, names in self._route(receivers):
+            transport.send(data, receivers=names)
+            
+    def _route(self, receivers):
+        '''returns [(transport, receivers)] to pass the message to.'''
+        if receivers is None:
+            return [(transport, None) for transport in list(self.transports)]
+        if isinstance(receivers, str):
+            receivers = [receivers]
+        routes = self.routes
+        if len(receivers) == 1 and receivers[0] in routes:
+            # unicast
+            return [(routes[receivers[0]], receivers)]
+        targets = {}
+        unknown = []
+        for name in receivers:
+            transport = routes.get(name)
+            if transport is None:
+                unknown.append(name)
+            else:
+                targets.setdefault(transport, []).append(name)
+        result = list(targets.items())
+        if unknown:
+            result += [(transport, unknown) for transport in list(self.transports)]
+        return result
         
     def handle_received(self, sender, data):
         '''handles INCOMING data from any of the muxed transports.
@@ -172,7 +361,7 @@ class MuxTransport(Transport):
     def add_transport(self, transport, start=True):
         '''add and start the transport (if running).'''
         self.transports.append(transport)
-        transport.set_api(self)
+        transport.set_api(_Route(self, transport))
         if start and self.running:
             transport.start()
         return self
@@ -181,15 +370,27 @@ class MuxTransport(Transport):
         '''remove and stop the transport.'''
         self.transports.remove(transport)
         transport.set_api(None)
+        for name, route in list(self.routes.items()):
+            if route is transport:
+                self.forget(name)
         if stop:
             transport.stop()
         return self
         
+    def forget(self, sender):
+        '''drops route and leftover data of sender, also in outer muxes.'''
+        self.routes.pop(sender, None)
+        self.leftovers.pop(sender, None)
+        Transport.forget(self, sender)
+        
     __iadd__ = add_transport
     __isub__ = remove_transport
     
     def stop(self):
         L().debug('MuxTransport.stop() called')
+        self.running = False
+        # wake up run()
+        self.in_queue.put(None)
         Transport.stop(self)
     
     def run(self):
@@ -199,22 +400,24 @@ class MuxTransport(Transport):
             transport.start()
         L().debug('Thread overview: %s'%([t.name for t in threading.enumerate()],))
         while self.running:
-            try:
-                indata = self.in_queue.get(timeout=0.5)
-            except queue.Empty:
-                # timeout passed, check self.running and try again.
+            indata = self.in_queue.get()
+            if indata is None:
+                # woken up by stop()
                 continue
             L().debug('MuxTransport: received %r'%(indata,))
-            leftover = self.leftovers.get(indata.sender, b'')
+            leftover = self.leftovers.pop(indata.sender, b'')
             leftover = self.received(indata.sender, leftover + indata.data)
-            self.leftovers[indata.sender] = leftover
+            # no entry for b'', it would outlive a forget() of the sender
+            if leftover:
+                self.leftovers[indata.sender] = leftover
             
         # stop all transports
-        for transport in self.transports:
+        # (copy, since transports may remove themselves meanwhile)
+        for transport in list(self.transports):
             transport.stop()
         L().debug('MuxTransport has finished')
             
 
-def TcpServerTransport(port, interface='', announcer=None):
+def TcpServerTransport(port, interface='', announcer=None, **kwargs):
     from .network_transports import TcpServerTransport
-    return TcpServerTransport(port, interface, announcer)
+    return TcpServerTransport(port, interface, announcer, **kwargs)
@@ -3,10 +3,10 @@ import logging
 L = lambda: logging.getLogger(__name__)
 
 from neatocom.codecs import TerseCodec
-from neatocom.transports import StdioTransport, MuxTransport, TcpServerTransport
 from neatocom.announcer_api import make_udp_announcer
 
 from .puzzle_service import PuzzleService
+from .puzzle_board import PuzzleBoard
 
 if '--console' in sys.argv:
     logging.basicConfig(level='INFO')
@@ -19,27 +19,96 @@ else:
 L().info('\n### New run of Puzzleboard ###')
 
 L().info('initializing Transport')
+if '--threaded' in sys.argv:
+    # one thread per connection
+    from neatocom.transports import StdioTransport, MuxTransport, TcpServerTransport
+    use_asyncio = False
+else:
+    from neatocom.asyncio_transports import (
+        AsyncioStdioTransport as StdioTransport,
+        AsyncioMuxTransport as MuxTransport,
+        AsyncioTcpServerTransport as TcpServerTransport,
+    )
+    use_asyncio = True
+port = 8888
+for arg in sys.argv:
+    if arg.startswith('--port='):
+        port = int(arg[len('--port='):])
 transport = MuxTransport()
 transport += StdioTransport()
-# FIXME hardcoded port
 server = TcpServerTransport(
-    port=8888,
-    announcer=make_udp_announcer(8889, description='type:puzzleboard version:0.1 servername:Unknown_Server')
+    port=port,
+    announcer=make_udp_announcer(
+        8889,
+        description='type:puzzleboard version:0.1 servername:Unknown_Server',
+        use_asyncio=use_asyncio
+    )
 )
 transport += server
 
-L().info('initializing PuzzleService')
+board_class = PuzzleBoard
+
+stats_interval = None
+rooms_folder = None
+default_room = None
+workers = None
+for arg in sys.argv:
+    if arg.startswith('--stats='):
+        # log message statistics every N seconds
+        stats_interval = float(arg[len('--stats='):])
+    if arg.startswith('--rooms='):
+        # one room per puzzle folder in the given folder
+        rooms_folder = arg[len('--rooms='):]
+    if arg.startswith('--default-room='):
+        default_room = arg[len('--default-room='):]
+    if arg.startswith('--workers='):
+        # rooms are spread over this many processes (0: one per CPU)
+        workers = int(arg[len('--workers='):])
+
 try:
-    service = PuzzleService(
-        codec=TerseCodec(),
-        transport=transport,
-        announcer=server.announcer,
-        close_handler=server.close,
-        quit_handler=transport.stop
-    )
+    if rooms_folder and workers is not None:
+        from .sharding import ShardServer
+        L().info('initializing ShardServer on %s'%rooms_folder)
+        service = ShardServer(
+            rooms_folder,
+            codec=TerseCodec(),
+            transport=transport,
+            close_handler=server.close,
+            quit_handler=transport.stop,
+            workers=workers,
+            board_class=board_class,
+            default_room=default_room,
+            log_interval=stats_interval,
+        )
+    elif rooms_folder:
+        from .rooms import RoomServer
+        L().info('initializing RoomServer on %s'%rooms_folder)
+        service = RoomServer(
+            rooms_folder,
+            codec=TerseCodec(),
+            transport=transport,
+            close_handler=server.close,
+            quit_handler=transport.stop,
+            board_class=board_class,
+            default_room=default_room,
+            log_interval=stats_interval,
+        )
+    else:
+        L().info('initializing PuzzleService')
+        service = PuzzleService(
+            codec=TerseCodec(),
+            transport=transport,
+            announcer=server.announcer,
+            close_handler=server.close,
+            quit_handler=transport.stop,
+            board_class=board_class
+        )
+        if stats_interval:
+            service.api.enable_stats(log_interval=stats_interval)
 
     L().info('start running')
     transport.run()
+    service.close()
     
 except Exception as e:
     L().critical('Fatal Exception occured', exc_info=True)
@@ -1,10 +1,68 @@
 from math import sin, cos, pi
 import json
 
+
+def clusters_as_columns(clusters):
+    '''compact columnar form of the cluster state:
+    {ids, x, y, rotation, sizes: [one entry per cluster], pieces: [all piece ids]}
+    pieces holds the piece ids of all clusters one after another,
+    sizes tells how many of them belong to each cluster.
+    '''
+    ids, xs, ys, rotations, sizes, pieces = [], [], [], [], [], []
+    for cluster in clusters:
+        ids.append(cluster.id)
+        xs.append(cluster.x)
+        ys.append(cluster.y)
+        rotations.append(cluster.rotation)
+        sizes.append(len(cluster.pieces))
+        pieces.extend(piece.id for piece in cluster.pieces)
+    return {
+        'ids': ids,
+        'x': xs,
+        'y': ys,
+        'rotation': rotations,
+        'sizes': sizes,
+        'pieces': pieces,
+    }
+
+def iter_cluster_columns(struct):
+    '''yields a dict {id, x, y, rotation, pieces} for each cluster
+    in the columnar form (see clusters_as_columns).
+    The old form {clusters: [{x, y, rotation, pieces}, ...]} is accepted as well.
+    '''
+    if 'clusters' in struct:
+        for cluster in struct['clusters']:
+            cluster = dict(cluster)
+            cluster.setdefault('id', min(cluster['pieces']))
+            yield cluster
+        return
+    pieces = struct['pieces']
+    start = 0
+    for id, x, y, rotation, size in zip(
+        struct['ids'], struct['x'], struct['y'], struct['rotation'], struct['sizes']
+    ):
+        yield {
+            'id': id,
+            'x': x,
+            'y': y,
+            'rotation': rotation,
+            'pieces': pieces[start:start+size],
+        }
+        start += size
+
+
 class Cluster(object):
+    # cached id, see PuzzleBoard.join
+    _id = None
+    # position in PuzzleBoard.clusters
+    _index = None
+    
     @property
     def id(o):
-        return min(piece.id for piece in o.pieces)
+        '''the lowest piece id'''
+        if o._id is None:
+            o._id = min(piece.id for piece in o.pieces)
+        return o._id
     
     @property
     def position(o):
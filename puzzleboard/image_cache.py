@@ -0,0 +1,46 @@
+'''ImageCache: piece image files kept in memory, shared by several PuzzleServices.'''
+import threading
+from collections import OrderedDict
+
+__all__ = [
+    'ImageCache',
+]
+
+
+class ImageCache(object):
+    '''least recently used file contents, up to max_bytes in total.
+    Thread safe. Files are identified by path; they must not change
+    while cached.'''
+    def __init__(self, max_bytes=256 << 20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        '''returns the content of the file at path.'''
+        with self._lock:
+            data = self._files.get(path)
+            if data is not None:
+                self._files.move_to_end(path)
+                self.hits += 1
+                return data
+            self.misses += 1
+        # read without holding the lock
+        with open(path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            if path not in self._files and len(data) <= self.max_bytes:
+                self._files[path] = data
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    old_path, old = self._files.popitem(last=False)
+                    self.size -= len(old)
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self.size = 0
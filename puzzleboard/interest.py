@@ -0,0 +1,110 @@
+'''InterestManager: sends position updates to the clients that can see them.
+
+Clients report their viewport (the visible part of the board, in puzzle
+coordinates) with PuzzleAPI.viewport. Clients that never did get all
+updates, as before.
+
+A moved cluster is sent to a client if its bounding box (as drawn, see
+PuzzleBoard.cluster_box) intersects the client's viewport, enlarged by
+`margin` times its size on each side, before or after the move.
+Otherwise the client misses the update and the cluster becomes stale for
+it. Since its known position was out of view too, nothing visible is
+wrong. The mover always gets its own updates.
+
+(The cluster origin (x, y) is no use for this: it is the position of the
+image origin and can be far away from the pieces.)
+
+Stale clusters are resent (absolute position):
+ * when they come into view, with the next update or viewport report;
+ * instead of group_moved, whose relative move needs the current
+   position.
+
+Grabbed, dropped, joined (with the survivor's position) and the bulk
+messages always go to everybody.
+'''
+
+__all__ = [
+    'InterestManager',
+]
+
+
+class InterestManager(object):
+    def __init__(self, margin=0.25):
+        self.margin = margin
+        # client -> (x0, y0, x1, y1), enlarged by margin
+        self.viewports = {}
+        # client -> ids of the clusters whose last position it did not get
+        self.stale = {}
+
+    @property
+    def active(self):
+        '''False if no client reported a viewport, i.e. all updates go to all.'''
+        return bool(self.viewports)
+
+    def set_viewport(self, client, x, y, width, height, in_rect):
+        '''stores the viewport of client. in_rect(x0, y0, x1, y1) returns
+        the ids of the clusters whose box intersects the rectangle.
+        Returns the ids of the stale clusters which are now in view; the
+        client must get their positions.
+        '''
+        mx, my = abs(width) * self.margin, abs(height) * self.margin
+        x0, y0 = min(x, x + width), min(y, y + height)
+        x1, y1 = max(x, x + width), max(y, y + height)
+        rect = self.viewports[client] = (x0 - mx, y0 - my, x1 + mx, y1 + my)
+        stale = self.stale.setdefault(client, set())
+        if not stale:
+            return []
+        resync = stale.intersection(in_rect(*rect))
+        stale -= resync
+        return list(resync)
+
+    def forget(self, client):
+        self.viewports.pop(client, None)
+        self.stale.pop(client, None)
+
+    def reset(self):
+        '''all clients got all positions (e.g. new puzzle or clusters).'''
+        for stale in self.stale.values():
+            stale.clear()
+
+    def joined(self, cluster, joined_clusters):
+        '''everybody got the position of cluster; joined_clusters are gone.'''
+        for stale in self.stale.values():
+            stale.discard(cluster)
+            stale.difference_update(joined_clusters)
+
+    def route(self, clients, sender, moves):
+        '''decides who gets which updates.
+
+        moves: {cluster id: (old box, new box)}, boxes as (x0, y0, x1, y1).
+        Returns a list of (receivers, ids, resync): receivers get the
+        updates for ids; resync is the subset of ids which was stale for
+        them. Clients with the same updates are grouped.
+        '''
+        all_ids = frozenset(moves)
+        groups = {}
+        for client in clients:
+            rect = self.viewports.get(client)
+            if rect is None:
+                key = (all_ids, frozenset())
+            else:
+                if client == sender:
+                    ids = all_ids
+                else:
+                    ids = frozenset(
+                        cid for cid, (old, new) in moves.items()
+                        if _intersects(rect, old) or _intersects(rect, new)
+                    )
+                stale = self.stale[client]
+                resync = ids & stale
+                stale -= ids
+                stale |= all_ids - ids
+                key = (ids, frozenset(resync))
+            if key[0]:
+                groups.setdefault(key, []).append(client)
+        return [(receivers, ids, resync) for (ids, resync), receivers in groups.items()]
+
+
+def _intersects(rect, box):
+    x0, y0, x1, y1 = rect
+    return box[0] <= x1 and x0 <= box[2] and box[1] <= y1 and y0 <= box[3]
@@ -0,0 +1,188 @@
+'''Persistence of the cluster state of a PuzzleBoard.
+
+The state lives in two files in the puzzle folder:
+
+ * ``clusters.json`` - a full snapshot, written atomically (tmp file + rename).
+ * ``clusters.journal`` - append-only log of the changes since the snapshot,
+   one JSON object per line. The first line is a header naming the
+   snapshot generation the journal belongs to.
+
+Saving appends only what changed since the last save. When the journal grows
+beyond ``compact_after`` records, or after big changes like a puzzle reset,
+a new snapshot is written instead and the journal starts over.
+
+Saving is split into ``collect`` (cheap, needs a consistent board) and
+``write`` (file I/O, can run in another thread).
+'''
+
+import os
+import json
+import logging
+
+L = logging.getLogger(__name__)
+
+__all__ = ['StateJournal']
+
+SNAPSHOT_FILE = 'clusters.json'
+JOURNAL_FILE = 'clusters.journal'
+
+
+def _write_atomic(path, data):
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+
+
+class StateJournal(object):
+    '''Records cluster changes of a board and persists them.
+
+    The board reports its changes via ``moved``, ``joined`` and ``invalidate``.
+    '''
+    def __init__(o, compact_after=1000):
+        o.compact_after = compact_after
+        o.generation = 0
+        # number of records in the journal file
+        o.journal_length = 0
+        # python id -> cluster, for clusters whose position changed
+        o._moved = {}
+        # list of cluster id lists which were joined, in order
+        o._joins = []
+        o._snapshot_needed = True
+
+    # ---- recording ----
+
+    def moved(o, clusters):
+        for cluster in clusters:
+            o._moved[id(cluster)] = cluster
+
+    def joined(o, cluster_ids, to_cluster):
+        '''cluster_ids: ids of all clusters (including to_cluster) before the join.'''
+        o._joins.append(sorted(cluster_ids))
+        # the position of to_cluster changes as well
+        o._moved[id(to_cluster)] = to_cluster
+
+    def invalidate(o):
+        '''the next save writes a full snapshot.'''
+        o._snapshot_needed = True
+        o._moved.clear()
+        o._joins = []
+
+    @property
+    def dirty(o):
+        return bool(o._snapshot_needed or o._moved or o._joins)
+
+    # ---- saving ----
+
+    def collect(o, board):
+        '''takes the pending changes of board and returns a batch for write().
+        Returns None if there is nothing to save.
+        '''
+        if not o.dirty:
+            return None
+        clusters = set(map(id, board.clusters))
+        records = [{'join': ids} for ids in o._joins]
+        moves = {
+            str(cluster.id): [cluster.x, cluster.y, cluster.rotation]
+            for key, cluster in o._moved.items()
+            if key in clusters
+        }
+        if moves:
+            records.append({'move': moves})
+        o._moved.clear()
+        o._joins = []
+
+        if o._snapshot_needed or o.journal_length + len(records) > o.compact_after:
+            o._snapshot_needed = False
+            o.generation += 1
+            o.journal_length = 0
+            snapshot = board.clusters_as_jsonstruct()
+            snapshot['generation'] = o.generation
+            return {'snapshot': snapshot, 'generation': o.generation}
+        o.journal_length += len(records)
+        return {'records': records}
+
+    def write(o, folder, batch):
+        '''writes a batch obtained from collect() to folder.'''
+        if batch is None:
+            return
+        journalfile = os.path.join(folder, JOURNAL_FILE)
+        if 'snapshot' in batch:
+            _write_atomic(
+                os.path.join(folder, SNAPSHOT_FILE),
+                json.dumps(batch['snapshot'], separators=(',', ':'))
+            )
+            # the old journal is void now.
+            _write_atomic(journalfile, json.dumps({'generation': batch['generation']}) + '\n')
+            L.debug('wrote snapshot generation %d'%batch['generation'])
+        else:
+            data = ''.join(json.dumps(record) + '\n' for record in batch['records'])
+            with open(journalfile, 'a') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            L.debug('appended %d records to journal'%len(batch['records']))
+
+    # ---- loading ----
+
+    def load(o, folder, board):
+        '''loads snapshot and journal from folder into board.
+        Raises ValueError if the snapshot is corrupt.
+        '''
+        snapshotfile = os.path.join(folder, SNAPSHOT_FILE)
+        if not os.path.exists(snapshotfile):
+            o.invalidate()
+            return
+        with open(snapshotfile, 'r') as f:
+            struct = json.loads(f.read())
+        board.clusters_from_jsonstruct(struct)
+        o.invalidate()
+        o.generation = struct.get('generation', 0)
+        o._snapshot_needed = not o._replay(os.path.join(folder, JOURNAL_FILE), board)
+        board.update_grid(board.clusters)
+        o._moved.clear()
+        o._joins = []
+
+    def _replay(o, journalfile, board):
+        '''applies the journal to board. Returns True if the journal can be
+        appended to.
+        '''
+        o.journal_length = 0
+        if not os.path.exists(journalfile):
+            return False
+        with open(journalfile, 'r') as f:
+            lines = f.read().split('\n')
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            L.warning('journal header is corrupt, ignoring journal')
+            return False
+        if header.get('generation') != o.generation:
+            L.info('journal belongs to another snapshot, ignoring it')
+            return False
+        clusters_by_id = {cluster.id: cluster for cluster in board.clusters}
+        for line in lines[1:]:
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # torn write at the end
+                L.warning('journal ends with a broken record, ignoring it')
+                return False
+            if 'join' in record:
+                clusters = [clusters_by_id.pop(cid) for cid in record['join'] if cid in clusters_by_id]
+                if len(clusters) > 1:
+                    clusters = [board.join(clusters[1:], to_cluster=clusters[0])]
+                if clusters:
+                    clusters_by_id[clusters[0].id] = clusters[0]
+            else:
+                for cid, (x, y, rotation) in record['move'].items():
+                    cluster = clusters_by_id.get(int(cid))
+                    if cluster:
+                        cluster.x, cluster.y, cluster.rotation = x, y, rotation
+            o.journal_length += 1
+        L.debug('replayed %d journal records'%o.journal_length)
+        return True
@@ -0,0 +1,106 @@
+'''Layout of cluster selections (rearrange).
+
+pack_clusters arranges clusters of any size on shelves: the bounding boxes
+of the rotated clusters are sorted by height and filled into rows of
+roughly square total extent.
+
+Bounding boxes are computed with numpy if available, otherwise in pure Python.
+'''
+
+import logging
+from math import sin, cos, pi
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+L = logging.getLogger(__name__)
+
+__all__ = ['cluster_boxes', 'pack_clusters']
+
+
+def cluster_boxes(clusters):
+    '''returns the bounding boxes of the rotated clusters, relative to their
+    origin, as four lists x0, y0, x1, y1 (one entry per cluster).
+    '''
+    if np is not None:
+        return _cluster_boxes_np(clusters)
+    x0s, y0s, x1s, y1s = [], [], [], []
+    for cluster in clusters:
+        theta = 2.*pi*cluster.rotation/cluster.rotations
+        sinval, cosval = sin(theta), cos(theta)
+        xs, ys = [], []
+        for p in cluster.pieces:
+            for x, y in ((p.x0, p.y0), (p.x0+p.w, p.y0), (p.x0, p.y0+p.h), (p.x0+p.w, p.y0+p.h)):
+                # see Cluster.rotate
+                xs.append(x * cosval + y * sinval)
+                ys.append(-x * sinval + y * cosval)
+        x0s.append(min(xs))
+        y0s.append(min(ys))
+        x1s.append(max(xs))
+        y1s.append(max(ys))
+    return x0s, y0s, x1s, y1s
+
+def _cluster_boxes_np(clusters):
+    sizes = [len(cluster.pieces) for cluster in clusters]
+    geometry = np.array(
+        [(p.x0, p.y0, p.w, p.h) for cluster in clusters for p in cluster.pieces],
+        dtype=float
+    ).reshape(-1, 4)
+    x0, y0, w, h = geometry.T
+    rotation = np.repeat([cluster.rotation for cluster in clusters], sizes)
+    rotations = np.repeat([cluster.rotations for cluster in clusters], sizes)
+    theta = 2.*pi*rotation/rotations
+    sinval, cosval = np.sin(theta)[:, None], np.cos(theta)[:, None]
+    # corners of all pieces, shape (n, 4)
+    x = np.stack((x0, x0+w, x0, x0+w), axis=1)
+    y = np.stack((y0, y0, y0+h, y0+h), axis=1)
+    # see Cluster.rotate
+    xr = x * cosval + y * sinval
+    yr = -x * sinval + y * cosval
+    # pieces of a cluster are contiguous
+    starts = np.cumsum([0] + sizes[:-1])
+    return (
+        np.minimum.reduceat(xr.min(axis=1), starts).tolist(),
+        np.minimum.reduceat(yr.min(axis=1), starts).tolist(),
+        np.maximum.reduceat(xr.max(axis=1), starts).tolist(),
+        np.maximum.reduceat(yr.max(axis=1), starts).tolist(),
+    )
+
+def pack_clusters(clusters, center, gap=0.):
+    '''computes new positions for clusters, packed on shelves and centered
+    on center = (x, y). Rotations are kept. gap is the free space between
+    bounding boxes.
+
+    Returns two lists x, y (new cluster positions in the order of clusters).
+    Clusters with the same height keep their relative order.
+    '''
+    if not clusters:
+        return [], []
+    bx0, by0, bx1, by1 = cluster_boxes(clusters)
+    n = len(clusters)
+    w = [bx1[i] - bx0[i] + gap for i in range(n)]
+    h = [by1[i] - by0[i] + gap for i in range(n)]
+    row_width = max(sum(w[i] * h[i] for i in range(n)) ** 0.5, max(w))
+
+    px, py = [0.]*n, [0.]*n
+    x = y = shelf_height = width = 0.
+    for i in sorted(range(n), key=lambda i: -h[i]):
+        if x > 0 and x + w[i] > row_width:
+            # next shelf
+            y += shelf_height
+            x = shelf_height = 0.
+        px[i], py[i] = x, y
+        x += w[i]
+        width = max(width, x)
+        shelf_height = max(shelf_height, h[i])
+    height = y + shelf_height
+
+    # move box corner to (px, py), center everything.
+    x0 = center[0] - 0.5 * width + 0.5 * gap
+    y0 = center[1] - 0.5 * height + 0.5 * gap
+    return (
+        [x0 + px[i] - bx0[i] for i in range(n)],
+        [y0 + py[i] - by0[i] for i in range(n)],
+    )
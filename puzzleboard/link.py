@@ -12,7 +12,7 @@ class Link(object):
         return cls(**struct)
     
     def reversed(o):
-        return Link(id1=o.id2, id2=o.id1, x=0, y=0)
+        return Link(id1=o.id2, id2=o.id1, x=o.x, y=o.y)
     
     def as_jsonstruct(o):
         return {
@@ -20,4 +20,12 @@ class Link(object):
             'id2': o.id2,
             'x': o.x, 
             'y': o.y,
-        }
\ No newline at end of file
+        }
+
+def link_anchor(piece1, piece2):
+    '''anchor point of the link between two pieces, in image coordinates:
+    the center of the overlap of their bounding boxes (the plug between
+    them), or the middle between the boxes if they do not overlap.'''
+    x0, x1 = max(piece1.x0, piece2.x0), min(piece1.x0+piece1.w, piece2.x0+piece2.w)
+    y0, y1 = max(piece1.y0, piece2.y0), min(piece1.y0+piece1.h, piece2.y0+piece2.h)
+    return 0.5*(x0+x1), 0.5*(y0+y1)
@@ -14,8 +14,9 @@ class PuzzleAPI(RemoteAPI):
     # ---- player management ----
     
     @incoming
-    def connect(self, sender, name):
-        '''registers the given name as alias for the sender.'''
+    def connect(self, sender, name, room=None):
+        '''registers the given name as alias for the sender.
+        On a multi-room server, room is the id of the puzzle to join.'''
         pass
         
     @outgoing
@@ -46,9 +47,17 @@ class PuzzleAPI(RemoteAPI):
     
     @incoming
     def save_puzzle(self, sender):
-        '''saves the puzzle (i.e. clusters.json). Sender must be stdio.'''
+        '''saves the puzzle state (i.e. clusters.json and its journal). Sender must be stdio.'''
         pass
     
+    @incoming
+    def autosave(self, sender, enabled):
+        '''turns saving of the puzzle state on every change on/off.
+        Changes are written in the background at most every few seconds.
+        Sender must be stdio.
+        '''
+        pass
+
     @incoming
     def restart_puzzle(self, sender):
         '''restarts the puzzle (i.e. rerandomizes clusters.json).'''
@@ -73,8 +82,10 @@ class PuzzleAPI(RemoteAPI):
             links: [{id1, id2, x, y: int}]
         }
         cluster_data : {
-            clusters: [{x, y, rotation:int, pieces:[int,]}]
+            ids, x, y, rotation, sizes: [one entry per cluster],
+            pieces: [int,] (piece ids of all clusters one after another)
         }
+        Use puzzleboard.cluster.iter_cluster_columns to read cluster_data.
         '''
         pass
         
@@ -133,16 +144,39 @@ class PuzzleAPI(RemoteAPI):
         '''
         pass
     
+    @incoming
+    def move_group(self, sender, clusters, dx, dy, rotate=0, pivot_x=0, pivot_y=0):
+        '''move clusters rigidly as one group.
+        All given clusters are rotated by `rotate` steps about
+        (pivot_x, pivot_y), then translated by (dx, dy).
+        Cheaper than move() for large selections.
+        '''
+        pass
+
     @incoming
     def rearrange(self, sender, clusters, x=None, y=None):
         '''special kind of move, rearranges clusters as grid.'''
         pass
-    
+
+    @incoming
+    def viewport(self, sender, x, y, width, height):
+        '''reports the visible part of the board (puzzle coordinates).
+        Afterwards the sender gets moved / group_moved mostly for clusters
+        in or near the viewport (see puzzleboard.interest).
+        Clients should report at most a few times per second.
+        '''
+        pass
+
     @outgoing
     def moved(self, receivers, cluster_positions):
         '''see move'''
         pass
-    
+
+    @outgoing
+    def group_moved(self, receivers, clusters, dx, dy, rotate, pivot_x, pivot_y):
+        '''see move_group'''
+        pass
+
     @outgoing
     def joined(self, receivers, cluster, joined_clusters, position):
         '''on join: joined_clusters (list) are merged into cluster.
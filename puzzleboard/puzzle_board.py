@@ -4,8 +4,11 @@ import json
 
 from random import shuffle, randint
 from .piece import Piece
-from .cluster import Cluster
+from .cluster import Cluster, clusters_as_columns, iter_cluster_columns
 from .link import Link
+from .journal import StateJournal
+from .layout import pack_clusters, cluster_boxes
+from .spatial import SpatialGrid
 
 L = logging.getLogger(__name__)
 
@@ -26,6 +29,14 @@ class PuzzleBoard(object):
         o.pieces = list(pieces or [])
         o.pieces_by_id = {p.id:p for p in o.pieces}
         o.links = links or []
+        o.journal = StateJournal()
+        # cluster bounding boxes; cells of about two pieces
+        sizes = [p.w + p.h for p in o.pieces]
+        o.grid = SpatialGrid(cell_size=max(sum(sizes) / max(len(sizes), 1), 1.))
+        # cluster -> (rotation, number of pieces, box relative to cluster origin)
+        o._boxes = {}
+        # cluster -> links to other clusters, as (piece1, piece2)
+        o._perimeter = {}
         o.init_clusters()
         o.basefolder = ''
         o.imagefolder = ''
@@ -38,13 +49,10 @@ class PuzzleBoard(object):
             puzzle = cls.from_jsonstring(f.read())
             puzzle.basefolder = foldername
             puzzle.imagefolder = os.path.join(foldername, 'pieces')
-        clustersfile = os.path.join(foldername, 'clusters.json')
-        if os.path.exists(clustersfile):
-            try:
-                with open(clustersfile, 'r') as f:
-                    puzzle.clusters_from_jsonstring(f.read())
-            except ValueError:
-                L.error('PuzzleBoard.from_folder: clusters file is corrupt.')
+        try:
+            puzzle.journal.load(foldername, puzzle)
+        except ValueError:
+            L.error('PuzzleBoard.from_folder: clusters file is corrupt.')
         return puzzle
         
     @classmethod
@@ -65,9 +73,10 @@ class PuzzleBoard(object):
     def clusters_from_jsonstruct(o, jsonstruct):
         o.clusters = [
             Cluster.from_jsonstruct(js, pieces_by_id=o.pieces_by_id, rotations=o.rotations)
-            for js in jsonstruct['clusters']
+            for js in iter_cluster_columns(jsonstruct)
         ]
         o._clusters_changed()
+        o.journal.invalidate()
     
     def init_clusters(o):
         o.clusters = [
@@ -75,23 +84,72 @@ class PuzzleBoard(object):
             for piece in o.pieces
         ]
         o._clusters_changed()
+        o.journal.invalidate()
     
     def _clusters_changed(o):
-        for cluster in o.clusters:
+        for index, cluster in enumerate(o.clusters):
+            cluster._index = index
             for piece in cluster:
                 piece.cluster = cluster
+        o.grid.clear()
+        o._boxes = {}
+        o.update_grid(o.clusters)
+        o._index_links()
+        
+    def _index_links(o):
+        '''rebuilds the perimeter links of all clusters.'''
+        pieces_by_id = {piece.id: piece for piece in o.pieces}
+        piece_links = {}
+        for link in o.links:
+            entry = (pieces_by_id[link.id1], pieces_by_id[link.id2])
+            piece_links.setdefault(link.id1, []).append(entry)
+            piece_links.setdefault(link.id2, []).append(entry)
+        o._perimeter = {
+            cluster: [
+                entry
+                for piece in cluster
+                for entry in piece_links.get(piece.id, ())
+                if entry[0].cluster is not entry[1].cluster
+            ]
+            for cluster in o.clusters
+        }
+        
+    def update_grid(o, clusters):
+        '''updates the bounding boxes of clusters in o.grid.
+        Needed after setting cluster positions directly.'''
+        boxes = o._boxes
+        stale = [
+            cluster for cluster in clusters
+            if boxes.get(cluster, (None, None))[:2] != (cluster.rotation, len(cluster.pieces))
+        ]
+        if stale:
+            for cluster, box in zip(stale, zip(*cluster_boxes(stale))):
+                boxes[cluster] = (cluster.rotation, len(cluster.pieces), box)
+        for cluster in clusters:
+            x0, y0, x1, y1 = boxes[cluster][2]
+            x, y = cluster.x, cluster.y
+            o.grid.update(cluster, (x0 + x, y0 + y, x1 + x, y1 + y))
+            
+    def cluster_box(o, cluster):
+        '''bounding box (x0, y0, x1, y1) of the cluster on the board.'''
+        return o.grid.box(cluster)
+        
+    def clusters_in_rect(o, x0, y0, x1, y1):
+        '''clusters whose bounding box intersects the rectangle.'''
+        return list(o.grid.rect(x0, y0, x1, y1))
+        
+    def nearest_cluster(o, x, y):
+        '''the cluster whose bounding box is closest to (x, y), or None.'''
+        return o.grid.nearest(x, y)[0]
         
     def save_state(o):
+        '''saves the changes since the last save (see StateJournal).'''
         if not o.basefolder:
             raise ValueError('State cannot be saved without base folder')
-        clusterfile = os.path.join(o.basefolder, 'clusters.json')
-        with open(clusterfile, 'w') as f:
-            f.write(as_jsonstring(o.clusters_as_jsonstruct()))
+        o.journal.write(o.basefolder, o.journal.collect(o))
             
     def clusters_as_jsonstruct(o):
-        return {
-            'clusters': [cluster.as_jsonstruct() for cluster in o.clusters],
-        }
+        return clusters_as_columns(o.clusters)
     
     def puzzle_as_jsonstruct(o):
         return {
@@ -113,39 +171,97 @@ class PuzzleBoard(object):
         cluster.x = x
         cluster.y = y
         cluster.rotation = rotation
+        o.update_grid([cluster])
+        o.journal.moved([cluster])
         L.debug('moved cluster %s to %r, %r * %r'%([p.id for p in cluster.pieces], x, y, rotation))
         o.on_changed()
-        
+
+    def move_group(o, clusters, dx, dy, rotate=0, pivot=(0, 0)):
+        '''moves all clusters rigidly: rotation by `rotate` steps about pivot,
+        then translation by (dx, dy). Fires on_changed only once.
+        '''
+        px, py = pivot
+        for cluster in clusters:
+            x, y = cluster.x - px, cluster.y - py
+            if rotate:
+                x, y = cluster.rotate(x, y, rotate)
+            cluster.x = px + x + dx
+            cluster.y = py + y + dy
+            cluster.rotation = (cluster.rotation + rotate) % o.rotations
+        o.update_grid(clusters)
+        o.journal.moved(clusters)
+        L.debug('moved %d clusters by %r, %r * %r'%(len(clusters), dx, dy, rotate))
+        o.on_changed()
+
     def joinable_clusters(o, cluster):
-        pids = {piece.id for piece in cluster}
-        links = {l for l in o.links if l.id1 in pids or l.id2 in pids}
-        linked_clusters = {o.pieces_by_id[link.id1].cluster for link in links}
-        linked_clusters |= {o.pieces_by_id[link.id2].cluster for link in links}
+        '''clusters with the same rotation, linked to cluster and placed
+        within SNAP_DISTANCE of it. Only the links on the perimeter of
+        cluster are checked.'''
+        x, y, rotation = cluster.x, cluster.y, cluster.rotation
         result = []
-        for linked_cluster in linked_clusters:
-            if linked_cluster is cluster: continue
+        checked = {cluster}
+        for piece1, piece2 in o._perimeter[cluster]:
+            other = piece2.cluster if piece1.cluster is cluster else piece1.cluster
+            if other in checked: continue
+            checked.add(other)
+            # With equal rotations both clusters rotate the link anchor
+            # alike, so the anchor cancels and the origins are compared.
             if (
-                abs(cluster.x-linked_cluster.x) < SNAP_DISTANCE 
-                and abs(cluster.y-linked_cluster.y) < SNAP_DISTANCE
-                and cluster.rotation == linked_cluster.rotation
+                other.rotation == rotation
+                and abs(x - other.x) < SNAP_DISTANCE
+                and abs(y - other.y) < SNAP_DISTANCE
             ):
-                result.append(linked_cluster)
+                result.append(other)
         return result
     
     def join(o, clusters, to_cluster):
-        '''joins pieces from all clusters in clusters to to_cluster.
-        clusters in clusters become invalid.
-        position of to_cluster changes to the cluster with the most pieces position.
+        '''joins all clusters in clusters and to_cluster.
+        
+        The cluster with the most pieces survives and keeps its position;
+        only the pieces of the others are moved over (union by size).
+        All other clusters become invalid. The survivor gets the lowest
+        id of all joined clusters.
+        
+        Returns the surviving cluster.
         '''
-        anchor = max(clusters+[to_cluster], key=lambda c: len(c.pieces))
-        to_cluster.x, to_cluster.y, to_cluster.rotation = anchor.x, anchor.y, anchor.rotation
+        clusters = clusters + [to_cluster]
+        ids = [c.id for c in clusters]
+        survivor = max(clusters, key=lambda c: len(c.pieces))
+        links = [entry for cluster in clusters for entry in o._perimeter[cluster]]
+        boxes = [o._boxes[cluster] for cluster in clusters]
         for cluster in clusters:
-            to_cluster.pieces.extend(cluster.pieces)
-            o.clusters.remove(cluster)
-        for piece in to_cluster.pieces:
-            piece.cluster = to_cluster
-        L.debug('clusters after join: %r'%[c.as_jsonstruct() for c in o.clusters])
+            if cluster is not survivor:
+                o._merge_into(survivor, cluster)
+                o._remove_cluster(cluster)
+        # links between the joined clusters are inside now
+        o._perimeter[survivor] = [entry for entry in links if entry[0].cluster is not entry[1].cluster]
+        if all(rotation == survivor.rotation for rotation, n, box in boxes):
+            # the relative box depends on the pieces only: union of the boxes
+            o._boxes[survivor] = (survivor.rotation, len(survivor.pieces), (
+                min(box[0] for r, n, box in boxes), min(box[1] for r, n, box in boxes),
+                max(box[2] for r, n, box in boxes), max(box[3] for r, n, box in boxes),
+            ))
+        survivor._id = min(ids)
+        o.update_grid([survivor])
+        o.journal.joined(ids, survivor)
+        L.debug('joined clusters %r, %d clusters left'%(ids, len(o.clusters)))
         o.on_changed()
+        return survivor
+        
+    def _merge_into(o, survivor, cluster):
+        survivor.pieces.extend(cluster.pieces)
+        for piece in cluster.pieces:
+            piece.cluster = survivor
+    
+    def _remove_cluster(o, cluster):
+        '''removes cluster from o.clusters in O(1) by moving the last one into its place.'''
+        last = o.clusters.pop()
+        if last is not cluster:
+            o.clusters[cluster._index] = last
+            last._index = cluster._index
+        o.grid.remove(cluster)
+        del o._boxes[cluster]
+        del o._perimeter[cluster]
         
     def reset_puzzle(o):
         o.init_clusters()
@@ -158,37 +274,44 @@ class PuzzleBoard(object):
         
     def rearrange(o, clusters, pos=None):
         o._rearrange(clusters, pos)
+        o.journal.moved(clusters)
         o.on_changed()
         
     def _rearrange(o, clusters, pos=None):
-        clusters = [c for c in clusters if len(c.pieces) == 1]
+        '''packs clusters (of any size) around pos, see layout.pack_clusters.
+        Without pos, they go to the free space next to their center of mass.'''
+        if not clusters:
+            return
+        clusters = list(clusters)
         shuffle(clusters)
-        pieces = [c.pieces[0] for c in clusters]
-        # calculate maximum piece diagonal (squared)
-        maxdgsq = max((p.w*p.w + p.h*p.h for p in pieces))
-        # no matter how you rotate a piece, it will never be higher or wider
-        # than its diagonal. so choose this value as pitch.
-        pitch = maxdgsq ** 0.5
-        # try to achieve roughly square aspect.
-        pieces_per_row = max(int(len(clusters)**0.5), 1)
+        find_space = not pos
         if not pos:
             # try to keep center of mass
-            x = sum((cluster.x for cluster in clusters)) / len(clusters)
-            y = sum((cluster.y for cluster in clusters)) / len(clusters)
-        else:
-            x, y = pos
-        x -= pitch * (pieces_per_row -0.5) * 0.5
-        y -= pitch * (pieces_per_row - 0.5) * 0.5
-        x0 = x
-        n_in_row = 0
-        for cluster in clusters:
-            p = cluster.pieces[0]
-            xc, yc  = cluster.rotate(-p.x0 - 0.5*p.w, -p.y0 - 0.5*p.h)
-            cluster.x = x + xc
-            cluster.y = y + yc
-            x += pitch
-            n_in_row += 1
-            if n_in_row >= pieces_per_row:
-                x = x0
-                y += pitch
-                n_in_row = 0
+            pos = (
+                sum((cluster.x for cluster in clusters)) / len(clusters),
+                sum((cluster.y for cluster in clusters)) / len(clusters),
+            )
+        # leave some space between clusters: a fifth of the average piece size
+        sample = [cluster.pieces[0] for cluster in clusters]
+        gap = 0.1 * sum(p.w + p.h for p in sample) / len(sample)
+        xs, ys = pack_clusters(clusters, pos, gap)
+        for cluster, x, y in zip(clusters, xs, ys):
+            cluster.x = x
+            cluster.y = y
+        o.update_grid(clusters)
+        if find_space:
+            o._move_to_free_space(clusters, gap)
+            
+    def _move_to_free_space(o, clusters, gap):
+        '''shifts clusters as a block so that they do not overlap others.'''
+        boxes = [o.grid.box(cluster) for cluster in clusters]
+        x0, y0 = min(b[0] for b in boxes), min(b[1] for b in boxes)
+        x1, y1 = max(b[2] for b in boxes), max(b[3] for b in boxes)
+        fx, fy = o.grid.free_area(
+            x1 - x0, y1 - y0, 0.5 * (x0 + x1), 0.5 * (y0 + y1), gap=gap, exclude=clusters)
+        dx, dy = fx - x0, fy - y0
+        if dx or dy:
+            for cluster in clusters:
+                cluster.x += dx
+                cluster.y += dy
+            o.update_grid(clusters)
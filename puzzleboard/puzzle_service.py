@@ -2,25 +2,61 @@ import logging
 L = lambda: logging.getLogger(__name__)
 
 import os
+import time
+import functools
+import threading
+from collections import deque
+
+from neatocom.codecs import Cached
 
 from .puzzle_api import PuzzleAPI
 from .puzzle_board import PuzzleBoard
+from .interest import InterestManager
 
 
 class PuzzleService(object):
-    def __init__(self, codec, transport, announcer, close_handler, quit_handler):
+    # autosave when this many seconds passed since the first unsaved change...
+    autosave_delay = 5.0
+    # ... or when this many changes are unsaved.
+    autosave_ops = 200
+
+    def __init__(self, codec, transport, announcer, close_handler, quit_handler, board_class=PuzzleBoard, image_cache=None, autosave_thread=True):
         self.transport = transport
+        self.board_class = board_class
+        # ImageCache for piece images, None reads the files on each request
+        self.image_cache = image_cache
         self.api = PuzzleAPI(codec=codec, transport=transport)
         self._announcer=announcer
         self.close_handler = close_handler
         self.quit_handler = quit_handler
         
         self.servername = 'Unnamed server'
-        self.board = PuzzleBoard()
         self.players = {}
+        # who gets which position updates
+        self.interest = InterestManager()
         # player id -> list of grabbed clusters
         self.grabbed_clusters_by_player = {}
         
+        # guards the board; handlers run in the transport thread,
+        # state files are written by the autosave thread.
+        self._cond = threading.Condition(threading.RLock())
+        # held while taking and writing batches, keeps them in order
+        self._write_lock = threading.Lock()
+        self.autosave_enabled = True
+        self._dirty_ops = 0
+        self._dirty_since = 0
+        # (journal, folder, batch) waiting to be written
+        self._batches = deque()
+        self._running = True
+        self._set_board(board_class())
+        # without autosave thread, the owner calls autosave() regularly
+        # (see RoomServer, which saves all its rooms in one thread).
+        self._autosave_thread = None
+        if autosave_thread:
+            self._autosave_thread = threading.Thread(target=self._autosave_loop, name='autosave')
+            self._autosave_thread.daemon = True
+            self._autosave_thread.start()
+        
         self._init_handlers()
         
     def _init_handlers(self):
@@ -30,9 +66,96 @@ class PuzzleService(object):
         for name in dir(self):
             if name.startswith('on_'):
                 try:
-                    getattr(self.api, name[3:]).connect(getattr(self, name))
+                    getattr(self.api, name[3:]).connect(self._locked(getattr(self, name)))
                 except AttributeError:
                     raise AttributeError("There is a handler defined for a nonexistent message '%s'"%name[3:])
+
+    def _locked(self, func):
+        @functools.wraps(func)
+        def locked_func(*args, **kwargs):
+            with self._cond:
+                return func(*args, **kwargs)
+        return locked_func
+
+    def close(self):
+        '''saves pending changes (if autosave is on) and stops the autosave thread.'''
+        with self._cond:
+            if self.autosave_enabled:
+                self._collect_state()
+            self._running = False
+            self._cond.notify()
+        if self._autosave_thread is not None:
+            self._autosave_thread.join()
+            return
+        with self._write_lock:
+            with self._cond:
+                batches = self._take_batches()
+            _write_batches(batches)
+
+    def autosave(self):
+        '''writes the changes that are due, in the calling thread.
+        For services without autosave thread.'''
+        with self._write_lock:
+            with self._cond:
+                batches = self._take_batches()
+            _write_batches(batches)
+
+    # ---- autosave ----
+
+    def _set_board(self, board):
+        self.board = board
+        # the puzzle itself does not change, so encode it only once.
+        self._puzzle_data = Cached(board.puzzle_as_jsonstruct())
+        self.interest.reset()
+        board.on_changed = self._on_board_changed
+        self._dirty_ops = 0
+
+    def _on_board_changed(self):
+        with self._cond:
+            self._dirty_ops += 1
+            if self._dirty_ops == 1:
+                # start the timer
+                self._dirty_since = time.monotonic()
+                self._cond.notify()
+            elif self._dirty_ops >= self.autosave_ops:
+                self._cond.notify()
+
+    def _autosave_remaining(self):
+        '''seconds until the next autosave is due, None if none is pending.'''
+        if not (self.autosave_enabled and self._dirty_ops and self.board.basefolder):
+            return None
+        if self._dirty_ops >= self.autosave_ops:
+            return 0
+        return max(0, self._dirty_since + self.autosave_delay - time.monotonic())
+
+    def _collect_state(self):
+        '''takes the unsaved changes of the board for writing. Lock must be held.'''
+        self._dirty_ops = 0
+        if not self.board.basefolder:
+            return
+        batch = self.board.journal.collect(self.board)
+        if batch:
+            self._batches.append((self.board.journal, self.board.basefolder, batch))
+            self._cond.notify()
+
+    def _take_batches(self):
+        '''collects the state if due; returns and clears the waiting batches. Lock must be held.'''
+        if self._autosave_remaining() == 0:
+            self._collect_state()
+        batches = list(self._batches)
+        self._batches.clear()
+        return batches
+
+    def _autosave_loop(self):
+        while True:
+            with self._cond:
+                while self._running and not self._batches and self._autosave_remaining() != 0:
+                    self._cond.wait(self._autosave_remaining())
+                batches = self._take_batches()
+                if not batches and not self._running:
+                    return
+            # write without holding the lock
+            _write_batches(batches)
                 
     def on_quit(self, sender):
         if sender!='stdio':
@@ -41,6 +164,14 @@ class PuzzleService(object):
         L().info("invoke quit")
         self.quit_handler()
         
+    def on_autosave(self, sender, enabled):
+        if sender!='stdio':
+            L().warning('autosave command only allowed from stdio')
+            return
+        self.autosave_enabled = bool(enabled)
+        self._cond.notify()
+        L().info('autosave %s'%('enabled' if enabled else 'disabled'))
+
     def on_servername(self, sender, name):
         if sender!='stdio':
             L().warning('servername command only allowed from stdio')
@@ -54,19 +185,21 @@ class PuzzleService(object):
         
     # ---- Player management ----
     
-    def on_connect(self, sender, name):
+    def on_connect(self, sender, name, room=None):
         # TODO: check that the name does not contain evil stuff.
         self.players[sender] = name
         self.grabbed_clusters_by_player[sender] = []
         self.api.connected(None, playerid=sender, name=name)
         
     def on_disconnect(self, sender):
-        # drop all pieces of sender
-        self.on_drop(sender, [cluster.id for cluster in self._get_grabbed(sender)])
-        # forget about him
-        del self.players[sender]
-        del self.grabbed_clusters_by_player[sender]
-        self.api.disconnected(None, playerid=sender)
+        with self.api.batch():
+            # drop all pieces of sender
+            self.on_drop(sender, [cluster.id for cluster in self._get_grabbed(sender)])
+            # forget about him
+            del self.players[sender]
+            del self.grabbed_clusters_by_player[sender]
+            self.interest.forget(sender)
+            self.api.disconnected(None, playerid=sender)
         # close connection
         self.close_handler(sender)
         
@@ -76,10 +209,16 @@ class PuzzleService(object):
         if sender!='stdio':
             L().warning('load_puzzle command only allowed from stdio.')
             return
-        board = PuzzleBoard.from_folder(path)
+        self.load_puzzle(path)
+            
+    def load_puzzle(self, path):
+        '''loads the puzzle in folder path and sends it to all players.'''
+        board = self.board_class.from_folder(path)
         # FIXME: error check
         if board:
-            self.board = board
+            if self.autosave_enabled:
+                self._collect_state()
+            self._set_board(board)
             L().info('New puzzle was loaded: %s'%path)
             # send new puzzle to all players
             self.send_puzzle(None)
@@ -88,17 +227,23 @@ class PuzzleService(object):
         if sender!='stdio':
             L().warning('save_puzzle command only allowed from stdio.')
             return
-        try:
-            self.board.save_state()
-        except ValueError as e:
-            L().error(e)
-        L().info('puzzle state was saved')
+        if not self.board.basefolder:
+            L().error('State cannot be saved without base folder')
+            return
+        # written later by the autosave thread (or the owner's autosave()),
+        # which logs the outcome; waiting for it here would block the handler.
+        self._collect_state()
+        if self._batches:
+            L().info('puzzle state queued for saving')
+        else:
+            L().info('puzzle state unchanged, nothing to save')
             
     def on_restart_puzzle(self, sender):
         if sender!='stdio':
             L().warning('reset_puzzle command only allowed from stdio.')
             return
         self.board.reset_puzzle()
+        self.interest.reset()
         self.send_clusters(None)
         L().info('puzzle was restarted')
         
@@ -108,7 +253,7 @@ class PuzzleService(object):
     def send_puzzle(self, receivers):
         self.api.puzzle(
             receivers,
-            puzzle_data = self.board.puzzle_as_jsonstruct(),
+            puzzle_data = self._puzzle_data,
             cluster_data = self.board.clusters_as_jsonstruct()
         )
     
@@ -132,6 +277,9 @@ class PuzzleService(object):
                 L().warning('%s requested pixmap for nonexisting piece id %d'%(sender, pieceid))
                 continue
             path = os.path.join(self.board.imagefolder, piece.image)
+            if self.image_cache is not None:
+                pixmaps[str(piece.id)] = self.image_cache.read(path)
+                continue
             with open(path, "rb") as f:
                 pixmaps[str(piece.id)] = f.read()
         self.api.piece_pixmaps(sender, pixmaps=pixmaps)
@@ -173,6 +321,11 @@ class PuzzleService(object):
     def on_drop(self, sender, clusters):
         if sender not in self.players:
             return
+        # dropped, joined and solved go out as one frame
+        with self.api.batch():
+            self._drop(sender, clusters)
+            
+    def _drop(self, sender, clusters):
         clusters = self._get_clusters(clusters)
         grabbed_clusters = self._get_grabbed(sender)
         clusters = [cluster for cluster in clusters if cluster in grabbed_clusters]
@@ -200,12 +353,11 @@ class PuzzleService(object):
                     
             # execute join
             # The new cluster will have the lowest id of all joined clusters.
-            clusterid = min([cluster.id for cluster in joinable_clusters+[cluster]])
             jcids = [jc.id for jc in joinable_clusters+[cluster]]
-            jcids.remove(clusterid)
-            
-            self.board.join(joinable_clusters, to_cluster=cluster)
-            self.api.joined(None, cluster=clusterid, joined_clusters=jcids, position=cluster.position)
+            joined = self.board.join(joinable_clusters, to_cluster=cluster)
+            jcids.remove(joined.id)
+            self.interest.joined(joined.id, jcids)
+            self.api.joined(None, cluster=joined.id, joined_clusters=jcids, position=joined.position)
         if len(self.board.clusters) == 1:
             self.api.solved(None)
             
@@ -216,13 +368,47 @@ class PuzzleService(object):
         grabbed_clusters = self._get_grabbed(sender)
         clusters = [cluster for cluster in clusters if cluster in grabbed_clusters]
         
-        new_positions = {}
+        old_boxes = [self.board.cluster_box(cluster) for cluster in clusters]
         for cluster in clusters:
             pos = cluster_positions[str(cluster.id)]
             self.board.move_cluster(cluster, pos['x'], pos['y'], pos['rotation'])
-            new_positions[str(cluster.id)] = cluster.position
-        self.api.moved(None, cluster_positions=new_positions)
-        
+        self._send_moved(sender, clusters, old_boxes)
+
+    def on_move_group(self, sender, clusters, dx, dy, rotate=0, pivot_x=0, pivot_y=0):
+        if sender not in self.players:
+            return
+        clusters = self._get_clusters(clusters)
+        grabbed_clusters = self._get_grabbed(sender)
+        clusters = [cluster for cluster in clusters if cluster in grabbed_clusters]
+        if not clusters:
+            return
+
+        old_boxes = [self.board.cluster_box(cluster) for cluster in clusters]
+        self.board.move_group(clusters, dx, dy, rotate, (pivot_x, pivot_y))
+        if not self.interest.active:
+            self.api.group_moved(
+                None,
+                clusters=[cluster.id for cluster in clusters],
+                dx=dx, dy=dy, rotate=rotate,
+                pivot_x=pivot_x, pivot_y=pivot_y
+            )
+            return
+        by_id = {cluster.id: cluster for cluster in clusters}
+        with self.api.batch():
+            for receivers, ids, resync in self._route_moves(sender, clusters, old_boxes):
+                # stale clusters need their absolute position
+                if resync:
+                    self.api.moved(receivers, cluster_positions={
+                        str(cid): by_id[cid].position for cid in resync
+                    })
+                if len(ids) > len(resync):
+                    self.api.group_moved(
+                        receivers,
+                        clusters=[cid for cid in ids if cid not in resync],
+                        dx=dx, dy=dy, rotate=rotate,
+                        pivot_x=pivot_x, pivot_y=pivot_y
+                    )
+
     def on_rearrange(self, sender, clusters, x=None, y=None):
         if sender not in self.players:
             return
@@ -234,9 +420,53 @@ class PuzzleService(object):
         if x is not None and y is not None:
             pos = (x, y)
         
+        old_boxes = [self.board.cluster_box(cluster) for cluster in clusters]
         self.board.rearrange(clusters, pos)
-        new_positions = {
-            str(cluster.id): cluster.position
-            for cluster in clusters
+        self._send_moved(sender, clusters, old_boxes)
+
+    def _route_moves(self, sender, clusters, old_boxes):
+        moves = {
+            cluster.id: (old, self.board.cluster_box(cluster))
+            for cluster, old in zip(clusters, old_boxes)
         }
-        self.api.moved(None, cluster_positions=new_positions)
\ No newline at end of file
+        return self.interest.route(list(self.players), sender, moves)
+
+    def _send_moved(self, sender, clusters, old_boxes):
+        '''sends the new positions of clusters to the players that see them.'''
+        if not self.interest.active:
+            self.api.moved(None, cluster_positions={
+                str(cluster.id): cluster.position for cluster in clusters
+            })
+            return
+        by_id = {cluster.id: cluster for cluster in clusters}
+        with self.api.batch():
+            for receivers, ids, resync in self._route_moves(sender, clusters, old_boxes):
+                self.api.moved(receivers, cluster_positions={
+                    str(cid): by_id[cid].position for cid in ids
+                })
+
+    def on_viewport(self, sender, x, y, width, height):
+        if sender not in self.players:
+            return
+        resync = self.interest.set_viewport(sender, x, y, width, height, self._cluster_ids_in_rect)
+        if resync:
+            self.api.moved(sender, cluster_positions={
+                str(cid): self.board.pieces_by_id[cid].cluster.position for cid in resync
+            })
+
+    def _cluster_ids_in_rect(self, x0, y0, x1, y1):
+        return [cluster.id for cluster in self.board.clusters_in_rect(x0, y0, x1, y1)]
+
+
+def _write_batches(batches):
+    for journal, folder, batch in batches:
+        t = time.monotonic()
+        try:
+            journal.write(folder, batch)
+        except (OSError, ValueError) as e:
+            L().error('saving puzzle state failed: %s'%e)
+            continue
+        L().info('saved puzzle state (%s) in %.1f ms'%(
+            'snapshot' if 'snapshot' in batch else '%d records'%len(batch['records']),
+            1000*(time.monotonic()-t)
+        ))
@@ -0,0 +1,319 @@
+'''RoomServer: many puzzles ("rooms") in one server process.
+
+Each room is a subfolder of the rooms folder containing a puzzle, as
+written by the slicer. The folder name is the room id.
+
+A client joins a room with its first message, ``connect(name, room)``.
+Everything it sends afterwards goes to the PuzzleService of that room,
+which sees only the players of its room. All rooms share the transport
+(i.e. one port, the connections and their compression) and an ImageCache
+for the piece images.
+
+Rooms are loaded when the first player joins. A room without players is
+unloaded after idle_timeout seconds: its state is saved and the board is
+dropped. Idle rooms are looked for while messages arrive, at most every
+check_interval seconds (there is no timer thread).
+
+The rooms have no autosave thread each; one saver thread looks for due
+changes in all rooms every save_interval seconds and writes them.
+
+CPU accounting: the thread CPU time spent on the messages of a room
+(decoding, handlers, sending) is added up per room. Writing the state
+files in the autosave thread is not included. See room_stats(); with
+log_interval set, the busiest rooms are logged regularly.
+
+Messages of stdio and of clients which did not join a room yet go to the
+LobbyAPI. Commands for single rooms (load_puzzle, ...) are not available
+on a multi-room server.
+'''
+import logging
+L = lambda: logging.getLogger(__name__)
+
+import os
+import re
+import time
+import threading
+
+from neatocom.remote_api import RemoteAPI, incoming, outgoing
+from neatocom.transports import Transport
+
+from .puzzle_service import PuzzleService
+from .puzzle_board import PuzzleBoard
+from .image_cache import ImageCache
+
+__all__ = [
+    'LobbyAPI',
+    'RoomServer',
+    'room_folder',
+]
+
+# room ids are folder names; no path separators or dots.
+_ROOM_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def room_folder(folder, room_id):
+    '''returns the puzzle folder of the room, None if there is no such room.'''
+    if not room_id or not _ROOM_ID.match(room_id):
+        return None
+    path = os.path.join(folder, room_id)
+    if not os.path.exists(os.path.join(path, 'puzzle.json')):
+        return None
+    return path
+
+
+class LobbyAPI(RemoteAPI):
+    @incoming
+    def quit(self, sender):
+        '''stop the server'''
+        pass
+
+    @incoming
+    def connect(self, sender, name, room=None):
+        '''joins the room (see PuzzleAPI.connect).'''
+        pass
+
+    @incoming
+    def get_room_stats(self, sender):
+        '''requests room_stats'''
+        pass
+
+    @outgoing
+    def room_stats(self, receivers, rooms):
+        '''rooms: {room id: {players, frames, cpu_s, loaded_s, idle_s}}'''
+        pass
+
+
+class _RoomTransport(Transport):
+    '''the transport of one room: sends via the server transport,
+    broadcasts go to the members of the room only.'''
+    def __init__(self, transport, members):
+        Transport.__init__(self)
+        self.transport = transport
+        self.members = members
+
+    def send(self, data, receivers=None):
+        if receivers is None:
+            if not self.members:
+                return
+            receivers = list(self.members)
+        self.transport.send(data, receivers=receivers)
+
+
+class Room(object):
+    def __init__(self, room_id, service, members):
+        self.id = room_id
+        self.service = service
+        # senders in the room
+        self.members = members
+        self.frames = 0
+        self.cpu_s = 0.
+        self.loaded_at = time.monotonic()
+        self.last_active = self.loaded_at
+
+    def received(self, sender, data):
+        '''passes data to the service. Returns the undecoded rest.'''
+        t0 = time.thread_time()
+        try:
+            return self.service.transport.received(sender, data)
+        finally:
+            self.cpu_s += time.thread_time() - t0
+            self.frames += 1
+            self.last_active = time.monotonic()
+
+    def stats(self, now):
+        return {
+            'players': len(self.members),
+            'frames': self.frames,
+            'cpu_s': self.cpu_s,
+            'loaded_s': now - self.loaded_at,
+            'idle_s': now - self.last_active if not self.members else 0.,
+        }
+
+
+class RoomServer(object):
+    '''api of the server transport, dispatching to the rooms.
+
+    folder: contains one puzzle folder per room.
+    default_room: room of clients that connect without room id.
+    '''
+    def __init__(self, folder, codec, transport, close_handler, quit_handler,
+                 board_class=PuzzleBoard, default_room=None, idle_timeout=300.,
+                 check_interval=10., log_interval=None, image_cache=None, save_interval=1.):
+        self.folder = folder
+        self.codec = codec
+        self.transport = transport
+        self.close_handler = close_handler
+        self.quit_handler = quit_handler
+        self.board_class = board_class
+        self.default_room = default_room
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.log_interval = log_interval
+        self.image_cache = image_cache or ImageCache()
+        # room id -> Room, loaded rooms only; changed under _lock
+        self.rooms = {}
+        self._lock = threading.Lock()
+        # sender -> Room
+        self._members = {}
+        self._next_check = time.monotonic() + check_interval
+        self._next_log = time.monotonic() + (log_interval or 0)
+
+        self.save_interval = save_interval
+        self._stop_saving = threading.Event()
+        self._saver = threading.Thread(target=self._save_loop, name='rooms-autosave')
+        self._saver.daemon = True
+        self._saver.start()
+
+        transport.set_api(self)
+        self.lobby = LobbyAPI(codec=codec, transport=_RoomTransport(transport, ()))
+        self.lobby.quit.connect(self.on_quit)
+        self.lobby.connect.connect(self.on_connect)
+        self.lobby.get_room_stats.connect(self.on_get_room_stats)
+
+    def handle_received(self, sender, data):
+        room = self._members.get(sender)
+        if room is None:
+            leftover = self._lobby_received(sender, data)
+        else:
+            leftover = room.received(sender, data)
+        if time.monotonic() >= self._next_check:
+            self._housekeeping()
+        return leftover
+
+    def _lobby_received(self, sender, data):
+        # Messages are newline-terminated. Up to (including) the connect,
+        # they are for the lobby, from there on for the room.
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].split(b'\n')[:-1]
+        for i, line in enumerate(lines):
+            self.lobby.handle_received(sender, line + b'\n')
+            room = self._members.get(sender)
+            if room is not None:
+                return room.received(sender, b'\n'.join(lines[i:]) + b'\n' + data[end:])
+        return data[end:]
+
+    def forget(self, sender):
+        '''the connection of sender was lost: leaves its room.'''
+        room = self._members.pop(sender, None)
+        if room is None:
+            return
+        room.members.discard(sender)
+        if sender in room.service.players:
+            # drops its clusters and tells the others
+            t0 = time.thread_time()
+            room.service.api.disconnect(sender)
+            room.cpu_s += time.thread_time() - t0
+        room.last_active = time.monotonic()
+
+    # ---- lobby ----
+
+    def on_quit(self, sender):
+        if sender!='stdio':
+            L().warning('quit command only allowed from stdio')
+            return
+        L().info("invoke quit")
+        self.quit_handler()
+
+    def on_connect(self, sender, name, room=None):
+        if sender=='stdio':
+            L().warning('stdio cannot join a room')
+            return
+        room_id = room or self.default_room
+        room = self.rooms.get(room_id) or self._load(room_id)
+        if room is None:
+            L().warning('%s (%s) asked for unknown room %r'%(sender, name, room_id))
+            self.close_handler(sender)
+            return
+        room.members.add(sender)
+        self._members[sender] = room
+
+    def on_get_room_stats(self, sender):
+        self.lobby.room_stats(sender, rooms=self.room_stats())
+
+    # ---- rooms ----
+
+    def _load(self, room_id):
+        '''returns the loaded Room, or None if there is no such room.'''
+        path = room_folder(self.folder, room_id)
+        if path is None:
+            return None
+        members = set()
+        service = PuzzleService(
+            codec=self.codec,
+            transport=_RoomTransport(self.transport, members),
+            announcer=None,
+            close_handler=self._closed_by_room,
+            quit_handler=lambda: None,
+            board_class=self.board_class,
+            image_cache=self.image_cache,
+            autosave_thread=False,
+        )
+        try:
+            service.load_puzzle(path)
+        except (OSError, ValueError, KeyError):
+            L().error('loading room %s failed'%room_id, exc_info=True)
+            service.close()
+            return None
+        room = Room(room_id, service, members)
+        with self._lock:
+            self.rooms[room_id] = room
+        L().info('room %s loaded, %d rooms active'%(room_id, len(self.rooms)))
+        return room
+
+    def _closed_by_room(self, sender):
+        '''close handler of the services, called after disconnect.'''
+        room = self._members.pop(sender, None)
+        if room is not None:
+            room.members.discard(sender)
+            room.last_active = time.monotonic()
+        self.close_handler(sender)
+
+    def _unload(self, room):
+        # writes the pending changes
+        room.service.close()
+        with self._lock:
+            del self.rooms[room.id]
+        L().info('room %s unloaded after %.0f s, %.2f s cpu, %d frames'%(
+            room.id, time.monotonic() - room.loaded_at, room.cpu_s, room.frames))
+
+    def _housekeeping(self):
+        now = time.monotonic()
+        self._next_check = now + self.check_interval
+        for room in list(self.rooms.values()):
+            if not room.members and now - room.last_active >= self.idle_timeout:
+                self._unload(room)
+        if self.log_interval and now >= self._next_log:
+            self._next_log = now + self.log_interval
+            self.log_stats()
+
+    def _save_loop(self):
+        while not self._stop_saving.wait(self.save_interval):
+            with self._lock:
+                rooms = list(self.rooms.values())
+            for room in rooms:
+                room.service.autosave()
+
+    def room_stats(self):
+        '''returns {room id: {players, frames, cpu_s, loaded_s, idle_s}} of the loaded rooms.'''
+        now = time.monotonic()
+        return {room_id: room.stats(now) for room_id, room in self.rooms.items()}
+
+    def log_stats(self, top=10):
+        '''logs the rooms using the most CPU time.'''
+        stats = sorted(self.room_stats().items(), key=lambda item: item[1]['cpu_s'], reverse=True)
+        lines = [
+            '  %-20s %3d players %8d frames %8.2f s cpu'%(room_id, s['players'], s['frames'], s['cpu_s'])
+            for room_id, s in stats[:top]
+        ]
+        L().info('%d rooms, %d players, image cache %.1f MB (%d hits, %d misses)%s'%(
+            len(self.rooms), len(self._members), self.image_cache.size / 1e6,
+            self.image_cache.hits, self.image_cache.misses,
+            ''.join('\n' + line for line in lines)
+        ))
+
+    def close(self):
+        '''saves and unloads all rooms.'''
+        self._stop_saving.set()
+        self._saver.join()
+        for room in list(self.rooms.values()):
+            self._unload(room)
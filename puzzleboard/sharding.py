@@ -0,0 +1,323 @@
+'''ShardServer: the rooms of a multi-room server, spread over worker processes.
+
+The front-end process accepts the connections (transport, compression)
+and runs the ShardServer as api of its transport. Each room is assigned
+to one of the worker processes, the one with the fewest rooms at the
+time the room is first joined; the assignment is kept. A worker runs a
+RoomServer (see rooms.py) for its rooms, so puzzle logic, encoding and
+decoding run in parallel on several cores.
+
+Front end and workers talk over a socketpair each. Messages are wrapped
+in envelopes
+
+    <kind: 1 byte> <names length: 4 bytes> <data length: 4 bytes> <names> <data>
+
+(lengths big endian). names is the sender, or the receivers separated by
+newlines. The front end passes only complete messages (lines) of a
+sender; it does not decode them, except before the sender joined a room.
+
+Workers are started with fork, i.e. POSIX only. A worker that dies is not
+restarted; the connections in its rooms are closed.
+
+stdio commands: quit (saves all rooms), get_room_stats (answered by each
+worker for its rooms).
+'''
+import logging
+L = lambda: logging.getLogger(__name__)
+
+import os
+import socket
+import struct
+import threading
+import multiprocessing
+
+from neatocom.transports import Transport
+
+from .rooms import LobbyAPI, RoomServer, room_folder
+
+__all__ = [
+    'ShardServer',
+]
+
+_HEADER = struct.Struct('>BII')
+# front end -> worker
+DATA, FORGET, QUIT = 1, 2, 3
+# worker -> front end
+SEND, CLOSE = 4, 5
+
+
+def _envelope(kind, names=b'', data=b''):
+    return _HEADER.pack(kind, len(names), len(data)) + names + data
+
+def _read_envelopes(sock):
+    '''generator of (kind, names, data) received on sock, until EOF.'''
+    buf = bytearray()
+    while True:
+        try:
+            chunk = sock.recv(1 << 18)
+        except OSError:
+            return
+        if not chunk:
+            return
+        buf += chunk
+        start = 0
+        while len(buf) - start >= _HEADER.size:
+            kind, nlen, dlen = _HEADER.unpack_from(buf, start)
+            end = start + _HEADER.size + nlen + dlen
+            if len(buf) < end:
+                break
+            names_end = start + _HEADER.size + nlen
+            yield kind, bytes(buf[start + _HEADER.size:names_end]), bytes(buf[names_end:end])
+            start = end
+        del buf[:start]
+
+
+class _WorkerTransport(Transport):
+    '''transport of a worker process: the socket to the front end.'''
+    def __init__(self, sock):
+        Transport.__init__(self)
+        self.sock = sock
+        self._lock = threading.Lock()
+        # sender -> undecoded rest
+        self.leftovers = {}
+
+    def run(self):
+        self.running = True
+        for kind, name, data in _read_envelopes(self.sock):
+            sender = name.decode('utf8')
+            if kind == DATA:
+                leftover = self.received(sender, self.leftovers.pop(sender, b'') + data)
+                if leftover:
+                    self.leftovers[sender] = leftover
+            elif kind == FORGET:
+                self.leftovers.pop(sender, None)
+                self.forget(sender)
+            elif kind == QUIT:
+                break
+            if not self.running:
+                break
+        self.running = False
+
+    def _post(self, envelope):
+        with self._lock:
+            self.sock.sendall(envelope)
+
+    def send(self, data, receivers=None):
+        if receivers is None:
+            names = b''
+        elif isinstance(receivers, str):
+            names = receivers.encode('utf8')
+        else:
+            names = '\n'.join(receivers).encode('utf8')
+        self._post(_envelope(SEND, names, data))
+
+    def close(self, name):
+        self._post(_envelope(CLOSE, name.encode('utf8')))
+
+
+def _worker_main(sock, others, folder, options):
+    # sockets of the other workers, inherited by fork
+    for other in others:
+        other.close()
+    transport = _WorkerTransport(sock)
+    server = RoomServer(
+        folder,
+        transport=transport,
+        close_handler=transport.close,
+        quit_handler=transport.stop,
+        **options
+    )
+    transport.run()
+    server.close()
+    sock.close()
+
+
+class _Worker(object):
+    '''front end side of a worker process.'''
+    def __init__(self, index, process, sock):
+        self.index = index
+        self.process = process
+        self.sock = sock
+        self.alive = True
+        self._lock = threading.Lock()
+        self.senders = set()
+        self.rooms = set()
+
+    def post(self, kind, name, data=b''):
+        envelope = _envelope(kind, name.encode('utf8'), data)
+        with self._lock:
+            if not self.alive:
+                return
+            try:
+                self.sock.sendall(envelope)
+            except OSError as e:
+                L().error('worker %d: %s'%(self.index, e))
+                self.alive = False
+
+
+class ShardServer(object):
+    '''api of the front-end transport, dispatching to worker processes.
+
+    folder, default_room: see RoomServer; further keyword arguments are
+    passed to the RoomServer of each worker.
+    workers: number of worker processes, default: one per CPU.
+    '''
+    def __init__(self, folder, codec, transport, close_handler, quit_handler,
+                 workers=None, default_room=None, **room_options):
+        self.folder = folder
+        self.codec = codec
+        self.transport = transport
+        self.close_handler = close_handler
+        self.quit_handler = quit_handler
+        self.default_room = default_room
+        # room id -> _Worker
+        self._room_workers = {}
+        # sender -> _Worker
+        self._members = {}
+        self._lock = threading.Lock()
+        self._running = True
+
+        room_options = dict(room_options, codec=codec, default_room=default_room)
+        context = multiprocessing.get_context('fork')
+        self.workers = []
+        for index in range(workers or os.cpu_count() or 1):
+            front, back = socket.socketpair()
+            process = context.Process(
+                target=_worker_main,
+                args=(back, [worker.sock for worker in self.workers] + [front], folder, room_options),
+                name='puzzleboard-worker%d'%index,
+                daemon=True,
+            )
+            process.start()
+            back.close()
+            self.workers.append(_Worker(index, process, front))
+        for worker in self.workers:
+            thread = threading.Thread(target=self._read_worker, args=(worker,), name='%s-reader'%worker.process.name)
+            thread.daemon = True
+            thread.start()
+        L().info('started %d worker processes'%len(self.workers))
+
+        transport.set_api(self)
+        self.lobby = LobbyAPI(codec=codec, transport=None)
+        self.lobby.quit.connect(self.on_quit)
+        self.lobby.connect.connect(self.on_connect)
+        self.lobby.get_room_stats.connect(self.on_get_room_stats)
+
+    def handle_received(self, sender, data):
+        worker = self._members.get(sender)
+        if worker is None:
+            return self._lobby_received(sender, data)
+        end = data.rfind(b'\n') + 1
+        if end:
+            worker.post(DATA, sender, data[:end])
+        return data[end:]
+
+    def _lobby_received(self, sender, data):
+        # see RoomServer._lobby_received
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].split(b'\n')[:-1]
+        for i, line in enumerate(lines):
+            self.lobby.handle_received(sender, line + b'\n')
+            worker = self._members.get(sender)
+            if worker is not None:
+                worker.post(DATA, sender, b'\n'.join(lines[i:]) + b'\n')
+                break
+        return data[end:]
+
+    def forget(self, sender):
+        '''the connection of sender was lost.'''
+        with self._lock:
+            worker = self._members.pop(sender, None)
+            if worker is None:
+                return
+            worker.senders.discard(sender)
+        worker.post(FORGET, sender)
+
+    # ---- lobby ----
+
+    def on_quit(self, sender):
+        if sender!='stdio':
+            L().warning('quit command only allowed from stdio')
+            return
+        L().info("invoke quit")
+        self._running = False
+        self.quit_handler()
+
+    def on_connect(self, sender, name, room=None):
+        if sender=='stdio':
+            L().warning('stdio cannot join a room')
+            return
+        room_id = room or self.default_room
+        worker = self._room_workers.get(room_id)
+        if worker is None or not worker.alive:
+            if room_folder(self.folder, room_id) is None:
+                L().warning('%s (%s) asked for unknown room %r'%(sender, name, room_id))
+                self.close_handler(sender)
+                return
+            worker = min(
+                (w for w in self.workers if w.alive),
+                key=lambda w: len(w.rooms),
+                default=None
+            )
+            if worker is None:
+                L().error('no worker left for room %s'%room_id)
+                self.close_handler(sender)
+                return
+            worker.rooms.add(room_id)
+            self._room_workers[room_id] = worker
+            L().info('room %s assigned to worker %d'%(room_id, worker.index))
+        with self._lock:
+            worker.senders.add(sender)
+            self._members[sender] = worker
+
+    def on_get_room_stats(self, sender):
+        data = self.codec.encode('get_room_stats', kwargs={})
+        for worker in self.workers:
+            worker.post(DATA, sender, data)
+
+    # ---- workers ----
+
+    def _read_worker(self, worker):
+        for kind, names, data in _read_envelopes(worker.sock):
+            if not self._running:
+                # quitting, the transport may be stopped already
+                continue
+            try:
+                self._forward(worker, kind, names, data)
+            except RuntimeError:
+                # event loop closed meanwhile
+                if self._running:
+                    raise
+        with worker._lock:
+            worker.alive = False
+        if not self._running:
+            return
+        with self._lock:
+            lost = list(worker.senders)
+        if lost:
+            L().error('worker %d ended, closing %d connections'%(worker.index, len(lost)))
+        for sender in lost:
+            self.close_handler(sender)
+
+    def _forward(self, worker, kind, names, data):
+        if kind == SEND:
+            if names:
+                receivers = names.decode('utf8').split('\n')
+            else:
+                with self._lock:
+                    receivers = list(worker.senders)
+            self.transport.send(data, receivers=receivers)
+        elif kind == CLOSE:
+            self.close_handler(names.decode('utf8'))
+
+    def close(self):
+        '''stops the workers; they save their rooms.'''
+        self._running = False
+        for worker in self.workers:
+            worker.post(QUIT, '')
+        for worker in self.workers:
+            worker.process.join(60)
+            if worker.process.is_alive():
+                L().error('worker %d did not stop, terminating'%worker.index)
+                worker.process.terminate()
+            worker.sock.close()
@@ -0,0 +1,210 @@
+'''SpatialGrid: uniform grid index over axis-aligned boxes.
+
+Items (clusters) are stored with their bounding box (x0, y0, x1, y1) in
+every grid cell the box touches. Items that would touch more than
+max_cells cells (big clusters) are kept in a separate set instead, which
+every query checks; there are only few of them.
+
+Queries:
+ * rect(x0, y0, x1, y1): items whose box intersects the rectangle
+ * nearest(x, y): the item whose box is closest to the point
+ * free_area(width, height, x, y): a free rectangle near the point
+'''
+from math import floor, hypot
+
+__all__ = [
+    'SpatialGrid',
+]
+
+
+class SpatialGrid(object):
+    def __init__(self, cell_size=256., max_cells=64):
+        self.cell_size = float(cell_size)
+        self.max_cells = max_cells
+        # (i, j) -> set of items
+        self._cells = {}
+        # item -> (box, cell range or None for large items)
+        self._items = {}
+        self._large = set()
+        # cell range ever used (grows only); bounds the searches
+        self._bounds = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def box(self, item):
+        return self._items[item][0]
+
+    def _range(self, x0, y0, x1, y1):
+        s = self.cell_size
+        return floor(x0 / s), floor(y0 / s), floor(x1 / s), floor(y1 / s)
+
+    def insert(self, item, box):
+        cells = self._range(*box)
+        i0, j0, i1, j1 = cells
+        if self._bounds is None:
+            self._bounds = cells
+        else:
+            b = self._bounds
+            if i0 < b[0] or j0 < b[1] or i1 > b[2] or j1 > b[3]:
+                self._bounds = (min(i0, b[0]), min(j0, b[1]), max(i1, b[2]), max(j1, b[3]))
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > self.max_cells:
+            self._large.add(item)
+            cells = None
+        else:
+            grid = self._cells
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    cell = grid.get((i, j))
+                    if cell is None:
+                        grid[(i, j)] = {item}
+                    else:
+                        cell.add(item)
+        self._items[item] = (box, cells)
+
+    def remove(self, item):
+        box, cells = self._items.pop(item)
+        if cells is None:
+            self._large.discard(item)
+            return
+        grid = self._cells
+        i0, j0, i1, j1 = cells
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                cell = grid[(i, j)]
+                cell.discard(item)
+                if not cell:
+                    del grid[(i, j)]
+
+    def update(self, item, box):
+        '''inserts item or moves it to box.'''
+        old = self._items.get(item)
+        if old is not None:
+            if old[1] is not None and old[1] == self._range(*box):
+                # same cells
+                self._items[item] = (box, old[1])
+                return
+            self.remove(item)
+        self.insert(item, box)
+
+    def clear(self):
+        self._cells.clear()
+        self._items.clear()
+        self._large.clear()
+        self._bounds = None
+
+    def rect(self, x0, y0, x1, y1):
+        '''returns the set of items whose box intersects the rectangle.'''
+        i0, j0, i1, j1 = self._range(x0, y0, x1, y1)
+        if self._bounds is not None:
+            b = self._bounds
+            i0, j0, i1, j1 = max(i0, b[0]), max(j0, b[1]), min(i1, b[2]), min(j1, b[3])
+        candidates = set(self._large)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._cells):
+            # fewer occupied cells than cells in the rectangle
+            for (i, j), cell in self._cells.items():
+                if i0 <= i <= i1 and j0 <= j <= j1:
+                    candidates |= cell
+        else:
+            grid = self._cells
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    cell = grid.get((i, j))
+                    if cell:
+                        candidates |= cell
+        items = self._items
+        result = set()
+        for item in candidates:
+            bx0, by0, bx1, by1 = items[item][0]
+            if bx0 <= x1 and x0 <= bx1 and by0 <= y1 and y0 <= by1:
+                result.add(item)
+        return result
+
+    def nearest(self, x, y, exclude=()):
+        '''returns (item, distance) for the item whose box is closest to (x, y),
+        distance 0 meaning the point is inside. (None, None) if there is none.'''
+        best, best_d = None, None
+        for item in self._large:
+            if item in exclude:
+                continue
+            d = _distance(self._items[item][0], x, y)
+            if best_d is None or d < best_d:
+                best, best_d = item, d
+        if self._bounds is None:
+            return best, best_d
+        s = self.cell_size
+        ci, cj = floor(x / s), floor(y / s)
+        b = self._bounds
+        # rings beyond this one contain no cells
+        max_ring = max(ci - b[0], cj - b[1], b[2] - ci, b[3] - cj, 0)
+        grid, items = self._cells, self._items
+        for ring in range(max_ring + 1):
+            # everything in this ring is at least (ring - 1) * s away
+            if best_d is not None and best_d <= (ring - 1) * s:
+                break
+            for key in _ring_cells(ci, cj, ring):
+                cell = grid.get(key)
+                if not cell:
+                    continue
+                for item in cell:
+                    if item in exclude:
+                        continue
+                    d = _distance(items[item][0], x, y)
+                    if best_d is None or d < best_d:
+                        best, best_d = item, d
+        return best, best_d
+
+    def free_area(self, width, height, x, y, gap=0., exclude=(), step=None):
+        '''returns (x0, y0), the corner of a width x height rectangle which
+        is at least gap away from all boxes (except those of exclude).
+
+        Candidates are centered around (x, y) on a lattice with spacing
+        step (default: half the smaller side, at least a cell); the
+        first free one on the closest ring is taken.
+        '''
+        if step is None:
+            step = max(min(width, height) / 2., self.cell_size)
+        if self._bounds is None:
+            return x - width / 2., y - height / 2.
+        s = self.cell_size
+        b = self._bounds
+        # far enough to be outside of all boxes
+        extent = max(
+            abs(x - b[0] * s), abs(x - (b[2] + 1) * s),
+            abs(y - b[1] * s), abs(y - (b[3] + 1) * s),
+        ) + max(width, height) + gap
+        max_ring = int(extent / step) + 1
+        for ring in range(max_ring + 1):
+            candidates = sorted(
+                _ring_cells(0, 0, ring),
+                key=lambda ij: hypot(ij[0], ij[1])
+            )
+            for i, j in candidates:
+                x0 = x + i * step - width / 2.
+                y0 = y + j * step - height / 2.
+                hits = self.rect(x0 - gap, y0 - gap, x0 + width + gap, y0 + height + gap)
+                if not hits or hits <= set(exclude):
+                    return x0, y0
+        return x0, y0
+
+
+def _ring_cells(ci, cj, ring):
+    '''the cells at chebyshev distance ring from (ci, cj).'''
+    if ring == 0:
+        yield ci, cj
+        return
+    for i in range(ci - ring, ci + ring + 1):
+        yield i, cj - ring
+        yield i, cj + ring
+    for j in range(cj - ring + 1, cj + ring):
+        yield ci - ring, j
+        yield ci + ring, j
+
+def _distance(box, x, y):
+    x0, y0, x1, y1 = box
+    dx = x0 - x if x < x0 else (x - x1 if x > x1 else 0.)
+    dy = y0 - y if y < y0 else (y - y1 if y > y1 else 0.)
+    return hypot(dx, dy)
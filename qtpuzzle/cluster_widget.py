@@ -183,6 +183,18 @@ class ClusterWidget(QGraphicsWidget):
             return
         o.setClusterPosition(x, y, rotation)
     
+    def onClusterGroupMoved(o, dx, dy, rotate, pivot_x, pivot_y):
+        '''Apply a rigid group move (see PuzzleAPI.move_group) to the last known server position.'''
+        if o._grabbed_locally:
+            pos, rotation = o._last_server_pos, o._last_server_rotation
+        else:
+            pos, rotation = o.pos(), o.clusterRotation()
+        x, y = pos.x() - pivot_x, pos.y() - pivot_y
+        if rotate:
+            sinval, cosval = sin(2.*pi*rotate/o.rotations), cos(2.*pi*rotate/o.rotations)
+            x, y = x * cosval + y * sinval, -x * sinval + y * cosval
+        o.onClusterMoved(pivot_x + x + dx, pivot_y + y + dy, (rotation + rotate) % o.rotations)
+
     def onClusterDropped(o):
         '''reset all grab state'''
         o._grabbed_by = None
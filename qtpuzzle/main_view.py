@@ -1,6 +1,6 @@
 import logging as L
 
-from qtpy.QtCore import Qt
+from qtpy.QtCore import Qt, Signal, QTimer
 from qtpy.QtGui import QPainter
 from qtpy.QtWidgets import QGraphicsView
 from qtpy.QtOpenGL import QGLWidget
@@ -8,6 +8,10 @@ from qtpy.QtOpenGL import QGLWidget
 from .input_tracker import InputTracker
 
 class MainView(QGraphicsView):
+    # visible scene rect x, y, width, height; at most every REPORT_INTERVAL ms
+    viewportChanged = Signal(float, float, float, float)
+    REPORT_INTERVAL = 250
+
     def __init__(self, *args):
         QGraphicsView.__init__(self, *args)
         #self._input_tracker = InputTracker(self, accepts=[Qt.Key_Space])
@@ -20,9 +24,33 @@ class MainView(QGraphicsView):
         self.pan_active = False
         self._prev_mouse_pos = None
         self._last_zoom_level = 1.0
+        self._reported_rect = None
+        self._report_timer = QTimer(self)
+        self._report_timer.setSingleShot(True)
+        self._report_timer.setInterval(self.REPORT_INTERVAL)
+        self._report_timer.timeout.connect(self._report_viewport)
         
     def resizeEvent(self, ev):
-        pass
+        self.viewportChangedLater()
+        
+    def viewportChangedLater(self, force=False):
+        '''schedules emitting viewportChanged, unless already pending.
+        force: emit even if the rect did not change since the last time.'''
+        if force:
+            self._reported_rect = None
+        if not self._report_timer.isActive():
+            self._report_timer.start()
+            
+    def _report_viewport(self):
+        r = self.mapToScene(self.viewport().rect()).boundingRect()
+        rect = (r.x(), r.y(), r.width(), r.height())
+        if rect != self._reported_rect:
+            self._reported_rect = rect
+            self.viewportChanged.emit(*rect)
+            
+    def scrollContentsBy(self, dx, dy):
+        QGraphicsView.scrollContentsBy(self, dx, dy)
+        self.viewportChangedLater()
         
     def wheelEvent(self, ev):
         self.lastMouseMoveScenePoint = self.mapToScene(ev.pos())
@@ -30,17 +58,20 @@ class MainView(QGraphicsView):
         delta = 2 ** (ev.angleDelta().y() / 240.)
         self.scale(delta, delta)
         self._is_view_all = False
+        self.viewportChangedLater()
         
     def viewAll(self):
         self._last_zoom_level = self.transform().m11()
         self.fitInView(self.scene().sceneRect(), Qt.KeepAspectRatio)
         self._is_view_all = True
+        self.viewportChangedLater()
         
     def zoomOnMouse(self):
         self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
         self.resetTransform()
         self.scale(self._last_zoom_level, self._last_zoom_level)
         self._is_view_all=False
+        self.viewportChangedLater()
         
     def isViewAll(self):
         return self._is_view_all
@@ -64,4 +95,5 @@ class MainView(QGraphicsView):
             delta /= self.transform().m11()
             self.translate(delta.x(), delta.y())
             self._is_view_all = False
+            self.viewportChangedLater()
         self._prev_mouse_pos = ev.pos()
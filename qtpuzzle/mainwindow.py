@@ -58,6 +58,7 @@ class MainWindow(QMainWindow):
         self.ui.actionAutosave.toggled.connect(self.toggle_autosave)
         self.ui.menuNetwork.aboutToShow.connect(self.refreshNetworkMenu)
         self.ui.menuNetwork.aboutToHide.connect(self.stopNetworkMenu)
+        self.ui.mainView.viewportChanged.connect(self.report_viewport)
 
         self._slicer = None
         
@@ -80,6 +81,7 @@ class MainWindow(QMainWindow):
             self.client = self.initPuzzleClient(self.nickname, client_type, address)
             self.client.connect(name=self.nickname)
             self.scene = PuzzleScene(self.ui.mainView, self.client, self)
+            self.ui.mainView.viewportChangedLater(force=True)
         else:
             # set dummy scene
             self.scene = QGraphicsScene()
@@ -89,10 +91,15 @@ class MainWindow(QMainWindow):
         self.ui.actionReset.setEnabled(client_type=='local')
         self.ui.mainView.setScene(self.scene)
         
+    def report_viewport(self, x, y, width, height):
+        # only network games profit from fewer updates
+        if self.client_type == 'tcp':
+            self.client.viewport(x=x, y=y, width=width, height=height)
+        
     def deinitPuzzleClient(self):
         L().info('deinit puzzle client')
         if self.client_type == 'local':
-            self.do_autosave('')
+            # the server saves pending changes itself when quitting.
             self.client.quit()
             self.client.transport.stop()
         elif self.client_type == 'tcp':
@@ -115,14 +122,12 @@ class MainWindow(QMainWindow):
         codec = TerseCodec()
         client = PuzzleClient(codec, transport, nickname)
         client.connected.connect(self.on_player_connect)
-        client.dropped.connect(self.do_autosave)
-        client.joined.connect(self.do_autosave)
-        client.clusters.connect(self.do_autosave)
         client.solved.connect(self.on_solved)
         transport.start()
         if client_type=='local':
             self.own_servername = nickname+"'s server"
             client.servername(name=self.own_servername)
+            client.autosave(enabled=self.ui.actionAutosave.isChecked())
         return client
     
     def change_nickname(self):
@@ -214,6 +219,8 @@ class MainWindow(QMainWindow):
     def toggle_autosave(self):
         settings = QSettings()
         settings.setValue("Autosave", self.ui.actionAutosave.isChecked())
+        if self.client_type == 'local':
+            self.client.autosave(enabled=self.ui.actionAutosave.isChecked())
         
     def toggle_fullscreen(self, fs='auto'):
         if fs=='auto' or fs=='toggle':
@@ -253,11 +260,6 @@ class MainWindow(QMainWindow):
             return
         self.scene.clearSelection()
         
-    def do_autosave(self, sender, **kwargs):
-        if self.ui.actionAutosave.isChecked():
-            L().debug('autosaving')
-            self.client.save_puzzle()
-        
     def on_solved(self, sender):
         QMessageBox.information(self, "Puzzle solved.", "You did it!")
         
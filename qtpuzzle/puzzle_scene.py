@@ -16,6 +16,7 @@ from .input_tracker import InputTracker
 from .cluster_widget import ClusterWidget
 from .select_by_color_dlg import select_by_color_dlg
 #from puzzleboard.puzzle_board import PuzzleBoard
+from puzzleboard.cluster import iter_cluster_columns
 
 
 L = lambda: logging.getLogger(__name__)
@@ -62,6 +63,7 @@ class PuzzleScene(QGraphicsScene):
         o.client.clusters.connect(o.OnClustersChanged)
         o.client.grabbed.connect(o.onClustersGrabbed)
         o.client.moved.connect(o.onClustersMoved)
+        o.client.group_moved.connect(o.onClustersGroupMoved)
         o.client.dropped.connect(o.onClustersDropped)
         o.client.joined.connect(o.onClustersJoined)
         # request puzzle data from server
@@ -73,6 +75,11 @@ class PuzzleScene(QGraphicsScene):
         o.grabbed_widgets = {}
         # number of rotations (relative to initial rotation) having been applied to the grabbed widgets.
         o._move_rotation = 0
+        # cursor position of the grabbed group (pivot for group moves)
+        o._move_pos = None
+        # _move_rotation and _move_pos as of the last position update sent
+        o._sent_rotation = 0
+        o._sent_pos = None
         # time of last position update (for rate limit)
         o._last_move_send_time = 0
 
@@ -119,21 +126,21 @@ class PuzzleScene(QGraphicsScene):
         
     def _create_clusters(o, cluster_data, piece_defs=None, piece_items=None):
         pieces = []
-        for cluster in cluster_data.clusters:
+        for cluster in iter_cluster_columns(cluster_data):
             if piece_defs:
-                pieces = [piece_defs[pid] for pid in cluster.pieces]
+                pieces = [piece_defs[pid] for pid in cluster['pieces']]
             cw = ClusterWidget(
-                clusterid=cluster.id,
+                clusterid=cluster['id'],
                 pieces=pieces,
                 rotations=o.rotations,
                 client=o.client
             )
             if piece_items:
-                for pid in cluster.pieces:
+                for pid in cluster['pieces']:
                     piece_items[pid].copy_to(cw)
             o.addItem(cw)
-            o.cluster_map[cluster.id] = cw
-            cw.setClusterPosition(cluster.x, cluster.y, cluster.rotation)
+            o.cluster_map[cluster['id']] = cw
+            cw.setClusterPosition(cluster['x'], cluster['y'], cluster['rotation'])
         
     def _get_next_pieces(o):
         if o._pieces_to_get:
@@ -205,7 +212,8 @@ class PuzzleScene(QGraphicsScene):
         for widget in widgets:
             if widget.grabLocally(scene_pos):
                 o.grabbed_widgets[widget.clusterid] = widget
-        o._move_rotation = 0
+        o._move_rotation = o._sent_rotation = 0
+        o._move_pos = o._sent_pos = scene_pos
         o._last_move_send_time = time()
         if o.grabbed_widgets:
             # send grab to the server
@@ -214,8 +222,9 @@ class PuzzleScene(QGraphicsScene):
         L().debug("lift: " + o.grabbed_widgets.__repr__())
 
     def dropGrabbedWidgets(o):
-        # Send last position unconditionally
-        o.sendPositions()
+        # Send last position unconditionally, as absolute positions so that
+        # rounding errors of the group moves do not accumulate.
+        o.sendPositions(absolute=True)
         o.client.drop(clusters=list(o.grabbed_widgets.keys()))
         o.grabbed_widgets = {}
         L().debug('dropped')
@@ -228,6 +237,8 @@ class PuzzleScene(QGraphicsScene):
         '''
         for widget in o.grabbed_widgets.values():
             widget.repositionGrabbedPiece(scene_pos, rotate)
+        o._move_rotation += rotate
+        o._move_pos = scene_pos
         t = time()
         if t-o._last_move_send_time > MOVE_SEND_INTERVAL:
             o.sendPositions()
@@ -235,7 +246,15 @@ class PuzzleScene(QGraphicsScene):
         # disabled - leads to endless recursion due to triggering mouse move event
         #o.updateSceneRect()
             
-    def sendPositions(o):
+    def sendPositions(o, absolute=False):
+        '''send position update of the grabbed widgets.
+
+        By default, this is a single group move relative to the last update.
+        absolute=True sends the position of each cluster instead.
+        '''
+        if not absolute:
+            o.sendGroupMove()
+            return
         positions = {}
         for widget in o.grabbed_widgets.values():
             new_pos = widget.pos()
@@ -244,6 +263,27 @@ class PuzzleScene(QGraphicsScene):
                 rotation += widget.rotations
             positions[str(widget.clusterid)] = {'x': new_pos.x(), 'y': new_pos.y(), 'rotation': rotation}
         o.client.move(cluster_positions=positions)
+        o._sent_rotation = o._move_rotation
+        o._sent_pos = o._move_pos
+
+    def sendGroupMove(o):
+        '''All grabbed widgets move rigidly with the cursor. Since the last update,
+        they were rotated about the cursor's old position, then moved along
+        with the cursor.
+        '''
+        if not o.grabbed_widgets:
+            return
+        rotate = o._move_rotation - o._sent_rotation
+        delta = o._move_pos - o._sent_pos
+        if not rotate and delta.isNull():
+            return
+        o.client.move_group(
+            clusters=list(o.grabbed_widgets.keys()),
+            dx=delta.x(), dy=delta.y(), rotate=rotate,
+            pivot_x=o._sent_pos.x(), pivot_y=o._sent_pos.y()
+        )
+        o._sent_rotation = o._move_rotation
+        o._sent_pos = o._move_pos
         
     def selectionRearrange(o, pos=None):
         items = o.selectedItems()
@@ -285,6 +325,11 @@ class PuzzleScene(QGraphicsScene):
                 rotation=position.rotation
             )
     
+    def onClustersGroupMoved(o, sender, clusters, dx, dy, rotate, pivot_x, pivot_y):
+        '''Server notifies that somebody (maybe me) has moved a group of clusters.'''
+        for clusterid in clusters:
+            o.cluster_map[clusterid].onClusterGroupMoved(dx, dy, rotate, pivot_x, pivot_y)
+
     def onClustersDropped(o, sender, clusters):
         for clusterid in clusters:
             o.cluster_map[clusterid].onClusterDropped()
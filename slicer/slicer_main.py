@@ -9,7 +9,7 @@ from qtpy.QtWidgets import QDialog, QFileDialog
 
 from puzzleboard.puzzle_board import PuzzleBoard
 from puzzleboard.piece import Piece
-from puzzleboard.link import Link
+from puzzleboard.link import Link, link_anchor
 
 from .goldberg_engine import GoldbergEngine, GBEngineSettings
 from .utils import loadUi
@@ -135,6 +135,7 @@ class SlicerMain(QDialog):
         o.board.imagefolder=os.path.join(dst_path, 'pieces')
         engine = GoldbergEngine(o.add_piece_func, o.add_relation_func, o.settings, outline_only=False)
         engine(grid_generator.generate_grid, piece_count, o.source_image.width(), o.source_image.height())
+        o.set_link_anchors()
         o.board.reset_puzzle()
         o.board.save_puzzle()
         o.board.save_state()
@@ -200,9 +201,14 @@ class SlicerMain(QDialog):
         o.board.links.append(Link(
             id1=piece_id_1,
             id2=piece_id_2,
-            x=0, #FIXME
-            y=0, #FIXME
         ))
+        
+    def set_link_anchors(o):
+        # grids may report a relation before both pieces are cut,
+        # so the anchors are set once all pieces exist.
+        pieces_by_id = {piece.id: piece for piece in o.board.pieces}
+        for link in o.board.links:
+            link.x, link.y = link_anchor(pieces_by_id[link.id1], pieces_by_id[link.id2])
     
 def _safeQImageCopy(source, rect):
     '''A modified version of QImage::copy, which avoids rendering errors even if rect is outside the bounds of the source image.'''
@@ -0,0 +1,219 @@
+'''
+Micro-benchmark for the neatocom codecs on realistic PuzzleAPI messages.
+
+Cases:
+ * puzzle: puzzle + cluster data of a synthetic puzzle (see puzzle_fixtures)
+ * pixmaps: piece_pixmaps with several MB of image bytes
+ * move: a single small `moved` message, as sent at high rate
+ * stream: a stream of moves with one puzzle message in between, received
+   in TCP-sized chunks through a ReceiveBuffer (partial frames)
+
+For each codec and case, encode and decode time (best of --repeat runs),
+throughput, encoded size and peak allocation (tracemalloc, measured in a
+separate run) are reported.
+
+Run from the repository root:
+
+    python -m tests.neatocom_codec_benchmark
+    python -m tests.neatocom_codec_benchmark --save baseline.json
+    ... change the codec ...
+    python -m tests.neatocom_codec_benchmark --compare baseline.json
+
+--compare prints the ratio against the baseline for every figure and exits
+with status 1 if anything got slower or bigger than --threshold.
+'''
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+from neatocom.codecs import JsonCodec, TerseCodec
+from neatocom.transports import ReceiveBuffer
+from .puzzle_fixtures import make_board
+
+CODECS = {
+    'terse': TerseCodec,
+    'json': JsonCodec,
+}
+
+# figures compared in --compare mode; all of them are "lower is better".
+FIGURES = ['encode_s', 'decode_s', 'size', 'encode_peak', 'decode_peak']
+
+
+def _move(rng):
+    return 'moved', {'cluster_positions': {
+        str(rng.randrange(10000)): {
+            'x': rng.uniform(-5000, 5000), 'y': rng.uniform(-5000, 5000), 'rotation': rng.randrange(4)
+        }
+    }}
+
+def make_cases(pieces=2000, pixmaps_mb=4, stream_moves=2000, chunk=1460, seed=1):
+    '''returns {name: (kind, payload)}. kind is 'message' (payload = method, kwargs)
+    or 'stream' (payload = list of messages, chunk size).
+    '''
+    rng = random.Random(seed)
+    board = make_board(pieces, seed=seed)
+    puzzle = ('puzzle', {
+        'puzzle_data': board.puzzle_as_jsonstruct(),
+        'cluster_data': board.clusters_as_jsonstruct(),
+    })
+    n_images = 16
+    size = pixmaps_mb * (1 << 20) // n_images
+    pixmaps = ('piece_pixmaps', {'pixmaps': {
+        str(i): bytes(rng.getrandbits(8) for _ in range(1024)) * (size // 1024)
+        for i in range(n_images)
+    }})
+    stream = [_move(rng) for i in range(stream_moves)]
+    stream.insert(stream_moves // 2, puzzle)
+    return {
+        'puzzle': ('message', puzzle),
+        'pixmaps': ('message', pixmaps),
+        'move': ('message', _move(rng)),
+        'stream': ('stream', (stream, chunk)),
+    }
+
+
+def _best(func, repeat):
+    '''best wall time of func() over repeat runs. Short functions are run in
+    a loop, so that each run takes at least about 0.05 s.'''
+    t = time.perf_counter()
+    func()
+    once = time.perf_counter() - t
+    number = max(1, int(0.05 / max(once, 1e-7)))
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        for j in range(number):
+            func()
+        elapsed = (time.perf_counter() - t) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def _peak(func):
+    '''peak allocation in bytes during func().'''
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _decode_stream(codec, data, chunk):
+    buffer = ReceiveBuffer()
+    count = 0
+    for i in range(0, len(data), chunk):
+        buffer.feed(data[i:i+chunk])
+        frame = buffer.pop_frame()
+        if frame:
+            messages, leftover = codec.decode(frame)
+            count += len(messages)
+            # unlike a real transport, we know that frames are complete.
+            assert not leftover
+    return count
+
+def measure(codec, kind, payload, repeat):
+    if kind == 'message':
+        method, kwargs = payload
+        data = codec.encode(method, kwargs)
+        encode = lambda: codec.encode(method, kwargs)
+        decode = lambda: codec.decode(data)
+    else:
+        messages, chunk = payload
+        data = b''.join(codec.encode(method, kwargs) for method, kwargs in messages)
+        encode = lambda: [codec.encode(method, kwargs) for method, kwargs in messages]
+        decode = lambda: _decode_stream(codec, data, chunk)
+    return {
+        'encode_s': _best(encode, repeat),
+        'decode_s': _best(decode, repeat),
+        'size': len(data),
+        'encode_peak': _peak(encode),
+        'decode_peak': _peak(decode),
+    }
+
+def run(cases, codecs, repeat):
+    results = {}
+    for codec_name in codecs:
+        codec = CODECS[codec_name]()
+        for case_name, (kind, payload) in cases.items():
+            results['%s/%s'%(codec_name, case_name)] = measure(codec, kind, payload, repeat)
+    return results
+
+
+def _fmt_time(seconds):
+    if seconds < 1e-3:
+        return '%7.1f us'%(seconds * 1e6)
+    return '%7.2f ms'%(seconds * 1e3)
+
+def _fmt_size(n):
+    if n < 1 << 20:
+        return '%7.1f kB'%(n / 1024.)
+    return '%7.2f MB'%(n / float(1 << 20))
+
+def print_results(results):
+    print('%-16s %10s %10s %10s %10s %10s %10s %10s'%(
+        'case', 'encode', 'decode', 'enc MB/s', 'dec MB/s', 'size', 'enc peak', 'dec peak'))
+    for name, r in results.items():
+        print('%-16s %10s %10s %10.1f %10.1f %10s %10s %10s'%(
+            name, _fmt_time(r['encode_s']), _fmt_time(r['decode_s']),
+            r['size'] / r['encode_s'] / 1e6, r['size'] / r['decode_s'] / 1e6,
+            _fmt_size(r['size']), _fmt_size(r['encode_peak']), _fmt_size(r['decode_peak']),
+        ))
+
+def compare(results, baseline, threshold):
+    '''prints ratios current / baseline. Returns list of regressions.'''
+    regressions = []
+    print()
+    print('%-16s '%'vs. baseline' + ' '.join('%11s'%f for f in FIGURES))
+    for name, r in results.items():
+        if name not in baseline:
+            print('%-16s (not in baseline)'%name)
+            continue
+        cells = []
+        for figure in FIGURES:
+            old = baseline[name].get(figure)
+            if not old:
+                cells.append('%11s'%'-')
+                continue
+            ratio = r[figure] / float(old)
+            mark = ' '
+            if ratio > 1 + threshold:
+                mark = '!'
+                regressions.append((name, figure, ratio))
+            cells.append('%10.2fx%s'%(ratio, mark)[-11:])
+        print('%-16s '%name + ' '.join(cells))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='neatocom codec benchmark')
+    parser.add_argument('--codec', choices=sorted(CODECS), action='append', help='default: all')
+    parser.add_argument('--case', action='append', help='puzzle, pixmaps, move, stream; default: all')
+    parser.add_argument('--pieces', type=int, default=2000, help='size of the puzzle message')
+    parser.add_argument('--pixmaps-mb', type=int, default=4, help='size of the piece_pixmaps message')
+    parser.add_argument('--chunk', type=int, default=1460, help='receive chunk size for the stream case')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', metavar='FILE', help='save results as JSON (baseline)')
+    parser.add_argument('--compare', metavar='FILE', help='compare against saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='tolerated relative increase, default 0.1')
+    args = parser.parse_args()
+
+    cases = make_cases(args.pieces, args.pixmaps_mb, chunk=args.chunk)
+    if args.case:
+        cases = {name: cases[name] for name in args.case}
+    results = run(cases, args.codec or sorted(CODECS), args.repeat)
+    print_results(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print()
+            for name, figure, ratio in regressions:
+                print('REGRESSION %s %s: %.2fx'%(name, figure, ratio))
+            sys.exit(1)
@@ -0,0 +1,156 @@
+'''
+Synthetic puzzles for benchmarks and tests, without GUI and source image.
+
+    board = make_board(pieces=5000, grid='hex', seed=1)
+    make_puzzle_folder('/tmp/puz', pieces=5000, grid='rect', seed=1)
+
+or from the command line (repository root):
+
+    python -m tests.puzzle_fixtures /tmp/puz --pieces 5000 --grid cairo
+
+Grids are those of the slicer: rect, hex, cairo, rotrex. They are cut by the
+slicer grid modules (needs qtpy, but no QApplication; piece masks are not
+rendered). Without qtpy only 'rect' is available, as a plain grid.
+
+Piece images are solid-colour placeholder PNGs of the piece bounding box.
+The same seed gives the same puzzle.
+'''
+import os
+import json
+import zlib
+import struct
+import random
+import argparse
+
+from puzzleboard.puzzle_board import PuzzleBoard
+from puzzleboard.piece import Piece
+from puzzleboard.link import Link, link_anchor
+
+GRIDS = ['rect', 'hex', 'cairo', 'rotrex']
+
+
+def placeholder_png(width, height, rgb):
+    '''returns a PNG file (bytes) filled with the color rgb = (r, g, b).'''
+    def chunk(tag, data):
+        return (
+            struct.pack('>I', len(data)) + tag + data
+            + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+        )
+    row = b'\x00' + bytes(rgb) * width
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(row * height))
+        + chunk(b'IEND', b'')
+    )
+
+
+def _cut_plain_rect(pieces, width, height):
+    '''pure-python rectangular grid. Returns rotations, [(id, x0, y0, w, h)], [(id1, id2)]'''
+    nx = max(int(round((pieces * width / height) ** 0.5)), 1)
+    ny = max(int(round(pieces / nx)), 1)
+    w, h = width // nx, height // ny
+    rects = [(x + y*nx, x*w, y*h, w, h) for y in range(ny) for x in range(nx)]
+    relations = (
+        [(x-1 + y*nx, x + y*nx) for y in range(ny) for x in range(1, nx)]
+        + [(x + (y-1)*nx, x + y*nx) for y in range(1, ny) for x in range(nx)]
+    )
+    return 4, rects, relations
+
+
+def _cut_with_slicer(grid, pieces, width, height):
+    '''cuts using the slicer grid module. Returns like _cut_plain_rect.'''
+    from slicer.goldberg_engine import GoldbergEngine
+    from slicer import grid_rect, grid_hex, grid_cairo, grid_rotrex
+    module = {
+        'rect': grid_rect,
+        'hex': grid_hex,
+        'cairo': grid_cairo,
+        'rotrex': grid_rotrex,
+    }[grid]
+    rects, relations = [], []
+
+    class HeadlessEngine(GoldbergEngine):
+        def make_piece_from_path(o, piece_id, qpainter_path):
+            # bounding box only, no mask image
+            r = qpainter_path.boundingRect().toAlignedRect()
+            rects.append((piece_id, r.x(), r.y(), r.width(), r.height()))
+
+    engine = HeadlessEngine(None, lambda id1, id2: relations.append((id1, id2)))
+    engine(module.generate_grid, pieces, width, height)
+    return module.rotations, rects, relations
+
+
+def make_board(pieces=100, grid='rect', seed=0, width=None, height=None, board_class=PuzzleBoard):
+    '''returns a board with about `pieces` pieces, shuffled (reset_puzzle).
+
+    The image size defaults to 4:3 with pieces of about 100x100 pixels.
+    Piece images are named piece<id>.png but not created (see make_puzzle_folder).
+    '''
+    if grid not in GRIDS:
+        raise ValueError('unknown grid %r, choose one of %s'%(grid, GRIDS))
+    if not height:
+        height = int((pieces * 100 * 100 * 3 / 4.) ** 0.5)
+    if not width:
+        width = height * 4 // 3
+    rng = random.Random(seed)
+    # the slicer and reset_puzzle use the global random generator.
+    random.seed(seed)
+    try:
+        import qtpy
+    except ImportError:
+        if grid != 'rect':
+            raise ImportError('grid %r needs qtpy'%grid)
+        rotations, rects, relations = _cut_plain_rect(pieces, width, height)
+    else:
+        rotations, rects, relations = _cut_with_slicer(grid, pieces, width, height)
+
+    pieces = [
+        Piece(
+            id=id, image='piece%d.png'%id, x0=x0, y0=y0, w=w, h=h,
+            dominant_colors=[[rng.randrange(256) for i in range(3)]],
+        )
+        for id, x0, y0, w, h in rects
+    ]
+    pieces_by_id = {piece.id: piece for piece in pieces}
+    board = board_class(
+        name='synthetic %s %d'%(grid, len(rects)),
+        rotations=rotations,
+        pieces=pieces,
+        links=[
+            Link(id1, id2, *link_anchor(pieces_by_id[id1], pieces_by_id[id2]))
+            for id1, id2 in relations
+        ],
+    )
+    board.reset_puzzle()
+    return board
+
+
+def make_puzzle_folder(folder, pieces=100, grid='rect', seed=0, images=True, **kwargs):
+    '''creates a puzzle folder (puzzle.json, clusters.json, pieces/) as
+    the slicer would. Returns the board.
+    images=False skips writing the placeholder images.
+    '''
+    board = make_board(pieces, grid, seed, **kwargs)
+    board.basefolder = folder
+    board.imagefolder = os.path.join(folder, 'pieces')
+    os.makedirs(board.imagefolder, exist_ok=True)
+    if images:
+        for piece in board.pieces:
+            with open(os.path.join(board.imagefolder, piece.image), 'wb') as f:
+                f.write(placeholder_png(max(piece.w, 1), max(piece.h, 1), piece.dominant_colors[0]))
+    board.save_puzzle()
+    board.save_state()
+    return board
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='create a synthetic puzzle folder')
+    parser.add_argument('folder')
+    parser.add_argument('--pieces', type=int, default=100)
+    parser.add_argument('--grid', choices=GRIDS, default='rect')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-images', action='store_true')
+    args = parser.parse_args()
+    board = make_puzzle_folder(args.folder, args.pieces, args.grid, args.seed, images=not args.no_images)
+    print('%s: %d pieces, %d links'%(args.folder, len(board.pieces), len(board.links)))
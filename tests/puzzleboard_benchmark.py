@@ -0,0 +1,464 @@
+'''
+Load generator / benchmark for the puzzleboard service.
+
+Starts a puzzleboard server on a synthetic puzzle (see puzzle_fixtures), connects N simulated
+players over TCP and lets them grab, move and drop clusters (sometimes
+next to a matching neighbour, so that clusters get joined).
+
+Reports request throughput, request latency (time from sending a request
+until its broadcast comes back), messages received by all players and
+server CPU time / peak memory.
+
+Run from the repository root:
+
+    python -m tests.puzzleboard_benchmark --players 20 --pieces 2000 --duration 10
+
+By default the server runs as subprocess (`python -m puzzleboard`), which
+gives exact CPU and memory figures (Linux only). With --inprocess the
+PuzzleService runs in a thread of the benchmark process; CPU and memory
+then include the simulated players.
+
+With --rooms N, the server is started as multi-room server (--rooms=FOLDER)
+with N copies of the puzzle; the players are spread over the rooms.
+--workers M additionally spreads the rooms over M server processes.
+
+With --viewport F, each player reports a random viewport covering the
+fraction F of the board, so that the server filters position updates.
+
+All players run in one Python process and decode every broadcast. With
+many players the load generator itself may become the bottleneck; watch
+the server CPU figure to tell.
+'''
+import os
+import sys
+import time
+import random
+import socket
+from math import sin, cos, pi
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import logging
+L = lambda: logging.getLogger(__name__)
+
+from neatocom.codecs import TerseCodec
+from neatocom.compression import Compression, FramePacker
+from puzzleboard.cluster import iter_cluster_columns
+from .puzzle_fixtures import make_puzzle_folder, GRIDS
+
+# max. offset when dropping next to a neighbour (server snaps at 40)
+SNAP = 10
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = {}
+        self.received = 0
+        self.received_bytes = 0
+        self.timeouts = 0
+        self.joins = 0
+
+    def add_latency(self, method, seconds):
+        self.latencies.setdefault(method, []).append(seconds)
+
+
+class Player(object):
+    '''simulated player. Sends one request at a time and waits for the
+    matching broadcast.'''
+    def __init__(self, name, host, port, stats, seed, join_rate=0.2, moves=5, timeout=5., compress=False, room=None, viewport=None):
+        self.name = name
+        self.viewport = viewport
+        self.room = room
+        self.host, self.port = host, port
+        self.stats = stats
+        self.rng = random.Random(seed)
+        self.join_rate = join_rate
+        self.moves = moves
+        self.timeout = timeout
+        self.codec = TerseCodec()
+        self.compression = Compression(FramePacker(), offer=True) if compress else None
+        self.playerid = None
+        self.held = None
+        self._waiter = None
+        # cluster id -> [x, y, rotation]
+        self.positions = {}
+        # cluster id -> piece ids, piece id -> cluster id
+        self.cluster_pieces = {}
+        self.piece_cluster = {}
+        # piece id -> linked piece ids
+        self.neighbours = {}
+        # piece id -> center of the piece in the image; number of rotations
+        self.piece_centers = {}
+        self.rotations = 1
+
+    def send(self, method, **kwargs):
+        self.writer.write(self.codec.encode(method, kwargs))
+
+    async def request(self, method, predicate, **kwargs):
+        '''sends request, waits until a message matching predicate arrives.
+        Returns the message or None on timeout.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        self._waiter = (predicate, future)
+        t = time.perf_counter()
+        self.send(method, **kwargs)
+        try:
+            msg = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            L().warning('%s: no answer to %s %r'%(self.name, method, kwargs))
+            self.stats.timeouts += 1
+            return None
+        finally:
+            self._waiter = None
+        if msg is not None:
+            self.stats.add_latency(method, time.perf_counter() - t)
+        return msg
+
+    async def _read_loop(self):
+        leftover = b''
+        while True:
+            data = await self.reader.read(1 << 16)
+            if not data:
+                return
+            self.stats.received_bytes += len(data)
+            if self.compression is not None:
+                data, answer = self.compression.received(data)
+            messages, leftover = self.codec.decode(leftover + data)
+            for msg in messages:
+                self.stats.received += 1
+                self._update(msg)
+                if self._waiter:
+                    predicate, future = self._waiter
+                    if not future.done() and predicate(msg):
+                        future.set_result(msg)
+
+    def _update(self, msg):
+        '''keeps track of cluster positions and membership.'''
+        kw = msg.kwargs
+        if msg.method in ('puzzle', 'clusters'):
+            if msg.method == 'puzzle':
+                puzzle = kw['puzzle_data']
+                self.rotations = puzzle['rotations']
+                self.piece_centers = {
+                    p['id']: (p['x0'] + p['w'] / 2., p['y0'] + p['h'] / 2.) for p in puzzle['pieces']
+                }
+                self.neighbours = {}
+                for link in kw['puzzle_data']['links']:
+                    self.neighbours.setdefault(link['id1'], []).append(link['id2'])
+                    self.neighbours.setdefault(link['id2'], []).append(link['id1'])
+            self.positions, self.cluster_pieces, self.piece_cluster = {}, {}, {}
+            for cluster in iter_cluster_columns(kw['cluster_data']):
+                self.positions[cluster['id']] = [cluster['x'], cluster['y'], cluster['rotation']]
+                self.cluster_pieces[cluster['id']] = list(cluster['pieces'])
+                for pid in cluster['pieces']:
+                    self.piece_cluster[pid] = cluster['id']
+        elif msg.method == 'moved':
+            for cid, pos in kw['cluster_positions'].items():
+                if int(cid) in self.positions:
+                    self.positions[int(cid)] = [pos['x'], pos['y'], pos['rotation']]
+        elif msg.method == 'joined':
+            self.stats.joins += 1
+            target = self.cluster_pieces.setdefault(kw['cluster'], [])
+            for cid in kw['joined_clusters']:
+                self.positions.pop(cid, None)
+                for pid in self.cluster_pieces.pop(cid, []):
+                    self.piece_cluster[pid] = kw['cluster']
+                    target.append(pid)
+            pos = kw['position']
+            self.positions[kw['cluster']] = [pos['x'], pos['y'], pos['rotation']]
+            if self.held in kw['joined_clusters'] and self.held != kw['cluster']:
+                # our cluster was absorbed into another one
+                self._lose_held()
+        elif msg.method == 'grabbed':
+            if kw['playerid'] == self.playerid and kw['clusters']:
+                self.held = kw['clusters'][0]
+        elif msg.method == 'dropped':
+            if self.held is not None and self.held in kw['clusters']:
+                # someone else joined our cluster; stop moving it
+                self._lose_held()
+
+    def _drawn_xy(self, cid):
+        '''where a piece of cluster cid is drawn. The cluster position is that
+        of the image origin, which may be far away from the pieces.'''
+        x, y, rotation = self.positions[cid]
+        px, py = self.piece_centers[self.cluster_pieces[cid][0]]
+        theta = 2. * pi * rotation / self.rotations
+        # see Cluster.rotate
+        return x + px * cos(theta) + py * sin(theta), y - px * sin(theta) + py * cos(theta)
+
+    def _send_viewport(self):
+        '''reports a random viewport covering the fraction self.viewport of the board.'''
+        drawn = [self._drawn_xy(cid) for cid in self.positions]
+        xs = [p[0] for p in drawn]
+        ys = [p[1] for p in drawn]
+        scale = self.viewport ** 0.5
+        width, height = (max(xs) - min(xs)) * scale, (max(ys) - min(ys)) * scale
+        x = self.rng.uniform(min(xs), max(xs) - width)
+        y = self.rng.uniform(min(ys), max(ys) - height)
+        self.send('viewport', x=x, y=y, width=width, height=height)
+
+    def _lose_held(self):
+        self.held = None
+        if self._waiter and not self._waiter[1].done():
+            self._waiter[1].set_result(None)
+
+    def _target(self, cid):
+        '''position where cluster cid would join a neighbour, or None.'''
+        if not self.cluster_pieces.get(cid):
+            return None
+        pid = self.rng.choice(self.cluster_pieces[cid])
+        others = [
+            self.piece_cluster[q] for q in self.neighbours.get(pid, [])
+            if self.piece_cluster.get(q, cid) != cid
+        ]
+        if not others:
+            return None
+        return self.positions.get(self.rng.choice(others))
+
+    async def run(self, deadline):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=1 << 26)
+        if self.compression is not None:
+            self.writer.write(self.compression.hello())
+        reading = asyncio.ensure_future(self._read_loop())
+        name = self.name
+        kwargs = {'room': self.room} if self.room else {}
+        msg = await self.request(
+            'connect', lambda m: m.method == 'connected' and m.kwargs['name'] == name, name=name, **kwargs)
+        if msg is None:
+            raise RuntimeError('%s could not connect'%name)
+        self.playerid = msg.kwargs['playerid']
+        await self.request('get_puzzle', lambda m: m.method == 'puzzle')
+        if self.viewport:
+            self._send_viewport()
+        while time.monotonic() < deadline:
+            cid = self.rng.choice(list(self.positions))
+            msg = await self.request(
+                'grab',
+                lambda m: m.method == 'grabbed' and m.kwargs['playerid'] == self.playerid,
+                clusters=[cid]
+            )
+            if not msg or cid not in msg.kwargs['clusters'] or cid not in self.positions:
+                continue
+            x, y, rotation = self.positions[cid]
+            for step in range(self.moves):
+                x += self.rng.uniform(-20, 20)
+                y += self.rng.uniform(-20, 20)
+                if step == self.moves - 1 and self.rng.random() < self.join_rate:
+                    target = self._target(cid)
+                    if target:
+                        x, y, rotation = target[0] + self.rng.uniform(-SNAP, SNAP), target[1], target[2]
+                key = str(cid)
+                msg = await self.request(
+                    'move',
+                    lambda m: m.method == 'moved' and key in m.kwargs['cluster_positions'],
+                    cluster_positions={key: {'x': x, 'y': y, 'rotation': rotation}}
+                )
+                if msg is None or self.held is None:
+                    break
+            if self.held is None:
+                # lost it
+                continue
+            self.held = None
+            await self.request('drop', lambda m: m.method == 'dropped' and cid in m.kwargs['clusters'], clusters=[cid])
+        self.send('disconnect')
+        await self.writer.drain()
+        reading.cancel()
+        try:
+            await reading
+        except asyncio.CancelledError:
+            pass
+        self.writer.close()
+
+
+# ---- server handling ----
+
+def _wait_for_port(port, timeout=30.):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not come up on port %d'%port)
+
+
+class SubprocessServer(object):
+    def __init__(self, folder, port, args, rooms=0):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+        # log goes to puzzleboard.log in folder.
+        self.logfile = os.path.join(folder, 'puzzleboard.log')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'puzzleboard', '--port=%d'%port]
+            + (['--rooms=%s'%folder] if rooms else []) + args,
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, cwd=folder, env=env,
+        )
+        _wait_for_port(port)
+        if not rooms:
+            self.process.stdin.write(('load_puzzle path:"%s"\n'%folder).encode('utf8'))
+            self.process.stdin.flush()
+            self._wait_for_log('New puzzle was loaded')
+        self.cpu_start = self.cpu_time()
+
+    def _wait_for_log(self, text, timeout=60.):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if os.path.exists(self.logfile) and text in open(self.logfile).read():
+                return
+            time.sleep(0.1)
+        raise RuntimeError('server did not log %r'%text)
+
+    def cpu_time(self):
+        '''CPU time of the server and its worker processes (--workers).'''
+        pids = [self.process.pid]
+        try:
+            with open('/proc/%d/task/%d/children'%(self.process.pid, self.process.pid)) as f:
+                pids += [int(pid) for pid in f.read().split()]
+        except OSError:
+            pass
+        total = None
+        for pid in pids:
+            try:
+                with open('/proc/%d/stat'%pid) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            # utime, stime are fields 14, 15 (counting from 1, pid and name cut off)
+            total = (total or 0) + (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        return total
+
+    def peak_memory(self):
+        try:
+            with open('/proc/%d/status'%self.process.pid) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+
+    def stop(self):
+        self.process.stdin.write(b'quit\n')
+        self.process.stdin.close()
+        self.process.wait(30)
+
+
+class InprocessServer(object):
+    def __init__(self, folder, port, args, rooms=0):
+        if rooms:
+            raise ValueError('--rooms needs the subprocess server')
+        import resource
+        from neatocom.asyncio_transports import AsyncioMuxTransport, AsyncioTcpServerTransport
+        from puzzleboard.puzzle_service import PuzzleService
+        self._resource = resource
+        self.transport = AsyncioMuxTransport()
+        server = AsyncioTcpServerTransport(port=port)
+        self.transport += server
+        self.service = PuzzleService(
+            codec=TerseCodec(),
+            transport=self.transport,
+            announcer=None,
+            close_handler=server.close,
+            quit_handler=self.transport.stop,
+        )
+        self.service.on_load_puzzle('stdio', folder)
+        self.thread = threading.Thread(target=self.transport.run, name='puzzleboard')
+        self.thread.start()
+        _wait_for_port(port)
+        self.cpu_start = self.cpu_time()
+
+    def cpu_time(self):
+        usage = self._resource.getrusage(self._resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    def peak_memory(self):
+        return self._resource.getrusage(self._resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def stop(self):
+        self.transport.stop()
+        self.thread.join()
+        self.service.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p / 100. * len(values)), len(values) - 1)]
+
+
+def run(players, pieces, duration, port, inprocess=False, server_args=(), join_rate=0.2, seed=1, grid='rect', compress=False, rooms=0, viewport=None):
+    folder = tempfile.mkdtemp(prefix='puzzleboard_benchmark_')
+    if rooms:
+        room_ids = ['room%d'%i for i in range(rooms)]
+        for room_id in room_ids:
+            count = len(make_puzzle_folder(os.path.join(folder, room_id), pieces, grid, seed, images=False).pieces)
+        pieces = count
+    else:
+        room_ids = [None]
+        pieces = len(make_puzzle_folder(folder, pieces, grid, seed, images=False).pieces)
+    server = (InprocessServer if inprocess else SubprocessServer)(folder, port, list(server_args), rooms)
+    stats = Stats()
+    loop = asyncio.new_event_loop()
+    t = time.monotonic()
+    try:
+        deadline = t + duration
+        async def play():
+            await asyncio.gather(*[
+                Player(
+                    'player%d'%i, '127.0.0.1', port, stats, seed=seed+i, join_rate=join_rate, compress=compress,
+                    room=room_ids[i % len(room_ids)], viewport=viewport,
+                ).run(deadline)
+                for i in range(players)
+            ])
+        loop.run_until_complete(play())
+        elapsed = time.monotonic() - t
+        cpu = server.cpu_time()
+        memory = server.peak_memory()
+    finally:
+        server.stop()
+        loop.close()
+
+    requests = sum(len(l) for l in stats.latencies.values())
+    print('%d players, %d pieces (%s)%s, %.1f s, server %s'%(
+        players, pieces, grid, ' in %d rooms'%rooms if rooms else '', elapsed, 'in-process' if inprocess else 'subprocess ' + ' '.join(server_args)))
+    print('requests: %d (%.0f/s), timeouts: %d, joins: %d'%(requests, requests/elapsed, stats.timeouts, stats.joins))
+    print('messages received by players: %d (%.0f/s, %.1f per request), %.1f MB%s'%(
+        stats.received, stats.received/elapsed, stats.received/max(requests, 1),
+        stats.received_bytes/1e6, ' compressed' if compress else ''))
+    for method, latencies in sorted(stats.latencies.items()):
+        print('  %-10s n=%6d  p50=%7.2f ms  p99=%7.2f ms'%(
+            method, len(latencies), 1000*percentile(latencies, 50), 1000*percentile(latencies, 99)))
+    if cpu is not None:
+        print('server cpu: %.2f s (%.0f%% of one core)'%(cpu - server.cpu_start, 100*(cpu - server.cpu_start)/elapsed))
+    if memory is not None:
+        print('server peak memory: %.1f MB'%(memory / 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='puzzleboard load generator')
+    parser.add_argument('--players', type=int, default=10)
+    parser.add_argument('--pieces', type=int, default=1000)
+    parser.add_argument('--grid', choices=GRIDS, default='rect')
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--port', type=int, default=8898)
+    parser.add_argument('--join-rate', type=float, default=0.2, help='fraction of drops next to a neighbour')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--inprocess', action='store_true', help='run PuzzleService in this process')
+    parser.add_argument('--threaded', action='store_true', help='server uses threaded transports')
+    parser.add_argument('--compress', action='store_true', help='players negotiate compression')
+    parser.add_argument('--rooms', type=int, default=0, help='multi-room server with this many rooms')
+    parser.add_argument('--workers', type=int, help='with --rooms: number of server worker processes')
+    parser.add_argument('--viewport', type=float, help='players report viewports of this fraction of the board')
+    args = parser.parse_args()
+    logging.basicConfig(level='WARNING')
+    server_args = ['--threaded'] if args.threaded else []
+    if args.workers is not None:
+        server_args.append('--workers=%d'%args.workers)
+    run(
+        args.players, args.pieces, args.duration, args.port,
+        inprocess=args.inprocess, server_args=server_args,
+        join_rate=args.join_rate, seed=args.seed, grid=args.grid, compress=args.compress,
+        rooms=args.rooms, viewport=args.viewport,
+    )
@@ -0,0 +1,110 @@
+'''
+Benchmark for the spatial grid of the puzzle board (puzzleboard.spatial).
+
+Builds a shuffled synthetic puzzle (see puzzle_fixtures), then measures
+against a linear scan over all clusters:
+ * rect: clusters in a viewport-sized rectangle
+ * nearest: cluster closest to a point
+and the cost of keeping the grid up to date (move_cluster, join), plus
+free_area lookups. The results of the grid queries are checked against
+the linear scan.
+
+Run from the repository root:
+
+    python -m tests.puzzleboard_spatial_benchmark --pieces 10000
+'''
+import time
+import random
+import argparse
+
+from puzzleboard.spatial import _distance
+from .puzzle_fixtures import make_board
+
+
+def _per_call(func, args):
+    t = time.perf_counter()
+    results = [func(*a) for a in args]
+    return (time.perf_counter() - t) / len(args), results
+
+
+def scan_rect(board, x0, y0, x1, y1):
+    result = set()
+    for cluster in board.clusters:
+        bx0, by0, bx1, by1 = board.cluster_box(cluster)
+        if bx0 <= x1 and x0 <= bx1 and by0 <= y1 and y0 <= by1:
+            result.add(cluster)
+    return result
+
+def scan_nearest(board, x, y):
+    return min(_distance(board.cluster_box(cluster), x, y) for cluster in board.clusters)
+
+
+def run(pieces, queries, seed):
+    rng = random.Random(seed)
+    t = time.perf_counter()
+    board = make_board(pieces, seed=seed)
+    print('board: %d clusters, built and shuffled in %.2f s (grid cell %.0f)'%(
+        len(board.clusters), time.perf_counter() - t, board.grid.cell_size))
+    t = time.perf_counter()
+    board.update_grid(board.clusters)
+    print('grid update of all clusters: %.1f ms'%(1e3 * (time.perf_counter() - t)))
+
+    boxes = [board.cluster_box(cluster) for cluster in board.clusters]
+    x0, y0 = min(b[0] for b in boxes), min(b[1] for b in boxes)
+    x1, y1 = max(b[2] for b in boxes), max(b[3] for b in boxes)
+    # a viewport showing about 2% of the table
+    vw, vh = 0.15 * (x1 - x0), 0.15 * (y1 - y0)
+
+    rects = []
+    for i in range(queries):
+        x, y = rng.uniform(x0, x1 - vw), rng.uniform(y0, y1 - vh)
+        rects.append((x, y, x + vw, y + vh))
+    grid_s, grid_res = _per_call(lambda *r: board.grid.rect(*r), rects)
+    scan_s, scan_res = _per_call(lambda *r: scan_rect(board, *r), rects)
+    assert grid_res == scan_res
+    print('rect:     grid %8.1f us   scan %8.1f us   (%.0fx, %.0f clusters per query)'%(
+        1e6 * grid_s, 1e6 * scan_s, scan_s / grid_s, sum(map(len, grid_res)) / float(queries)))
+
+    points = [(rng.uniform(x0, x1), rng.uniform(y0, y1)) for i in range(queries)]
+    grid_s, grid_res = _per_call(lambda x, y: board.grid.nearest(x, y)[1], points)
+    scan_s, scan_res = _per_call(lambda x, y: scan_nearest(board, x, y), points)
+    assert grid_res == scan_res
+    print('nearest:  grid %8.1f us   scan %8.1f us   (%.0fx)'%(1e6 * grid_s, 1e6 * scan_s, scan_s / grid_s))
+
+    sample = board.clusters[0].pieces[0]
+    size = 3 * (sample.w + sample.h)
+    free_s, free_res = _per_call(lambda x, y: board.grid.free_area(size, size, x, y), points[:max(queries // 10, 1)])
+    for fx, fy in free_res:
+        assert not board.grid.rect(fx, fy, fx + size, fy + size)
+    print('free_area (%.0f x %.0f): %8.1f us'%(size, size, 1e6 * free_s))
+
+    # keeping the grid up to date
+    clusters = rng.sample(board.clusters, min(queries, len(board.clusters)))
+    moves = [(c, c.x + rng.uniform(-size, size), c.y + rng.uniform(-size, size), c.rotation) for c in clusters]
+    move_s, _ = _per_call(board.move_cluster, moves)
+    print('move_cluster incl. grid update: %8.1f us'%(1e6 * move_s))
+    joins = []
+    for cluster in clusters[:len(clusters) // 2]:
+        if cluster._index is None or board.clusters[cluster._index] is not cluster:
+            continue
+        other = board.pieces_by_id[rng.choice(board.links).id1].cluster
+        if other is not cluster:
+            joins.append(([other], cluster))
+    t = time.perf_counter()
+    done = 0
+    for others, cluster in joins:
+        if board.clusters[others[0]._index] is others[0] and board.clusters[cluster._index] is cluster:
+            board.join(others, to_cluster=cluster)
+            done += 1
+    print('join incl. grid update: %8.1f us (%d joins)'%(1e6 * (time.perf_counter() - t) / max(done, 1), done))
+    assert len(board.grid) == len(board.clusters)
+    assert scan_rect(board, x0, y0, x1, y1) == board.grid.rect(x0, y0, x1, y1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='spatial grid benchmark')
+    parser.add_argument('--pieces', type=int, default=10000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    run(args.pieces, args.queries, args.seed)